@@ -0,0 +1,327 @@
+"""
+In-process MQTT broker stand-in and a paho.mqtt.client compatible Client.
+
+install() registers this module as paho.mqtt.client (and as the properties,
+packettypes and subscribeoptions modules MQTT v5 mode imports), so the script
+under test publishes straight into BROKER. MQTT v5 topic aliases are resolved
+per connection the way a broker would, so using one before it is set fails. Delivery is synchronous and in order, which keeps
+the numbers about the script's own cost rather than about sockets.
+"""
+import itertools
+import sys
+import threading
+import types
+
+MQTTv31 = 3
+MQTTv311 = 4
+MQTTv5 = 5
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+class PacketTypes:
+    CONNACK = 2
+    PUBLISH = 3
+    SUBSCRIBE = 8
+
+
+class Properties:
+    """
+    MQTT v5 properties, set as attributes like paho.mqtt.properties.Properties
+    """
+    def __init__(self, packet_type):
+        self.packet_type = packet_type
+
+
+class SubscribeOptions:
+    def __init__(self, qos=0, noLocal=False, retainAsPublished=False, retainHandling=0):
+        self.QoS = qos
+        self.noLocal = noLocal
+        self.retainAsPublished = retainAsPublished
+        self.retainHandling = retainHandling
+
+
+def encode(payload):
+    """
+    Payload bytes the way paho sends them
+    """
+    if payload is None:
+        return b""
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    if isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    return payload
+
+
+def topic_matches(topic_filter, topic):
+    """
+    MQTT topic filter matching, with the + and # wildcards
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class MQTTMessage:
+    def __init__(self, topic, payload, qos=0, retain=False, properties=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.properties = properties
+
+
+class MQTTMessageInfo:
+    def __init__(self, mid, rc=MQTT_ERR_SUCCESS, acknowledged=True):
+        self.mid = mid
+        self.rc = rc
+        self._published = threading.Event()
+        if rc == MQTT_ERR_SUCCESS and acknowledged:
+            self._published.set()
+
+    def is_published(self):
+        return self._published.is_set()
+
+    def wait_for_publish(self, timeout=None):
+        if self.rc != MQTT_ERR_SUCCESS:
+            raise RuntimeError(f"Message publish failed: {self.rc}")
+        self._published.wait(timeout)
+
+
+class Broker:
+    """
+    Keeps subscriptions and retained messages, and counts what went through it
+    """
+    def __init__(self, topic_alias_maximum=16, ack_delay=0.0):
+        self.lock = threading.RLock()
+        self.topic_alias_maximum = topic_alias_maximum # Sent to MQTT v5 clients in CONNACK
+        self.ack_delay = ack_delay # Seconds before QoS > 0 publishes are acknowledged, None never acks
+        self.subscriptions = []
+        self.retained = {}
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.messages = 0
+        self.bytes = 0
+        self.retained_messages = 0
+        self.subscribe_requests = 0
+        self.aliased_messages = 0
+        self.per_topic = {}
+
+    def publish(self, sender, topic, payload, qos=0, retain=False, properties=None):
+        with self.lock:
+            wire_topic = topic
+            alias = getattr(properties, "TopicAlias", None)
+            if alias is not None:
+                if not 0 < alias <= self.topic_alias_maximum:
+                    raise ValueError(f"Topic alias {alias} out of range")
+                if topic:
+                    sender.topic_aliases[alias] = topic
+                else:
+                    topic = sender.topic_aliases[alias] # KeyError: alias used before it was set
+                    self.aliased_messages += 1
+                self.bytes += 3 # Property identifier and two byte alias
+            self.messages += 1
+            self.bytes += len(wire_topic) + len(payload)
+            self.per_topic[topic] = self.per_topic.get(topic, 0) + 1
+            if retain:
+                self.retained_messages += 1
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            receivers = [client for topic_filter, client, no_local in self.subscriptions
+                         if client.connected and not (no_local and client is sender)
+                         and topic_matches(topic_filter, topic)]
+        for client in receivers:
+            client.deliver(MQTTMessage(topic, payload, qos, retain, properties))
+
+    def subscribe(self, client, topic_filters):
+        """
+        Handles one SUBSCRIBE packet, a list of (topic_filter, no_local)
+        """
+        with self.lock:
+            self.subscribe_requests += 1
+            for topic_filter, no_local in topic_filters:
+                self.subscriptions.append((topic_filter, client, no_local))
+            retained = [(topic, payload) for topic, payload in self.retained.items()
+                        if any(topic_matches(topic_filter, topic) for topic_filter, _ in topic_filters)]
+        for topic, payload in retained:
+            client.deliver(MQTTMessage(topic, payload, retain=True))
+
+    def unsubscribe(self, client, topic_filter):
+        with self.lock:
+            self.subscriptions = [(f, c, n) for f, c, n in self.subscriptions
+                                  if not (c is client and f == topic_filter)]
+
+    def drop(self, client):
+        with self.lock:
+            self.subscriptions = [(f, c, n) for f, c, n in self.subscriptions if c is not client]
+
+
+BROKER = Broker()
+
+
+class Client:
+    """
+    The subset of paho.mqtt.client.Client the script and the companion services use
+    """
+    def __init__(self, client_id="", clean_session=None, userdata=None,
+                 protocol=MQTTv311, transport="tcp", **kwargs):
+        self.client_id = client_id
+        self.protocol = protocol
+        self.userdata = userdata
+        self.connected = False
+        self.will = None
+        self.topic_aliases = {} # Alias -> topic the broker has seen from this client, per connection
+        self._mid = itertools.count(1)
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+
+    # Connection
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.will = (topic, encode(payload), qos, retain)
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def tls_set_context(self, context=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect_async(self, host, port=1883, keepalive=60, *args, **kwargs):
+        self.host = host
+        self.port = port
+
+    def connect(self, host, port=1883, keepalive=60, *args, **kwargs):
+        self.connect_async(host, port, keepalive)
+        self.connect_now()
+
+    def connect_now(self):
+        """
+        Completes the connection as if the broker had sent CONNACK
+        """
+        self.connected = True
+        self.topic_aliases.clear()
+        if self.on_connect is None:
+            return
+        if self.protocol == MQTTv5:
+            properties = Properties(PacketTypes.CONNACK)
+            properties.TopicAliasMaximum = BROKER.topic_alias_maximum
+            self.on_connect(self, self.userdata, {}, 0, properties)
+        else:
+            self.on_connect(self, self.userdata, {}, 0)
+
+    def drop_connection(self):
+        """
+        Simulates a broker or network failure, fires the will like a real broker would
+        """
+        self.connected = False
+        BROKER.drop(self)
+        if self.will is not None:
+            topic, payload, qos, retain = self.will
+            BROKER.publish(self, topic, payload, qos, retain)
+        if self.on_disconnect is not None:
+            self._on_disconnect(1)
+
+    def disconnect(self, *args, **kwargs):
+        was_connected = self.connected
+        self.connected = False
+        BROKER.drop(self)
+        if was_connected and self.on_disconnect is not None:
+            self._on_disconnect(0)
+        return MQTT_ERR_SUCCESS
+
+    def _on_disconnect(self, rc):
+        if self.protocol == MQTTv5:
+            self.on_disconnect(self, self.userdata, rc, None)
+        else:
+            self.on_disconnect(self, self.userdata, rc)
+
+    def reconnect(self):
+        self.connect_now()
+
+    def is_connected(self):
+        return self.connected
+
+    def loop_start(self):
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self, *args):
+        return MQTT_ERR_SUCCESS
+
+    def loop_forever(self, *args, **kwargs):
+        return MQTT_ERR_SUCCESS
+
+    def socket(self):
+        return None
+
+    # Messages
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if not topic and (self.protocol != MQTTv5 or properties is None):
+            raise ValueError("Invalid topic.")
+        mid = next(self._mid)
+        if not self.connected:
+            return MQTTMessageInfo(mid, MQTT_ERR_NO_CONN)
+        BROKER.publish(self, topic, encode(payload), qos, retain, properties)
+        delay = BROKER.ack_delay
+        if qos == 0 or delay == 0:
+            self._acknowledge(mid)
+            return MQTTMessageInfo(mid)
+        info = MQTTMessageInfo(mid, acknowledged=False)
+        if delay is not None:
+            timer = threading.Timer(delay, self._acknowledge, (mid, info))
+            timer.daemon = True
+            timer.start()
+        return info
+
+    def _acknowledge(self, mid, info=None):
+        if info is not None:
+            info._published.set()
+        if self.on_publish is not None:
+            self.on_publish(self, self.userdata, mid)
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        topics = topic if isinstance(topic, list) else [(topic, options or qos)]
+        mid = next(self._mid)
+        BROKER.subscribe(self, [(topic_filter, getattr(option, "noLocal", False)) for topic_filter, option in topics])
+        return (MQTT_ERR_SUCCESS, mid)
+
+    def unsubscribe(self, topic, properties=None):
+        for topic_filter in (topic if isinstance(topic, list) else [topic]):
+            BROKER.unsubscribe(self, topic_filter)
+        return (MQTT_ERR_SUCCESS, next(self._mid))
+
+    def deliver(self, message):
+        if self.on_message is not None:
+            self.on_message(self, self.userdata, message)
+
+
+def install():
+    """
+    Makes `import paho.mqtt.client` resolve to this module
+    """
+    paho = types.ModuleType("paho")
+    paho_mqtt = types.ModuleType("paho.mqtt")
+    paho.mqtt = paho_mqtt
+    sys.modules["paho"] = paho
+    sys.modules["paho.mqtt"] = paho_mqtt
+    for name in ("client", "properties", "packettypes", "subscribeoptions"):
+        setattr(paho_mqtt, name, sys.modules[__name__])
+        sys.modules[f"paho.mqtt.{name}"] = sys.modules[__name__]
@@ -0,0 +1,373 @@
+"""
+Stand-in for the obspython module OBS injects into scripts, so the script can
+be exercised on a plain Python install. Only what the script touches is here.
+
+Frame counters advance with wall clock time at FPS and a configurable share of
+frames lag. Timers and frontend events are only ever fired by the harness
+through run_timers and fire_frontend_event, never on their own.
+"""
+import random
+import time
+
+OBS_FRONTEND_EVENT_STREAMING_STARTING = 0
+OBS_FRONTEND_EVENT_STREAMING_STARTED = 1
+OBS_FRONTEND_EVENT_STREAMING_STOPPING = 2
+OBS_FRONTEND_EVENT_STREAMING_STOPPED = 3
+OBS_FRONTEND_EVENT_RECORDING_STARTING = 4
+OBS_FRONTEND_EVENT_RECORDING_STARTED = 5
+OBS_FRONTEND_EVENT_RECORDING_STOPPING = 6
+OBS_FRONTEND_EVENT_RECORDING_STOPPED = 7
+OBS_FRONTEND_EVENT_SCENE_CHANGED = 8
+OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED = 9
+OBS_FRONTEND_EVENT_TRANSITION_CHANGED = 10
+OBS_FRONTEND_EVENT_TRANSITION_STOPPED = 11
+OBS_FRONTEND_EVENT_TRANSITION_LIST_CHANGED = 12
+OBS_FRONTEND_EVENT_SCENE_COLLECTION_CHANGED = 13
+OBS_FRONTEND_EVENT_SCENE_COLLECTION_LIST_CHANGED = 14
+OBS_FRONTEND_EVENT_PROFILE_CHANGED = 15
+OBS_FRONTEND_EVENT_PROFILE_LIST_CHANGED = 16
+OBS_FRONTEND_EVENT_EXIT = 17
+OBS_FRONTEND_EVENT_REPLAY_BUFFER_STARTING = 18
+OBS_FRONTEND_EVENT_REPLAY_BUFFER_STARTED = 19
+OBS_FRONTEND_EVENT_REPLAY_BUFFER_STOPPING = 20
+OBS_FRONTEND_EVENT_REPLAY_BUFFER_STOPPED = 21
+OBS_FRONTEND_EVENT_VIRTUALCAM_STARTED = 22
+OBS_FRONTEND_EVENT_VIRTUALCAM_STOPPED = 23
+
+OBS_TEXT_DEFAULT = 0
+OBS_TEXT_PASSWORD = 1
+OBS_PATH_FILE = 0
+OBS_PATH_FILE_SAVE = 1
+OBS_PATH_DIRECTORY = 2
+
+FPS = 60.0
+LAG_PROBABILITY = 0.001 # Share of frames that lag
+BITRATE = 6000000 # Bits per second every active output writes
+DROP_PROBABILITY = 0.002 # Share of output frames dropped by the network
+STATE = {}
+TIMERS = {}
+EVENT_CALLBACKS = []
+SIGNALS = {}
+
+
+def reset(profiles=("Default",), fps=60.0, lag_probability=0.001, scenes=("Scene",), collections=("Untitled",)):
+    """
+    Puts OBS back into a freshly started, idle state
+    """
+    global FPS
+    global LAG_PROBABILITY
+    FPS = fps
+    LAG_PROBABILITY = lag_probability
+    STATE.clear()
+    STATE.update({
+        "recording": False,
+        "streaming": False,
+        "virtual_camera": False,
+        "paused": False,
+        "replay_buffer": False,
+        "profiles": list(profiles),
+        "profile": profiles[0],
+        "scenes": list(scenes),
+        "scene": scenes[0],
+        "scene_collections": list(collections),
+        "scene_collection": collections[0],
+        "scene_enumerations": 0,
+        "started": time.monotonic(),
+        "lagged_frames": 0,
+        "lag_checked_frames": 0,
+    })
+    TIMERS.clear()
+    EVENT_CALLBACKS.clear()
+    SIGNALS.clear()
+    for output in OUTPUTS.values():
+        output.reset()
+
+
+class Output:
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.started = None
+        self.reconnecting = False
+
+    def elapsed(self):
+        return time.monotonic() - self.started if self.started is not None else 0.0
+
+    def start(self):
+        self.started = time.monotonic()
+        fire_signal(self, "start")
+
+    def reconnect(self, success=True):
+        self.reconnecting = True
+        fire_signal(self, "reconnect")
+        if success:
+            self.reconnecting = False
+            fire_signal(self, "reconnect_success")
+
+    def stop(self):
+        self.started = None
+        fire_signal(self, "stop")
+
+
+OUTPUTS = {name: Output(name) for name in ("stream", "record", "virtual_camera")}
+
+
+class Source:
+    def __init__(self, name):
+        self.name = name
+
+
+def fire_signal(output, signal):
+    for callback in list(SIGNALS.get((output.name, signal), ())):
+        callback(None)
+
+
+def fire_frontend_event(event):
+    for callback in list(EVENT_CALLBACKS):
+        callback(event)
+
+
+def run_timers(elapsed_ms=None):
+    """
+    Fires every registered timer once, or only those whose period fits in elapsed_ms
+    """
+    for callback, period in list(TIMERS.items()):
+        if elapsed_ms is None or period <= elapsed_ms:
+            callback()
+
+
+# Frontend state
+def obs_frontend_recording_active():
+    return STATE["recording"]
+
+def obs_frontend_streaming_active():
+    return STATE["streaming"]
+
+def obs_frontend_virtualcam_active():
+    return STATE["virtual_camera"]
+
+def obs_frontend_recording_paused():
+    return STATE["paused"]
+
+def obs_frontend_replay_buffer_active():
+    return STATE["replay_buffer"]
+
+def _set_output(key, output, event, active):
+    if STATE[key] == active:
+        return
+    STATE[key] = active
+    if active:
+        OUTPUTS[output].start()
+    else:
+        OUTPUTS[output].stop()
+    fire_frontend_event(event)
+
+def obs_frontend_streaming_start():
+    fire_frontend_event(OBS_FRONTEND_EVENT_STREAMING_STARTING)
+    _set_output("streaming", "stream", OBS_FRONTEND_EVENT_STREAMING_STARTED, True)
+
+def obs_frontend_streaming_stop():
+    _set_output("streaming", "stream", OBS_FRONTEND_EVENT_STREAMING_STOPPED, False)
+
+def obs_frontend_recording_start():
+    fire_frontend_event(OBS_FRONTEND_EVENT_RECORDING_STARTING)
+    _set_output("recording", "record", OBS_FRONTEND_EVENT_RECORDING_STARTED, True)
+
+def obs_frontend_recording_stop():
+    _set_output("recording", "record", OBS_FRONTEND_EVENT_RECORDING_STOPPED, False)
+
+def obs_frontend_start_virtualcam():
+    _set_output("virtual_camera", "virtual_camera", OBS_FRONTEND_EVENT_VIRTUALCAM_STARTED, True)
+
+def obs_frontend_stop_virtualcam():
+    _set_output("virtual_camera", "virtual_camera", OBS_FRONTEND_EVENT_VIRTUALCAM_STOPPED, False)
+
+def obs_frontend_get_current_profile():
+    return STATE["profile"]
+
+def obs_frontend_get_profiles():
+    return list(STATE["profiles"])
+
+def obs_frontend_set_current_profile(profile):
+    if profile in STATE["profiles"] and profile != STATE["profile"]:
+        STATE["profile"] = profile
+        fire_frontend_event(OBS_FRONTEND_EVENT_PROFILE_CHANGED)
+
+def set_profiles(profiles):
+    """
+    Replaces the profile list the way adding, renaming or deleting one in OBS does
+    """
+    STATE["profiles"] = list(profiles)
+    if STATE["profile"] not in STATE["profiles"]:
+        STATE["profile"] = STATE["profiles"][0]
+    fire_frontend_event(OBS_FRONTEND_EVENT_PROFILE_LIST_CHANGED)
+
+def obs_frontend_get_scene_names():
+    STATE["scene_enumerations"] += 1 # Costs a walk over every source in OBS
+    return list(STATE["scenes"])
+
+def obs_frontend_get_current_scene():
+    return Source(STATE["scene"])
+
+def obs_get_source_by_name(name):
+    return Source(name) if name in STATE["scenes"] else None
+
+def obs_source_get_name(source):
+    return source.name
+
+def obs_source_release(source):
+    pass
+
+def obs_frontend_set_current_scene(source):
+    if source.name != STATE["scene"]:
+        STATE["scene"] = source.name
+        fire_frontend_event(OBS_FRONTEND_EVENT_SCENE_CHANGED)
+
+def set_scenes(scenes):
+    """
+    Replaces the scene list the way adding, renaming or deleting a scene in OBS does
+    """
+    STATE["scenes"] = list(scenes)
+    fire_frontend_event(OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED)
+    if STATE["scene"] not in STATE["scenes"]:
+        STATE["scene"] = STATE["scenes"][0]
+        fire_frontend_event(OBS_FRONTEND_EVENT_SCENE_CHANGED)
+
+def obs_frontend_get_scene_collections():
+    return list(STATE["scene_collections"])
+
+def obs_frontend_get_current_scene_collection():
+    return STATE["scene_collection"]
+
+def obs_frontend_set_current_scene_collection(collection):
+    if collection in STATE["scene_collections"] and collection != STATE["scene_collection"]:
+        STATE["scene_collection"] = collection
+        STATE["scenes"] = [f"{collection} {scene}" for scene in STATE["scenes"]]
+        STATE["scene"] = STATE["scenes"][0]
+        fire_frontend_event(OBS_FRONTEND_EVENT_SCENE_COLLECTION_CHANGED)
+
+def obs_frontend_add_event_callback(callback):
+    EVENT_CALLBACKS.append(callback)
+
+def obs_frontend_remove_event_callback(callback):
+    if callback in EVENT_CALLBACKS:
+        EVENT_CALLBACKS.remove(callback)
+
+
+# Render stats
+def _elapsed_frames():
+    return int((time.monotonic() - STATE["started"]) * FPS)
+
+def obs_get_active_fps():
+    return FPS + random.uniform(-0.5, 0.5)
+
+def obs_get_average_frame_time_ns():
+    return int(random.gauss(1.5e6, 2e5))
+
+def obs_get_total_frames():
+    return _elapsed_frames()
+
+def obs_get_lagged_frames():
+    frames = _elapsed_frames()
+    new_frames = frames - STATE["lag_checked_frames"]
+    if new_frames > 0:
+        STATE["lagged_frames"] += sum(random.random() < LAG_PROBABILITY for _ in range(min(new_frames, 1000)))
+        STATE["lag_checked_frames"] = frames
+    return STATE["lagged_frames"]
+
+
+# Outputs and signals
+def obs_frontend_get_streaming_output():
+    return OUTPUTS["stream"]
+
+def obs_frontend_get_recording_output():
+    return OUTPUTS["record"]
+
+def obs_frontend_get_virtualcam_output():
+    return OUTPUTS["virtual_camera"]
+
+def obs_output_release(output):
+    pass
+
+def obs_output_get_signal_handler(output):
+    return output
+
+def obs_output_get_total_bytes(output):
+    return int(output.elapsed() * BITRATE / 8)
+
+def obs_output_get_total_frames(output):
+    return int(output.elapsed() * FPS)
+
+def obs_output_get_frames_dropped(output):
+    return int(output.elapsed() * FPS * DROP_PROBABILITY)
+
+def obs_output_get_congestion(output):
+    return random.random() * 0.1
+
+def obs_output_get_connect_time_ms(output):
+    return 120 if output.started is not None else 0
+
+def obs_output_reconnecting(output):
+    return output.reconnecting
+
+def signal_handler_connect(handler, signal, callback):
+    SIGNALS.setdefault((handler.name, signal), []).append(callback)
+
+def signal_handler_disconnect(handler, signal, callback):
+    callbacks = SIGNALS.get((handler.name, signal), [])
+    if callback in callbacks:
+        callbacks.remove(callback)
+
+
+# Timers
+def timer_add(callback, milliseconds):
+    TIMERS[callback] = milliseconds
+
+def timer_remove(callback):
+    TIMERS.pop(callback, None)
+
+def remove_current_callback():
+    pass
+
+
+# Settings and properties
+def obs_data_create():
+    return {}
+
+def obs_data_get_string(settings, name):
+    return settings.get(name, "")
+
+def obs_data_get_int(settings, name):
+    return settings.get(name, 0)
+
+def obs_data_get_double(settings, name):
+    return settings.get(name, 0.0)
+
+def obs_data_get_bool(settings, name):
+    return settings.get(name, False)
+
+def _set_default(settings, name, value):
+    settings.setdefault(name, value)
+
+obs_data_set_default_string = _set_default
+obs_data_set_default_int = _set_default
+obs_data_set_default_double = _set_default
+obs_data_set_default_bool = _set_default
+
+def obs_properties_create():
+    return []
+
+def _add_property(props, name, *args):
+    props.append(name)
+
+obs_properties_add_text = _add_property
+obs_properties_add_int = _add_property
+obs_properties_add_int_slider = _add_property
+obs_properties_add_float = _add_property
+obs_properties_add_bool = _add_property
+obs_properties_add_path = _add_property
+
+
+reset()
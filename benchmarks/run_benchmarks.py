@@ -0,0 +1,502 @@
+"""
+Offline benchmark and soak harness for update_mqtt_status_homeassistant.
+
+Runs the script against the obspython stand-in and the in-process broker in
+this directory, so it works on any Linux box without OBS or an MQTT server:
+
+    python benchmarks/run_benchmarks.py            # all benchmarks
+    python benchmarks/run_benchmarks.py --quick    # fewer iterations
+    python benchmarks/run_benchmarks.py --soak 60  # one minute of random event storms
+
+Each line reports latency percentiles of the measured call, calls and MQTT
+messages per second, the average message size on the wire (topic and payload)
+and the memory allocated while running it.
+"""
+import argparse
+import collections
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, os.path.dirname(BENCH_DIR))
+
+import fake_broker
+fake_broker.install()
+import obspython as obs
+
+SCRIPT = "update_mqtt_status_homeassistant"
+REPORT = sys.stdout # The script's own prints are silenced unless --verbose
+BASE_CHANNEL = "homeassistant"
+SENSOR_NAME = "obs"
+
+
+def load_script(profiles=("Default",), connect=True, scenes=("Scene",), **settings):
+    """
+    Imports a fresh copy of the script and runs it through OBS's load sequence
+    """
+    obs.reset(profiles=profiles, scenes=scenes)
+    fake_broker.BROKER.__init__()
+    sys.modules.pop(SCRIPT, None)
+    script = importlib.import_module(SCRIPT)
+    data = obs.obs_data_create()
+    script.script_defaults(data)
+    data.update({
+        "mqtt_base_channel": BASE_CHANNEL,
+        "mqtt_sensor_name": SENSOR_NAME,
+        "controllable": True,
+    })
+    data.update(settings)
+    script.script_load(data)
+    script.script_update(data)
+    if connect:
+        script.CLIENT.connect_now()
+        script.discover_pending()
+    fake_broker.BROKER.reset_counters()
+    return script
+
+
+def unload_script(script):
+    script.script_unload()
+    sys.modules.pop(SCRIPT, None)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+
+class Result:
+    def __init__(self, name):
+        self.name = name
+        self.samples_ns = []
+        self.elapsed = 0.0
+        self.messages = 0
+        self.bytes = 0
+        self.allocated_kib = 0.0
+
+    def report(self):
+        ordered = sorted(self.samples_ns)
+        calls = len(ordered)
+        rate = calls / self.elapsed if self.elapsed else 0.0
+        message_rate = self.messages / self.elapsed if self.elapsed else 0.0
+        message_size = self.bytes / self.messages if self.messages else 0.0
+        print(f"{self.name:<44} n={calls:<6} "
+              f"p50={percentile(ordered, 0.50) / 1000:9.1f}us "
+              f"p95={percentile(ordered, 0.95) / 1000:9.1f}us "
+              f"p99={percentile(ordered, 0.99) / 1000:9.1f}us "
+              f"max={(ordered[-1] if ordered else 0) / 1000:9.1f}us "
+              f"calls/s={rate:10.0f} msgs={self.messages:<7} msgs/s={message_rate:9.0f} B/msg={message_size:6.1f} "
+              f"alloc={self.allocated_kib:8.1f}KiB", file=REPORT)
+
+
+def measure(name, setup, call, iterations, teardown=None):
+    """
+    Times call() iterations times on a script prepared by setup(), then repeats
+    a shorter run under tracemalloc so tracing doesn't distort the latencies
+    """
+    result = Result(name)
+    script = setup()
+    start = time.perf_counter()
+    for i in range(iterations):
+        before = time.perf_counter_ns()
+        call(script, i)
+        result.samples_ns.append(time.perf_counter_ns() - before)
+    if teardown is not None:
+        teardown(script)
+    result.elapsed = time.perf_counter() - start
+    result.messages = fake_broker.BROKER.messages
+    result.bytes = fake_broker.BROKER.bytes
+    unload_script(script)
+
+    script = setup()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i in range(max(1, iterations // 10)):
+        call(script, i)
+    result.allocated_kib = (tracemalloc.get_traced_memory()[1] - baseline) / 1024
+    tracemalloc.stop()
+    if teardown is not None:
+        teardown(script)
+    unload_script(script)
+    result.report()
+    return result
+
+
+def wait_for_worker(script):
+    if script.WORKER is not None:
+        deadline = time.monotonic() + 5
+        while script.WORKER.pending and time.monotonic() < deadline:
+            time.sleep(0.001)
+        time.sleep(0.01) # Let the last popped snapshot finish publishing
+
+
+# Benchmarks
+def bench_update_status(iterations, worker_mode, mqtt_v5=False):
+    def setup():
+        script = load_script(worker_mode=worker_mode, mqtt_v5=mqtt_v5)
+        obs.obs_frontend_streaming_start()
+        obs.obs_frontend_recording_start()
+        fake_broker.BROKER.reset_counters()
+        return script
+
+    def call(script, i):
+        script.update_status()
+
+    mode = ("worker" if worker_mode else "inline") + (", MQTT v5" if mqtt_v5 else "")
+    measure(f"update_status tick ({mode})", setup, call, iterations, teardown=wait_for_worker)
+
+
+def bench_bridge_tick(iterations):
+    directory = tempfile.mkdtemp()
+
+    def setup():
+        script = load_script(connect=False, bridge_mode=True, data_dir=directory)
+        obs.obs_frontend_streaming_start()
+        obs.obs_frontend_recording_start()
+        return script
+
+    def call(script, i):
+        script.bridge_tick()
+
+    measure("bridge_tick (OBS side of bridge mode)", setup, call, iterations)
+
+
+def bench_thumbnails(iterations, moving):
+    """
+    What the thumbnail worker does per captured frame: compare, encode within the byte budget, publish.
+    Capturing needs OBS's GPU, so frames are synthetic, a gradient with a box that moves (or doesn't).
+    """
+    width, height = 320, 180
+    background = bytearray(width * height * 4)
+    for y in range(height):
+        for x in range(width):
+            background[(y * width + x) * 4:(y * width + x + 1) * 4] = bytes((x * 255 // width, y * 255 // height, 96, 255))
+    frames = []
+    for i in range(8):
+        frame = bytearray(background)
+        left = (i * 37 if moving else 0) % (width - 64)
+        for y in range(40, 104):
+            frame[(y * width + left) * 4:(y * width + left + 64) * 4] = b"\xff\xff\xff\xff" * 64
+        frames.append(bytes(frame))
+
+    workers = {}
+
+    def setup():
+        script = load_script()
+        script.CAMERA = script.Camera(BASE_CHANNEL, SENSOR_NAME)
+        workers[script] = script.ThumbnailWorker(script.THUMBNAIL_MAX_BYTES, script.THUMBNAIL_THRESHOLD) # Not started
+        fake_broker.BROKER.reset_counters()
+        return script
+
+    def call(script, i):
+        workers[script].process(width, height, frames[i % len(frames)])
+
+    measure(f"thumbnail compare + encode ({'moving' if moving else 'static'})", setup, call, iterations)
+
+def bench_volmeter(iterations, source_count):
+    """
+    The work a volmeter callback does on OBS's audio thread, and its aggregation at publish time
+    """
+    import ctypes
+    levels = ctypes.c_float * 8
+    frames = [(levels(*[random.uniform(-60, -20)] * 8), levels(*[random.uniform(-40, 0)] * 8)) for _ in range(64)]
+    names = [f"Mic {i}" for i in range(source_count)]
+
+    def setup():
+        script = load_script()
+        script.AUDIO = script.AudioMeters(names, -60.0, 10, -0.5) # Not attached, fed directly
+        return script
+
+    def callback(script, i):
+        magnitude, peak = frames[i % len(frames)]
+        script.AUDIO.callback(i % source_count, magnitude, peak, peak)
+
+    def collect(script, i):
+        for j in range(50):
+            callback(script, i * 50 + j)
+        script.AUDIO.collect()
+        script.AUDIO.check_events()
+
+    measure("volmeter callback (audio thread)", setup, callback, iterations)
+    measure(f"50 callbacks + collect ({source_count} sources)", setup, collect, max(1, iterations // 50))
+
+def bench_sampling(iterations):
+    def setup():
+        script = load_script()
+        obs.obs_frontend_streaming_start()
+        return script
+
+    def call(script, i):
+        script.sample_frame_stats()
+
+    measure("sample_frame_stats", setup, call, iterations)
+
+
+def bench_command_burst(iterations, profile_count):
+    profiles = [f"Profile{i}" for i in range(profile_count)]
+    topics = [f"{BASE_CHANNEL}/switch/{SENSOR_NAME}/{switch}/set"
+              for switch in ("stream", "record", "virtual_camera")]
+    topics += [f"{BASE_CHANNEL}/switch/{profile}/profile/set" for profile in profiles]
+    sender = fake_broker.Client("home-assistant")
+    sender.connected = True
+    payloads = ("ON", "OFF")
+
+    def setup():
+        return load_script(profiles=profiles)
+
+    def call(script, i):
+        sender.publish(topics[i % len(topics)], payloads[(i // len(topics)) % 2])
+
+    measure(f"on_mqtt_message burst ({profile_count} profiles)", setup, call, iterations)
+
+    def drain(script, i):
+        for j in range(50):
+            sender.publish(topics[(i + j) % len(topics)], random.choice(payloads))
+        script.drain_commands()
+
+    measure("50 commands + drain_commands", setup, drain, max(1, iterations // 50))
+
+
+def bench_scene_commands(iterations, scene_count):
+    scenes = [f"Scene {i}" for i in range(scene_count)]
+    topic = f"{BASE_CHANNEL}/select/{SENSOR_NAME}/scene/set"
+    sender = fake_broker.Client("home-assistant")
+    sender.connected = True
+
+    def setup():
+        return load_script(scenes=scenes)
+
+    def call(script, i):
+        sender.publish(topic, scenes[(i * 7) % scene_count])
+        script.drain_commands()
+
+    enumerations = []
+
+    def teardown(script):
+        enumerations.append(obs.STATE["scene_enumerations"])
+
+    measure(f"scene select command + drain ({scene_count} scenes)", setup, call, iterations, teardown=teardown)
+    print(f"  scene list enumerated {enumerations[0]} times for {iterations} commands", file=REPORT)
+
+def bench_profile_setup(iterations, profile_count):
+    profiles = [f"Profile{i}" for i in range(profile_count)]
+
+    def setup():
+        return load_script(profiles=profiles)
+
+    def call(script, i):
+        script.setup_profiles_in_homeassistant()
+
+    measure(f"setup_profiles_in_homeassistant ({profile_count})", setup, call, iterations)
+
+
+def bench_profile_churn(iterations, profile_count):
+    profiles = [f"Profile{i}" for i in range(profile_count)]
+
+    def setup():
+        return load_script(profiles=profiles)
+
+    def call(script, i):
+        renamed = list(profiles)
+        renamed[i % profile_count] = f"Renamed{i}"
+        obs.set_profiles(renamed)
+
+    measure(f"profile rename churn ({profile_count})", setup, call, iterations)
+
+
+def bench_reconnect_loop(iterations, profile_count):
+    profiles = [f"Profile{i}" for i in range(profile_count)]
+
+    def setup():
+        return load_script(profiles=profiles)
+
+    def call(script, i):
+        script.CLIENT.drop_connection()
+        script.CLIENT.connect_now()
+        script.discover_pending()
+
+    measure(f"reconnect loop ({profile_count} profiles)", setup, call, iterations)
+
+
+def bench_reconnect_spread(instance_count, attempts):
+    """
+    Reconnect delays of instance_count encoders that lost the same broker at once,
+    reports how many of them retry in the busiest 100ms of each attempt
+    """
+    script = load_script()
+    client = fake_broker.Client("spread")
+    client.reconnect_delay_set = lambda min_delay, max_delay: None
+    backoffs = [script.Backoff(script.RECONNECT_MIN_DELAY, script.RECONNECT_MAX_DELAY) for _ in range(instance_count)]
+    elapsed = [0.0] * instance_count
+    for attempt in range(attempts):
+        for i, backoff in enumerate(backoffs):
+            elapsed[i] += backoff.disconnected(client) if attempt == 0 else backoff.attempt_failed(client)
+        busiest = max(collections.Counter(int(t * 10) for t in elapsed).values())
+        print(f"reconnect attempt {attempt + 1} ({instance_count} instances): "
+              f"{min(elapsed):6.1f}s - {max(elapsed):6.1f}s after the outage, "
+              f"at most {busiest} in the same 100ms", file=REPORT)
+    unload_script(script)
+
+
+def bench_unload(iterations, profile_count, ack_delay):
+    profiles = [f"Profile{i}" for i in range(profile_count)]
+
+    def call(script, i):
+        fake_broker.BROKER.ack_delay = ack_delay
+        script.script_unload()
+
+    ack = "never acked" if ack_delay is None else f"acked after {ack_delay * 1000:g}ms"
+    result = Result(f"script_unload ({profile_count} profiles, {ack})")
+    start = time.perf_counter()
+    for i in range(iterations):
+        script = load_script(profiles=profiles)
+        before = time.perf_counter_ns()
+        call(script, i)
+        result.samples_ns.append(time.perf_counter_ns() - before)
+        result.messages += fake_broker.BROKER.messages
+        result.bytes += fake_broker.BROKER.bytes
+        fake_broker.BROKER.ack_delay = 0.0
+        sys.modules.pop(SCRIPT, None)
+    result.elapsed = time.perf_counter() - start
+    result.report()
+    return result
+
+
+def bench_fleet(iterations, instance_count):
+    """
+    mqtt_status_fleet.py fed by instance_count simulated OBS instances, each
+    publishing its state and attributes on every tick, then rolled up
+    """
+    import mqtt_status_fleet
+    fake_broker.BROKER.__init__()
+    fleet = mqtt_status_fleet.Fleet("obs_fleet", BASE_CHANNEL)
+    aggregator = mqtt_status_fleet.create_client(fleet, BASE_CHANNEL, client_id="obs_fleet")
+    aggregator.connect_now()
+    instances = []
+    for n in range(instance_count):
+        client = fake_broker.Client(f"obs{n}")
+        client.connected = True
+        instances.append(client)
+    states = ("Streaming", "Recording", "Recording and Streaming", "Stopped", "Virtual Camera")
+    fake_broker.BROKER.reset_counters()
+    result = Result(f"fleet ingest ({instance_count} instances)")
+    start = time.perf_counter()
+    for i in range(iterations):
+        n = i % instance_count
+        tick = i // instance_count
+        frames = tick * 60
+        attributes = json.dumps({
+            "state": states[n % len(states)], "fps": 60.0, "frame_time_ns": 2000000 + (n * 7919 + tick) % 3000000,
+            "frames": frames, "lagged_frames": frames * (n % 7) // 1000, "streaming": True, "recording": False})
+        before = time.perf_counter_ns()
+        instances[n].publish(f"{BASE_CHANNEL}/sensor/obs{n}/state", states[n % len(states)])
+        instances[n].publish(f"{BASE_CHANNEL}/sensor/obs{n}/attributes", attributes)
+        result.samples_ns.append(time.perf_counter_ns() - before)
+    result.elapsed = time.perf_counter() - start
+    result.messages = fake_broker.BROKER.messages
+    result.bytes = fake_broker.BROKER.bytes
+    result.report()
+
+    fake_broker.BROKER.reset_counters()
+    result = Result(f"fleet rollup ({instance_count} instances)")
+    start = time.perf_counter()
+    for i in range(max(1, iterations // instance_count)):
+        before = time.perf_counter_ns()
+        mqtt_status_fleet.publish_rollup(aggregator, fleet, BASE_CHANNEL)
+        result.samples_ns.append(time.perf_counter_ns() - before)
+    result.elapsed = time.perf_counter() - start
+    result.messages = fake_broker.BROKER.messages
+    result.bytes = fake_broker.BROKER.bytes
+    result.report()
+    aggregator.disconnect()
+
+
+def soak(seconds, profile_count):
+    """
+    Random mix of everything the script reacts to, checks it keeps up and stays bounded
+    """
+    profiles = [f"Profile{i}" for i in range(profile_count)]
+    script = load_script(profiles=profiles, worker_mode=True)
+    sender = fake_broker.Client("home-assistant")
+    sender.connected = True
+    actions = {
+        "tick": lambda: obs.run_timers(),
+        "toggle_stream": lambda: (obs.obs_frontend_streaming_stop() if obs.STATE["streaming"]
+                                  else obs.obs_frontend_streaming_start()),
+        "toggle_record": lambda: (obs.obs_frontend_recording_stop() if obs.STATE["recording"]
+                                  else obs.obs_frontend_recording_start()),
+        "command": lambda: sender.publish(
+            f"{BASE_CHANNEL}/switch/{SENSOR_NAME}/{random.choice(('stream', 'record'))}/set",
+            random.choice(("ON", "OFF"))),
+        "profile_churn": lambda: obs.set_profiles(
+            [p if random.random() > 0.01 else f"{p}_{random.randint(0, 9)}" for p in profiles]),
+        "reconnect": lambda: (script.CLIENT.drop_connection(), script.CLIENT.connect_now(),
+                              script.discover_pending()),
+        "output_reconnect": lambda: obs.OUTPUTS["stream"].reconnect(),
+    }
+    weights = {"tick": 60, "toggle_stream": 2, "toggle_record": 2, "command": 30,
+               "profile_churn": 3, "reconnect": 1, "output_reconnect": 1}
+    names = list(weights)
+    results = {name: Result(f"soak: {name}") for name in names}
+    tracemalloc.start()
+    end = time.monotonic() + seconds
+    start = time.perf_counter()
+    while time.monotonic() < end:
+        name = random.choices(names, [weights[n] for n in names])[0]
+        before = time.perf_counter_ns()
+        actions[name]()
+        results[name].samples_ns.append(time.perf_counter_ns() - before)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for result in results.values():
+        result.elapsed = elapsed
+        result.report()
+    print(f"soak: {fake_broker.BROKER.messages} messages ({fake_broker.BROKER.messages / elapsed:.0f}/s), "
+          f"memory {current / 1024:.1f}KiB held, {peak / 1024:.1f}KiB peak", file=REPORT)
+    unload_script(script)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="run fewer iterations")
+    parser.add_argument("--profiles", type=int, default=200, help="profiles to create in OBS")
+    parser.add_argument("--soak", type=float, metavar="SECONDS", help="run the random event soak instead")
+    parser.add_argument("--verbose", action="store_true", help="show the script's own output")
+    args = parser.parse_args()
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    scale = 10 if args.quick else 1
+
+    if args.soak:
+        soak(args.soak, args.profiles)
+        return
+    bench_update_status(5000 // scale, worker_mode=False)
+    bench_update_status(5000 // scale, worker_mode=True)
+    bench_update_status(5000 // scale, worker_mode=False, mqtt_v5=True)
+    bench_bridge_tick(5000 // scale)
+    bench_thumbnails(200 // scale, moving=True)
+    bench_thumbnails(2000 // scale, moving=False)
+    bench_volmeter(20000 // scale, 4)
+    bench_sampling(20000 // scale)
+    bench_command_burst(20000 // scale, args.profiles)
+    bench_scene_commands(5000 // scale, args.profiles)
+    bench_profile_setup(50 // scale or 1, args.profiles)
+    bench_profile_churn(200 // scale, args.profiles)
+    bench_reconnect_loop(100 // scale, args.profiles)
+    bench_reconnect_spread(500, 5)
+    bench_unload(20 // scale, args.profiles, ack_delay=0.005)
+    bench_unload(2, args.profiles, ack_delay=None)
+    bench_fleet(50000 // scale, 500)
+
+
+if __name__ == "__main__":
+    main()
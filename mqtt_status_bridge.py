@@ -0,0 +1,411 @@
+"""
+Runs the MQTT side of update_mqtt_status_homeassistant.py outside of OBS.
+
+With "Publish through mqtt_status_bridge.py" enabled, the script in OBS only
+copies its state into a shared memory segment every BRIDGE_INTERVAL and
+executes the commands it finds there. This process attaches to the segment and
+runs the same script against it, so the MQTT connection, discovery, JSON, TLS
+and paho's network thread all live here instead of in OBS's interpreter. It
+can be stopped and restarted at any time without restarting OBS:
+
+    python mqtt_status_bridge.py --sensor-name obs
+
+--sensor-name and --data-dir must match the script's settings, everything else
+(broker, credentials, topics, intervals) is read from the segment, so settings
+changed in the OBS Scripts dialog apply here too.
+
+In this process this module is the obspython the script imports: the functions
+below answer the script's OBS calls from the last copy of the segment, and
+changes between two copies are fired as the frontend events and output
+signals OBS would have sent.
+"""
+import argparse
+import importlib
+import os
+import sys
+import time
+import traceback
+
+sys.modules.setdefault("obspython", sys.modules[__name__])
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = "update_mqtt_status_homeassistant"
+POLL_INTERVAL = 0.05 # How often the segment is read (in seconds)
+STALE_AFTER = 5.0 # OBS is considered gone once the segment hasn't been written for this long (in seconds)
+ATTACH_INTERVAL = 1.0 # How often to look for the segment while OBS isn't running (in seconds)
+
+OBS_FRONTEND_EVENT_STREAMING_STARTING = 0
+OBS_FRONTEND_EVENT_STREAMING_STARTED = 1
+OBS_FRONTEND_EVENT_STREAMING_STOPPING = 2
+OBS_FRONTEND_EVENT_STREAMING_STOPPED = 3
+OBS_FRONTEND_EVENT_RECORDING_STARTING = 4
+OBS_FRONTEND_EVENT_RECORDING_STARTED = 5
+OBS_FRONTEND_EVENT_RECORDING_STOPPING = 6
+OBS_FRONTEND_EVENT_RECORDING_STOPPED = 7
+OBS_FRONTEND_EVENT_SCENE_CHANGED = 8
+OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED = 9
+OBS_FRONTEND_EVENT_TRANSITION_CHANGED = 10
+OBS_FRONTEND_EVENT_TRANSITION_STOPPED = 11
+OBS_FRONTEND_EVENT_TRANSITION_LIST_CHANGED = 12
+OBS_FRONTEND_EVENT_SCENE_COLLECTION_CHANGED = 13
+OBS_FRONTEND_EVENT_SCENE_COLLECTION_LIST_CHANGED = 14
+OBS_FRONTEND_EVENT_PROFILE_CHANGED = 15
+OBS_FRONTEND_EVENT_PROFILE_LIST_CHANGED = 16
+OBS_FRONTEND_EVENT_EXIT = 17
+OBS_FRONTEND_EVENT_VIRTUALCAM_STARTED = 22
+OBS_FRONTEND_EVENT_VIRTUALCAM_STOPPED = 23
+
+OBS_TEXT_DEFAULT = 0
+OBS_TEXT_PASSWORD = 1
+OBS_PATH_FILE = 0
+OBS_PATH_FILE_SAVE = 1
+OBS_PATH_DIRECTORY = 2
+
+SEGMENT = None # The script's SharedStatus, attached to the segment OBS writes
+MODULE = None # The script, imported afresh for every OBS session
+TIMERS = {} # callback -> [period in milliseconds, next run on the monotonic clock]
+CURRENT_TIMER = None
+EVENT_CALLBACKS = []
+SIGNALS = {} # (output name, signal) -> callbacks
+
+class Output:
+    """
+    Stands for one of OBS's outputs, its counters are read from the segment
+    """
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def values(self):
+        return SEGMENT.outputs[self.name]
+
+OUTPUTS = {name: Output(name) for name in ("stream", "record", "virtual_camera")}
+
+# Frontend
+def obs_frontend_recording_active():
+    return SEGMENT.status[0]
+
+def obs_frontend_streaming_active():
+    return SEGMENT.status[1]
+
+def obs_frontend_virtualcam_active():
+    return SEGMENT.status[2]
+
+def obs_frontend_recording_paused():
+    return SEGMENT.status[3]
+
+def obs_frontend_get_profiles():
+    return list(SEGMENT.names[MODULE.SwitchType.profile])
+
+def obs_frontend_get_current_profile():
+    return SEGMENT.current(MODULE.SwitchType.profile)
+
+def obs_frontend_get_scene_names():
+    return list(SEGMENT.names[MODULE.SwitchType.scene])
+
+def obs_frontend_get_current_scene():
+    return SEGMENT.current(MODULE.SwitchType.scene) # Scenes are passed around by name here
+
+def obs_get_source_by_name(name):
+    return name
+
+def obs_source_get_name(source):
+    return source
+
+def obs_source_release(source):
+    pass
+
+def obs_frontend_get_scene_collections():
+    return list(SEGMENT.names[MODULE.SwitchType.scene_collection])
+
+def obs_frontend_get_current_scene_collection():
+    return SEGMENT.current(MODULE.SwitchType.scene_collection)
+
+def push_command(switch_type, payload, name=None):
+    SEGMENT.push_command(switch_type, payload, name)
+
+def obs_frontend_set_current_profile(profile):
+    push_command(MODULE.SwitchType.profile, MODULE.SwitchPayload.ON, profile)
+
+def obs_frontend_set_current_scene(scene):
+    push_command(MODULE.SwitchType.scene, MODULE.SwitchPayload.ON, scene)
+
+def obs_frontend_set_current_scene_collection(collection):
+    push_command(MODULE.SwitchType.scene_collection, MODULE.SwitchPayload.ON, collection)
+
+def obs_frontend_streaming_start():
+    push_command(MODULE.SwitchType.stream, MODULE.SwitchPayload.ON)
+
+def obs_frontend_streaming_stop():
+    push_command(MODULE.SwitchType.stream, MODULE.SwitchPayload.OFF)
+
+def obs_frontend_recording_start():
+    push_command(MODULE.SwitchType.record, MODULE.SwitchPayload.ON)
+
+def obs_frontend_recording_stop():
+    push_command(MODULE.SwitchType.record, MODULE.SwitchPayload.OFF)
+
+def obs_frontend_start_virtualcam():
+    push_command(MODULE.SwitchType.virtual_camera, MODULE.SwitchPayload.ON)
+
+def obs_frontend_stop_virtualcam():
+    push_command(MODULE.SwitchType.virtual_camera, MODULE.SwitchPayload.OFF)
+
+def obs_frontend_add_event_callback(callback):
+    EVENT_CALLBACKS.append(callback)
+
+def obs_frontend_remove_event_callback(callback):
+    if callback in EVENT_CALLBACKS:
+        EVENT_CALLBACKS.remove(callback)
+
+# Render stats
+def obs_get_active_fps():
+    return SEGMENT.status[4]
+
+def obs_get_average_frame_time_ns():
+    return SEGMENT.status[5]
+
+def obs_get_total_frames():
+    return SEGMENT.status[6]
+
+def obs_get_lagged_frames():
+    return SEGMENT.status[7]
+
+# Outputs and signals
+def obs_frontend_get_streaming_output():
+    return OUTPUTS["stream"]
+
+def obs_frontend_get_recording_output():
+    return OUTPUTS["record"]
+
+def obs_frontend_get_virtualcam_output():
+    return OUTPUTS["virtual_camera"]
+
+def obs_output_release(output):
+    pass
+
+def obs_output_get_signal_handler(output):
+    return output
+
+def obs_output_reconnecting(output):
+    return output.values[1]
+
+def obs_output_get_total_bytes(output):
+    return output.values[2]
+
+def obs_output_get_total_frames(output):
+    return output.values[3]
+
+def obs_output_get_frames_dropped(output):
+    return output.values[4]
+
+def obs_output_get_congestion(output):
+    return output.values[5]
+
+def obs_output_get_connect_time_ms(output):
+    return output.values[6]
+
+def signal_handler_connect(handler, signal, callback):
+    SIGNALS.setdefault((handler.name, signal), []).append(callback)
+
+def signal_handler_disconnect(handler, signal, callback):
+    callbacks = SIGNALS.get((handler.name, signal), [])
+    if callback in callbacks:
+        callbacks.remove(callback)
+
+# Timers
+def timer_add(callback, milliseconds):
+    TIMERS[callback] = [milliseconds, time.monotonic() + milliseconds / 1000]
+
+def timer_remove(callback):
+    TIMERS.pop(callback, None)
+
+def remove_current_callback():
+    if CURRENT_TIMER is not None:
+        timer_remove(CURRENT_TIMER)
+
+# Settings and properties
+def obs_data_create():
+    return {}
+
+def obs_data_get_string(settings, name):
+    return settings.get(name, "")
+
+def obs_data_get_int(settings, name):
+    return settings.get(name, 0)
+
+def obs_data_get_double(settings, name):
+    return settings.get(name, 0.0)
+
+def obs_data_get_bool(settings, name):
+    return settings.get(name, False)
+
+def obs_data_set_default(settings, name, value):
+    settings.setdefault(name, value)
+
+obs_data_set_default_string = obs_data_set_default
+obs_data_set_default_int = obs_data_set_default
+obs_data_set_default_double = obs_data_set_default
+obs_data_set_default_bool = obs_data_set_default
+
+def obs_properties_create():
+    return []
+
+def obs_properties_add(props, name, *args):
+    props.append(name)
+
+obs_properties_add_text = obs_properties_add
+obs_properties_add_int = obs_properties_add
+obs_properties_add_float = obs_properties_add
+obs_properties_add_bool = obs_properties_add
+obs_properties_add_path = obs_properties_add
+
+# Bridge
+def call(callback, *args):
+    """
+    Like OBS, a failing callback is logged and everything else keeps running
+    """
+    try:
+        callback(*args)
+    except Exception:
+        traceback.print_exc()
+
+def run_timers():
+    global CURRENT_TIMER
+    now = time.monotonic()
+    for callback, timer in list(TIMERS.items()):
+        if timer[1] > now or TIMERS.get(callback) is not timer:
+            continue
+        timer[1] = max(timer[1] + timer[0] / 1000, now) # Skip missed runs instead of bunching them up
+        CURRENT_TIMER = callback
+        call(callback)
+    CURRENT_TIMER = None
+
+def fire_event(event):
+    for callback in list(EVENT_CALLBACKS):
+        call(callback, event)
+
+def fire_signal(name, signal):
+    for callback in list(SIGNALS.get((name, signal), ())):
+        call(callback, None)
+
+def current_names():
+    return {kind: SEGMENT.current(kind) for kind in SEGMENT.LISTS}
+
+def dispatch(previous, previous_outputs, previous_names):
+    """
+    Fires the frontend events and output signals for what changed since the previous read
+    """
+    status = SEGMENT.status
+    for index, starting, started, stopped in (
+        (1, OBS_FRONTEND_EVENT_STREAMING_STARTING, OBS_FRONTEND_EVENT_STREAMING_STARTED, OBS_FRONTEND_EVENT_STREAMING_STOPPED),
+        (0, OBS_FRONTEND_EVENT_RECORDING_STARTING, OBS_FRONTEND_EVENT_RECORDING_STARTED, OBS_FRONTEND_EVENT_RECORDING_STOPPED),
+        (2, None, OBS_FRONTEND_EVENT_VIRTUALCAM_STARTED, OBS_FRONTEND_EVENT_VIRTUALCAM_STOPPED)
+    ):
+        if status[index] == previous[index]:
+            continue
+        if not status[index]:
+            fire_event(stopped)
+            continue
+        if starting is not None:
+            fire_event(starting)
+        fire_event(started)
+    names = current_names()
+    for kind, list_changed, current_changed in (
+        (MODULE.SwitchType.scene_collection, OBS_FRONTEND_EVENT_SCENE_COLLECTION_LIST_CHANGED, OBS_FRONTEND_EVENT_SCENE_COLLECTION_CHANGED),
+        (MODULE.SwitchType.scene, OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED, OBS_FRONTEND_EVENT_SCENE_CHANGED),
+        (MODULE.SwitchType.profile, OBS_FRONTEND_EVENT_PROFILE_LIST_CHANGED, OBS_FRONTEND_EVENT_PROFILE_CHANGED)
+    ):
+        generation = SEGMENT.LISTS[kind][0]
+        if status[generation] != previous[generation]:
+            fire_event(list_changed)
+        if names[kind] != previous_names[kind]:
+            fire_event(current_changed)
+    for name, values in SEGMENT.outputs.items():
+        for _ in range(min(values[7] - previous_outputs[name][7], 100)):
+            fire_signal(name, "reconnect")
+
+def attach(path):
+    """
+    Waits until OBS has created the segment and is writing to it
+    """
+    while True:
+        try:
+            segment = MODULE.SharedStatus(path)
+        except (OSError, ValueError):
+            time.sleep(ATTACH_INTERVAL)
+            continue
+        if segment.read() is not None and time.time_ns() - segment.written < STALE_AFTER * 1e9:
+            return segment
+        segment.close()
+        time.sleep(ATTACH_INTERVAL)
+
+def load_script():
+    """
+    Imports a fresh copy of the script, so nothing carries over from an earlier OBS session
+    """
+    global MODULE
+    TIMERS.clear()
+    EVENT_CALLBACKS.clear()
+    SIGNALS.clear()
+    sys.modules.pop(SCRIPT, None)
+    MODULE = importlib.import_module(SCRIPT)
+    return MODULE
+
+def settings_data():
+    data = obs_data_create()
+    MODULE.script_defaults(data)
+    data.update(SEGMENT.settings)
+    data["bridge_mode"] = False # This is the process talking MQTT
+    data["thumbnail"] = False # Only OBS can render its program output
+    data["audio_sources"] = "" # or meter its audio
+    return data
+
+def run_session(path):
+    """
+    Publishes for one OBS session, returns once OBS closes the segment or stops writing it
+    """
+    global SEGMENT
+    load_script()
+    SEGMENT = attach(path)
+    session = SEGMENT.read()
+    print(f"Attached to OBS through {path}")
+    data = settings_data()
+    MODULE.script_load(data)
+    MODULE.script_update(data)
+    settings_generation = SEGMENT.settings_generation
+    try:
+        while True:
+            previous = SEGMENT.status
+            previous_outputs = SEGMENT.outputs
+            previous_names = current_names()
+            if SEGMENT.read() != session:
+                print("OBS closed the segment")
+                return
+            if time.time_ns() - SEGMENT.written > STALE_AFTER * 1e9:
+                print(f"OBS hasn't written the segment for {STALE_AFTER}s")
+                return
+            if SEGMENT.settings_generation != settings_generation:
+                settings_generation = SEGMENT.settings_generation
+                MODULE.script_update(settings_data())
+            dispatch(previous, previous_outputs, previous_names)
+            run_timers()
+            time.sleep(POLL_INTERVAL)
+    finally:
+        MODULE.script_unload()
+        SEGMENT.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sensor-name", default="obs", help="MQTT Sensor Name set in the script")
+    parser.add_argument("--data-dir", default="", help="Data directory set in the script")
+    args = parser.parse_args()
+    path = load_script().shared_status_path(args.data_dir, args.sensor_name)
+    try:
+        while True:
+            run_session(path)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
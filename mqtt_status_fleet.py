@@ -0,0 +1,257 @@
+"""
+Rolls the sensors of many OBS instances up into one fleet sensor.
+
+Every OBS running update_mqtt_status_homeassistant.py publishes its state and
+attributes under [base channel]/sensor/[sensor name]. This service subscribes to
+all of them with wildcards, keeps the last WINDOW updates of every instance in
+small preallocated arrays and every --interval seconds publishes a single
+sensor, [base channel]/sensor/[--name], for Home Assistant to chart:
+
+    python mqtt_status_fleet.py --host broker.lan --base-channel homeassistant
+
+Its state is the number of live instances (streaming, recording or running the
+virtual camera), its attributes hold the rollups: how many instances are live,
+streaming, recording, off, offline or stale, the worst lagged frame rate and
+the p95 frame time across the fleet.
+"""
+import argparse
+import array
+import json
+import math
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+WINDOW = 60 # Updates kept per instance
+STALE_AFTER = 60.0 # A live instance that hasn't published for this long is stale (in seconds)
+ROLLUP_INTERVAL = 10.0 # How often the fleet sensor is published (in seconds)
+LIVE_STATES = {"Recording", "Streaming", "Recording and Streaming", "Virtual Camera"}
+STATES = LIVE_STATES | {"Stopped", "Off"} # Anything else on a state topic isn't an OBS sensor (diagnostics, ...)
+
+class Instance:
+    """
+    One OBS instance, its last updates are kept in arrays used as ring buffers
+    """
+    __slots__ = ("name", "state", "available", "seen", "frame_time_ms", "lagged_frames", "frames", "updates")
+
+    def __init__(self, name, window):
+        self.name = name
+        self.state = None
+        self.available = True
+        self.seen = 0.0 # Monotonic time of the last message
+        self.frame_time_ms = array.array("f", bytes(4 * window))
+        self.lagged_frames = array.array("q", bytes(8 * window))
+        self.frames = array.array("q", bytes(8 * window))
+        self.updates = 0
+
+    def add(self, attributes, now):
+        position = self.updates % len(self.frames)
+        self.frame_time_ms[position] = attributes.get("frame_time_ns", 0) / 1e6
+        self.lagged_frames[position] = attributes.get("lagged_frames", 0)
+        self.frames[position] = attributes.get("frames", 0)
+        self.updates += 1
+        self.seen = now
+
+    def samples(self):
+        return min(self.updates, len(self.frames))
+
+    def lagged_rate(self):
+        """
+        Lagged frames per rendered frame over the window (in percent)
+        """
+        samples = self.samples()
+        if samples < 2:
+            return 0.0
+        window = len(self.frames)
+        newest = (self.updates - 1) % window
+        oldest = (self.updates - samples) % window
+        frames = self.frames[newest] - self.frames[oldest]
+        if frames <= 0:
+            return 0.0 # OBS restarted, its counters went back to zero
+        return (self.lagged_frames[newest] - self.lagged_frames[oldest]) * 100 / frames
+
+    def frame_times(self):
+        return self.frame_time_ms[:self.samples()]
+
+class Fleet:
+    """
+    Every instance seen on the broker. handle() runs on paho's network thread,
+    rollup() on the main thread, the lock keeps the instance dict consistent.
+    """
+    def __init__(self, name, base_channel, window=WINDOW, stale_after=STALE_AFTER):
+        self.name = name
+        self.prefix = f"{base_channel}/sensor/" # The base channel may itself contain slashes
+        self.window = window
+        self.stale_after = stale_after
+        self.instances = {}
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.ignored = 0
+
+    def handle(self, topic, payload, now=None):
+        """
+        Takes a message from [base]/sensor/[name]/(state|attributes|availability)
+        """
+        now = time.monotonic() if now is None else now
+        parts = topic[len(self.prefix):].split("/") if topic.startswith(self.prefix) else ()
+        with self.lock:
+            self.messages += 1
+            if len(parts) != 2:
+                self.ignored += 1
+                return
+            name, kind = parts
+            if name == self.name:
+                return
+            instance = self.instances.get(name)
+            if kind == "attributes":
+                try:
+                    attributes = json.loads(payload)
+                except ValueError:
+                    attributes = None
+                if not isinstance(attributes, dict) or "frame_time_ns" not in attributes:
+                    self.ignored += 1
+                    return
+                if instance is None:
+                    instance = self.instances[name] = Instance(name, self.window)
+                instance.add(attributes, now)
+            elif kind == "state":
+                state = payload.decode("utf-8", "replace")
+                if state not in STATES:
+                    self.ignored += 1
+                    return
+                if instance is None:
+                    instance = self.instances[name] = Instance(name, self.window)
+                instance.state = state
+                instance.seen = now
+            elif kind == "availability":
+                if payload not in (b"online", b"offline"):
+                    self.ignored += 1
+                    return
+                if instance is None: # Already offline when we started, nothing else will come
+                    instance = self.instances[name] = Instance(name, self.window)
+                instance.available = payload == b"online"
+            else:
+                self.ignored += 1
+
+    def rollup(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            instances = list(self.instances.values())
+        counts = dict.fromkeys(("live", "streaming", "recording", "off", "offline", "stale"), 0)
+        stale = []
+        worst_rate = 0.0
+        worst_instance = None
+        frame_times = array.array("f")
+        for instance in instances:
+            if not instance.available:
+                counts["offline"] += 1
+                continue
+            if instance.state == "Off":
+                counts["off"] += 1
+                continue
+            if instance.state not in LIVE_STATES:
+                continue # Stopped instances only publish on changes, silence is expected
+            if now - instance.seen > self.stale_after:
+                counts["stale"] += 1
+                stale.append(instance.name)
+                continue
+            counts["live"] += 1
+            counts["streaming"] += "Streaming" in instance.state
+            counts["recording"] += "Recording" in instance.state
+            rate = instance.lagged_rate()
+            if rate > worst_rate:
+                worst_rate = rate
+                worst_instance = instance.name
+            frame_times.extend(instance.frame_times())
+        ordered = sorted(frame_times)
+        rollup = {"instances": len(instances)}
+        rollup.update(counts)
+        rollup.update({
+            "stale_instances": sorted(stale),
+            "worst_lagged_rate": round(worst_rate, 3),
+            "worst_lagged_instance": worst_instance,
+            "frame_time_ms_p95": round(ordered[math.ceil(0.95 * len(ordered)) - 1], 3) if ordered else None,
+            "messages": self.messages,
+            "ignored_messages": self.ignored
+        })
+        return rollup
+
+def topics(base_channel, name):
+    sensor = f"{base_channel}/sensor/{name}"
+    return {
+        "config": f"{sensor}/config",
+        "state": f"{sensor}/state",
+        "attributes": f"{sensor}/attributes",
+        "availability": f"{sensor}/availability"
+    }
+
+def create_client(fleet, base_channel, client_id=""):
+    """
+    A client that feeds fleet and (re)announces the fleet sensor whenever it connects
+    """
+    own = topics(base_channel, fleet.name)
+    client = mqtt.Client(client_id=client_id)
+    client.will_set(own["availability"], "offline", qos=1, retain=True)
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        print("MQTT connection successful")
+        client.subscribe([(f"{base_channel}/sensor/+/{kind}", 0) for kind in ("state", "attributes", "availability")])
+        client.publish(own["config"], json.dumps({
+            "name": f"{fleet.name}",
+            "unique_id": fleet.name,
+            "state_topic": own["state"],
+            "json_attributes_topic": own["attributes"],
+            "availability_topic": own["availability"],
+            "unit_of_measurement": "live",
+            "icon": "mdi:monitor-multiple"
+        }), retain=True)
+        client.publish(own["availability"], "online", qos=1, retain=True)
+
+    def on_message(client, userdata, message):
+        fleet.handle(message.topic, message.payload)
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    return client
+
+def publish_rollup(client, fleet, base_channel):
+    own = topics(base_channel, fleet.name)
+    rollup = fleet.rollup()
+    client.publish(own["attributes"], json.dumps(rollup))
+    client.publish(own["state"], rollup["live"])
+    return rollup
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost", help="MQTT server hostname")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT TCP/IP port")
+    parser.add_argument("--user", default="", help="MQTT username")
+    parser.add_argument("--password", default="", help="MQTT password")
+    parser.add_argument("--base-channel", default="homeassistant", help="MQTT Base Channel the OBS instances use")
+    parser.add_argument("--name", default="obs_fleet", help="sensor name of the fleet sensor")
+    parser.add_argument("--interval", type=float, default=ROLLUP_INTERVAL, help="seconds between rollups")
+    parser.add_argument("--window", type=int, default=WINDOW, help="updates kept per instance")
+    parser.add_argument("--stale-after", type=float, default=STALE_AFTER,
+                        help="seconds without a message after which a live instance is stale")
+    args = parser.parse_args()
+    fleet = Fleet(args.name, args.base_channel, args.window, args.stale_after)
+    client = create_client(fleet, args.base_channel, client_id=args.name)
+    if args.user and args.password:
+        client.username_pw_set(args.user, password=args.password)
+    client.connect_async(args.host, args.port, 60)
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(args.interval)
+            if client.is_connected():
+                publish_rollup(client, fleet, args.base_channel)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.publish(topics(args.base_channel, args.name)["availability"], "offline", qos=1, retain=True)
+        client.disconnect()
+        client.loop_stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Runs the script against the obspython stand-in and the in-process broker from
+benchmarks/, so it works without OBS or an MQTT server:
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import fake_broker
+import obspython as obs
+import run_benchmarks
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.script = run_benchmarks.load_script(sample_interval=0, heartbeat=60)
+        obs.STATE["streaming"] = True
+        self.attributes_topic = self.script.SENSOR.attributes_topic
+        # The stand-in jitters these on every call and counts frames as time passes, hold them still
+        for name, value in (("obs_get_active_fps", 60.0), ("obs_get_average_frame_time_ns", 1500000),
+                            ("obs_get_total_frames", 600), ("obs_get_lagged_frames", 0),
+                            ("obs_output_get_congestion", 0.0)):
+            patcher = mock.patch.object(obs, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        run_benchmarks.unload_script(self.script)
+
+    def attributes_sent(self):
+        return fake_broker.BROKER.per_topic.get(self.attributes_topic, 0)
+
+    def test_unchanged_stats_are_sent_once_before_the_heartbeat(self):
+        self.script.update_status()
+        self.script.update_status()
+        self.assertEqual(self.attributes_sent(), 1)
+
+    def test_unchanged_stats_are_sent_again_after_the_heartbeat(self):
+        self.script.update_status()
+        payload, sent = self.script.PUBLISHER.last_payloads[self.attributes_topic]
+        self.script.PUBLISHER.last_payloads[self.attributes_topic] = (payload, sent - 60)
+        self.script.update_status()
+        self.assertEqual(self.attributes_sent(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,31 @@ import json
 import socket # Just so we can properly handle hostname exceptions
 import obspython as obs
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.subscribeoptions import SubscribeOptions
 import ssl
-import pathlib
 import time
+import random
 import enum
 import uuid
+import threading
+import collections
+import functools
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+import bisect
+import array
+import math
+import itertools
+import ctypes
+import ctypes.util
+import sys
+import zlib
 
 
 # Meta
@@ -36,52 +56,593 @@ MQTT_HOST = "localhost" # Hostname of your MQTT server
 MQTT_USER = ""
 MQTT_PW = ""
 MQTT_PORT = 1883 # Default MQTT port is 1883
+MQTT_V5 = False # Connect with MQTT v5 for topic aliases, message expiry and no-local command subscriptions
+MQTT_TLS = False # Connect over TLS (brokers usually listen on 8883 for it)
+MQTT_CA_FILE = "" # CA certificates the broker's certificate is checked against, the system's when empty
+MQTT_CERT_FILE = "" # Client certificate (PEM) for brokers that authenticate clients by certificate
+MQTT_KEY_FILE = "" # Its private key, when it isn't in the certificate file
+MQTT_TLS_INSECURE = False # Don't verify the broker's certificate and hostname
+TLS_CONTEXT = None
+RECONNECT_MIN_DELAY = 1 # The first reconnect waits up to this, each failed attempt doubles it (in seconds)
+RECONNECT_MAX_DELAY = 120 # Longest wait between two reconnect attempts (in seconds)
 MQTT_BASE_CHANNEL = ""
 MQTT_SENSOR_NAME = "obs"
 PROFILES = []
+PROFILE = None
+ROUTES = {} # Command topic -> Switch, looked up for every incoming message
+DEVICE_DISCOVERY = False # Publish one device discovery payload instead of a config per entity
+DISCOVERY_HASH = None # Hash of the last device discovery payload published
+REMOVED_COMPONENTS = set()
+DATA_DIR = "" # Where the offline buffer and the history are kept, the system temp directory when empty
+OFFLINE_BUFFER = True # Keep snapshots taken while the broker is unreachable on disk, they're sent once it's back
+OFFLINE = None
+OFFLINE_BUFFER_RECORDS = 4096 # Snapshots kept while the broker is unreachable, oldest are evicted first
+BACKFILL_BATCH = 50 # Buffered snapshots per history message after a reconnect
+BACKFILL_INTERVAL = 0.2 # Pause between history messages (in seconds)
 STREAM_SWITCH = None
 VIRTUAL_CAMERA_SWITCH = None
 RECORD_SWITCH = None
+SCENE_SELECT = None
+SCENE_COLLECTION_SELECT = None
 SENSOR = None
 CONTROL = False
 DEBUG = False
-LOCK = False
+WORKER_MODE = False # Serialize and publish from a background thread instead of the OBS UI thread
+WORKER = None
+HEARTBEAT = 60 # Unchanged payloads are only republished this often (in seconds), 0 disables suppression
+SAMPLE_INTERVAL = 250 # Frame stats sampling interval (in milliseconds), 0 disables the windowed aggregates
+SAMPLES = None
+EVENT_DRIVEN = False # Only poll while streaming, recording or the virtual camera is active
+POLLING = False
+OUTPUT_SIGNALS = ("start", "stop", "reconnect", "reconnect_success")
+OUTPUT_CALLBACKS = {}
+OUTPUTS_CHANGED = False # Set on an output's thread when it starts, stops or reconnects, polling follows on the OBS thread
+OUTPUT_WINDOW = 6 # Samples (one per snapshot) the per-output bitrate and drop rates are computed over
+ADAPTIVE = False # Publish faster while frames lag or drop and back off while everything is stable
+ADAPTIVE_MIN_INTERVAL = 1.0 # Fastest publish interval (in seconds)
+ADAPTIVE_MAX_INTERVAL = 30.0 # Slowest publish interval (in seconds)
+LAGGED_FRAMES_THRESHOLD = 1 # Lagged frames per interval that count as an anomaly
+FRAME_TIME_THRESHOLD = 20.0 # Render frame time that counts as an anomaly (in milliseconds)
+DROPPED_FRAMES_THRESHOLD = 1 # Output frames dropped per interval that count as an anomaly
+SCHEDULER = None
+TIMER_INTERVAL = None # Period update_status is currently registered with (in milliseconds)
+SETTINGS_DEBOUNCE = 500 # Quiet time after the last edit in the Scripts GUI before it is applied (in milliseconds)
+PENDING_SETTINGS = None
+APPLIED_SETTINGS = {}
+TLS_SETTINGS = ("mqtt_tls", "mqtt_ca_file", "mqtt_cert_file", "mqtt_key_file", "mqtt_tls_insecure") # Changes recreate the MQTT client
+CONNECTION_SETTINGS = ("mqtt_host", "mqtt_port", "mqtt_user", "mqtt_pw", "mqtt_v5") + TLS_SETTINGS # Changes reconnect the MQTT client
+DISCOVERY_SETTINGS = ("mqtt_base_channel", "mqtt_sensor_name", "controllable", "device_discovery",
+                      "diagnostics_interval", "history", "thumbnail", "audio_sources") # Changes rerun Home Assistant discovery
+POLLING_SETTINGS = ("interval", "sample_interval", "event_driven", "adaptive",
+                    "adaptive_min_interval", "adaptive_max_interval") # Changes restart the polling timers
+THUMBNAIL = False # Publish a small image of the program output as a camera entity
+THUMBNAIL_INTERVAL = 10 # How often the program output is captured (in seconds)
+THUMBNAIL_READBACK_DELAY = 50 # Time the GPU gets to copy a captured frame back before it is read (in milliseconds)
+THUMBNAIL_WIDTH = 320 # Width of the image (in pixels), the height follows the canvas' aspect ratio
+THUMBNAIL_MAX_BYTES = 32768 # Largest image published, frames that can't be encoded this small are dropped
+THUMBNAIL_THRESHOLD = 2.0 # Frames whose downsampled signature differs less than this (in percent) aren't published
+THUMBNAIL_SETTINGS = ("thumbnail", "thumbnail_interval", "thumbnail_width", "thumbnail_max_bytes",
+                      "thumbnail_threshold") # Changes restart the capture
+CAPTURE = None
+THUMBNAILS = None
+CAMERA = None
+AUDIO_SOURCES = "" # Comma separated names of the audio sources to meter
+AUDIO_SILENCE_THRESHOLD = -60.0 # Peak below which a source counts as silent (in dBFS)
+AUDIO_SILENCE_SECONDS = 10 # How long a source has to stay silent before it is reported (in seconds)
+AUDIO_CLIP_THRESHOLD = -0.5 # Peak from which a source counts as clipping (in dBFS)
+AUDIO_CLIP_COOLDOWN = 5.0 # Least time between two clipping events of the same source (in seconds)
+AUDIO_EVENT_INTERVAL = 100 # How often silence and clipping are checked for (in milliseconds)
+AUDIO_SETTINGS = ("audio_sources", "audio_silence_threshold", "audio_silence_seconds",
+                  "audio_clip_threshold") # Changes reattach the meters
+AUDIO = None
+AUDIO_EVENTS = None
+KEEP_HISTORY = False # Keep every snapshot of a streaming or recording session on disk, queryable over MQTT
+HISTORY = None
+HISTORY_FILE_RECORDS = 17280 # Snapshots per history file before it rotates (a day at the default interval)
+HISTORY_MAX_FILES = 100 # History files kept, the oldest are removed first
+HISTORY_MAX_POINTS = 500 # Most records a "last N minutes" query returns, longer windows are thinned out
+HISTORY_QUERIES = threading.BoundedSemaphore(2) # History queries answered at the same time
+BRIDGE_MODE = False # Leave MQTT to mqtt_status_bridge.py, OBS only shares its state with it through memory
+BRIDGE = None
+BRIDGE_INTERVAL = 100 # How often OBS state is written for the bridge (in milliseconds)
+SHUTDOWN_FLUSH_TIMEOUT = 2.0 # Longest script_unload waits for the final messages to be acknowledged (in seconds)
+COMMAND_QUEUE_SIZE = 64 # Commands waiting for the OBS thread, the oldest are dropped beyond this
+WRITER = None
+WRITER_QUEUE_SIZE = 256 # Snapshots waiting to be written to disk, the oldest are dropped beyond this
+COMMAND_DRAIN_INTERVAL = 100 # How often the OBS thread executes queued commands (in milliseconds)
+DIAGNOSTICS_INTERVAL = 60 # How often the diagnostics sensor is published (in seconds), 0 disables it
+DIAGNOSTICS = None
+TIMINGS = {} # Histogram per instrumented function
+ACK_PENDING = {} # mid -> send time of QoS > 0 publishes waiting for their acknowledgement
+QUEUED = set() # mids of QoS 0 publishes paho hasn't written to the socket yet
+EARLY_ACKS = {} # mid -> time on_mqtt_publish saw it, before publish_tracked got to track it
+ACK_LOCK = threading.Lock() # Orders publish_tracked's bookkeeping against on_mqtt_publish
+CONNECTS = 0
+DISCONNECTS = 0
+DISCOVERY_PENDING = False # Set on paho's network thread when connected, discovery then runs on the OBS thread
 MAC = ':'.join(['{:02x}'.format((uuid.getnode() >> ele) & 0xff)
                 for ele in range(0,8*6,8)][::-1])
 
+class Publisher:
+    """
+    Remembers the last payload sent on each topic and skips identical ones until
+    the heartbeat has passed, so Home Assistant still sees the entities are alive
+    """
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        self.last_payloads = {}
+        self.published = 0
+        self.suppressed = 0
+
+    def publish(self, topic, payload, retain=False, force=False, expiry=None, qos=0):
+        now = time.monotonic()
+        last = self.last_payloads.get(topic)
+        if not force and last is not None and last[0] == payload and now - last[1] < self.heartbeat:
+            self.suppressed += 1
+            return None
+        self.last_payloads[topic] = (payload, now)
+        self.published += 1
+        if MQTT_V5:
+            return TOPIC_ALIASES.publish(topic, payload, retain, expiry, qos)
+        return publish_tracked(topic, payload, qos=qos, retain=retain)
+
+    def reset(self):
+        """
+        Forgets every payload, the next publish on each topic goes out unconditionally
+        """
+        self.last_payloads.clear()
+
+class TopicAliases:
+    """
+    MQTT v5 topic aliases for the topics published every interval. The first
+    publish on a topic carries the full topic and sets the alias, the following
+    ones send an empty topic and the two byte alias. Aliases last one connection.
+    """
+    def __init__(self):
+        self.hot = set() # Topics worth an alias, registered by the entities
+        self.reset(0)
+
+    def reset(self, maximum):
+        """
+        Forgets every alias, maximum is the Topic Alias Maximum from the broker's CONNACK
+        """
+        self.maximum = maximum
+        self.numbers = itertools.count(1)
+        self.aliases = {}
+        self.announced = set() # Topics whose alias has been handed to the client
+        self.saved_bytes = 0
+
+    def prefer(self, *topics):
+        self.hot.update(topics)
+
+    def publish(self, topic, payload, retain=False, expiry=None, qos=0):
+        alias = self.aliases.get(topic)
+        if alias is None and topic in self.hot and len(self.aliases) < self.maximum:
+            # Two threads may race for numbers, setdefault keeps one per topic
+            alias = self.aliases.setdefault(topic, next(self.numbers))
+        if alias is None or alias > self.maximum:
+            return publish_tracked(topic, payload, qos, retain, properties=publish_properties(None, expiry))
+        if topic in self.announced:
+            self.saved_bytes += len(topic)
+            return publish_tracked("", payload, qos, retain, properties=publish_properties(alias, expiry))
+        info = publish_tracked(topic, payload, qos, retain, properties=publish_properties(alias, expiry))
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.announced.add(topic) # Only once the packet setting it is queued ahead of any that use it
+        return info
+
+@functools.lru_cache(maxsize=256)
+def publish_properties(alias, expiry):
+    """
+    PUBLISH properties are only packed when sent, so one instance is shared per combination
+    """
+    if alias is None and expiry is None:
+        return None
+    properties = Properties(PacketTypes.PUBLISH)
+    if alias is not None:
+        properties.TopicAlias = alias
+    if expiry is not None:
+        properties.MessageExpiryInterval = expiry
+    return properties
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram, recording is a bisect and an increment
+    """
+    BOUNDS_US = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+
+    def __init__(self):
+        self.counts = array.array("Q", bytes(8 * (len(self.BOUNDS_US) + 1)))
+        self.count = 0
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+    def record(self, duration_ns):
+        duration_us = duration_ns / 1000
+        self.counts[bisect.bisect_left(self.BOUNDS_US, duration_us)] += 1
+        self.count += 1
+        self.total_us += duration_us
+        if duration_us > self.max_us:
+            self.max_us = duration_us
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket holding the percentile, capped at the largest value seen
+        """
+        rank = math.ceil(fraction * self.count)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.BOUNDS_US[i], round(self.max_us)) if i < len(self.BOUNDS_US) else round(self.max_us)
+        return 0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total_us / self.count, 1) if self.count else 0.0,
+            "p50_us": self.percentile(0.5),
+            "p95_us": self.percentile(0.95),
+            "p99_us": self.percentile(0.99),
+            "max_us": round(self.max_us, 1)
+        }
+
+def timed(function):
+    """
+    Records every call's duration in TIMINGS under the function's name
+    """
+    histogram = TIMINGS.setdefault(function.__name__, Histogram())
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+    return wrapper
+
+class ReconnectHistogram(Histogram):
+    """
+    Same histogram with buckets sized for reconnects, from 100ms to 10 minutes
+    """
+    BOUNDS_US = (100000, 250000, 500000, 1000000, 2500000, 5000000, 10000000, 30000000,
+                 60000000, 120000000, 300000000, 600000000)
+
+class Backoff:
+    """
+    Exponential reconnect backoff with jitter. paho can only double a fixed delay,
+    so before every retry its minimum and maximum are both set to the next delay:
+    a random point in the upper half of min_delay * 2 ** attempts (capped at
+    max_delay). Encoders that lost the same broker then come back spread out
+    instead of reconnecting and rerunning discovery at the same moment.
+    """
+    def __init__(self, min_delay, max_delay):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.attempts = 0
+        self.failed = 0
+        self.lost_at = None # Monotonic time the connection was lost, None while connected
+        self.delays = ReconnectHistogram()
+        self.outages = ReconnectHistogram()
+
+    def next_delay(self):
+        ceiling = min(self.max_delay, self.min_delay * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return random.uniform(ceiling / 2, ceiling)
+
+    def schedule(self, client):
+        delay = self.next_delay()
+        client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+        return delay
+
+    def disconnected(self, client):
+        if self.lost_at is None:
+            self.lost_at = time.monotonic()
+        delay = self.schedule(client)
+        self.delays.record(delay * 1e9)
+        return delay
+
+    def attempt_failed(self, client):
+        self.failed += 1
+        delay = self.schedule(client)
+        self.delays.record(delay * 1e9)
+        return delay
+
+    def connected(self, client):
+        if self.lost_at is not None:
+            self.outages.record((time.monotonic() - self.lost_at) * 1e9)
+            self.lost_at = None
+        self.attempts = 0
+
+    def stats(self):
+        return {
+            "failed_attempts": self.failed,
+            "delay": self.delays.summary(),
+            "outage": self.outages.summary()
+        }
+
+class ResumingContext(ssl.SSLContext):
+    """
+    Offers the TLS session of the last connection when paho opens the next one,
+    a resumed handshake skips the certificate exchange and its round trips
+    """
+    session = None
+    handshakes = 0
+    resumed = 0
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None:
+            kwargs.setdefault("session", self.session)
+        return super().wrap_socket(sock, *args, **kwargs)
+
+    def connected(self, sock):
+        """
+        Keeps the session of a connection the broker accepted
+        """
+        if not isinstance(sock, ssl.SSLSocket):
+            return
+        self.handshakes += 1
+        if sock.session_reused:
+            self.resumed += 1
+        if sock.session is not None:
+            self.session = sock.session
+
+    def stats(self):
+        return {"handshakes": self.handshakes, "resumed": self.resumed}
+
+class SampleRing:
+    """
+    Fixed-size, array-backed ring of frame stat samples taken between two publishes.
+    When it wraps the oldest samples are overwritten, lagged frames are cumulative
+    in OBS so the window delta stays exact regardless.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array.array("d", bytes(8 * capacity))
+        self.fps = array.array("d", bytes(8 * capacity))
+        self.frame_time_ns = array.array("d", bytes(8 * capacity))
+        self.lagged_frames = array.array("q", bytes(8 * capacity))
+        self.count = 0 # Samples written since creation
+        self.window_start = 0
+        self.window_time = time.monotonic()
+        self.window_lagged = None
+
+    def add(self, fps, frame_time_ns, lagged_frames):
+        i = self.count % self.capacity
+        self.timestamps[i] = time.monotonic()
+        self.fps[i] = fps
+        self.frame_time_ns[i] = frame_time_ns
+        self.lagged_frames[i] = lagged_frames
+        self.count += 1
+
+    def _ordered(self, values, start):
+        first = start % self.capacity
+        last = self.count % self.capacity
+        if first < last or self.count - start == 0:
+            return values[first:last]
+        return values[first:] + values[:last]
+
+    def drain(self):
+        """
+        Returns the samples taken since the previous drain (oldest first) and starts a new window
+        """
+        start = max(self.window_start, self.count - self.capacity)
+        window = FrameWindow(
+            self._ordered(self.fps, start),
+            self._ordered(self.frame_time_ns, start),
+            self._ordered(self.lagged_frames, start),
+            self.window_lagged,
+            time.monotonic() - self.window_time
+        )
+        if self.count > start:
+            self.window_lagged = self.lagged_frames[(self.count - 1) % self.capacity]
+        self.window_start = self.count
+        self.window_time = time.monotonic()
+        return window
+
+class FrameWindow:
+    """
+    Samples of one publish interval. Copied out of the ring on the OBS thread,
+    aggregated wherever the attributes get serialized
+    """
+    __slots__ = ("fps", "frame_time_ns", "lagged_frames", "previous_lagged", "elapsed")
+
+    def __init__(self, fps, frame_time_ns, lagged_frames, previous_lagged, elapsed):
+        self.fps = fps
+        self.frame_time_ns = frame_time_ns
+        self.lagged_frames = lagged_frames
+        self.previous_lagged = previous_lagged
+        self.elapsed = elapsed
+
+    def aggregates(self):
+        samples = len(self.frame_time_ns)
+        if samples == 0:
+            return {"samples": 0}
+        frame_times = sorted(self.frame_time_ns)
+        fps_mean = sum(self.fps) / samples
+        first_lagged = self.lagged_frames[0] if self.previous_lagged is None else self.previous_lagged
+        lagged_delta = max(0, self.lagged_frames[-1] - first_lagged)
+        return {
+            "samples": samples,
+            "frame_time_min_ns": int(frame_times[0]),
+            "frame_time_max_ns": int(frame_times[-1]),
+            "frame_time_mean_ns": int(sum(frame_times) / samples),
+            "frame_time_p95_ns": int(frame_times[math.ceil(0.95 * samples) - 1]),
+            "lagged_frames_delta": lagged_delta,
+            "lagged_frames_rate": round(lagged_delta / self.elapsed, 3) if self.elapsed > 0 else 0.0,
+            "fps_variance": round(sum((fps - fps_mean) ** 2 for fps in self.fps) / samples, 4)
+        }
+
+@functools.lru_cache(maxsize=None)
+def device_config(mqtt_sensor_name):
+    """
+    The device block shared by every entity, built once per sensor name
+    """
+    return {
+        "name": f"{mqtt_sensor_name}",
+        "identifiers": f"[['mac',{MAC}]]",
+        "manufacturer": f"OBS Script v.{__version__}",
+        "sw_version": __version__
+    }
+
+@functools.lru_cache(maxsize=None)
+def availability_config(mqtt_base_channel, mqtt_sensor_name):
+    """
+    Every entity shares one availability topic, which is also the MQTT last will,
+    so Home Assistant marks all of them unavailable the moment OBS goes away
+    """
+    return {
+        "topic": f"{mqtt_base_channel}/sensor/{mqtt_sensor_name}/availability",
+        "payload_available": Availability.online,
+        "payload_not_available": Availability.offline
+    }
+
+class OutputTelemetry:
+    """
+    Sliding window over one output's byte and frame counters. Every sample
+    overwrites the oldest slot and rates are deltas against it, so a sample
+    costs the same however long the session has been running.
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.times = array.array("d", bytes(8 * size))
+        self.total_bytes = array.array("Q", bytes(8 * size))
+        self.dropped_frames = array.array("Q", bytes(8 * size))
+        self.total_frames = array.array("Q", bytes(8 * size))
+        self.congestion = array.array("d", bytes(8 * size))
+        self.count = 0
+        self.congestion_sum = 0.0
+
+    def reset(self):
+        """
+        OBS restarts the counters with every session, so the window does too
+        """
+        self.count = 0
+        self.congestion_sum = 0.0
+
+    def sample(self, output):
+        now = time.monotonic()
+        total_bytes = obs.obs_output_get_total_bytes(output)
+        dropped_frames = obs.obs_output_get_frames_dropped(output)
+        total_frames = obs.obs_output_get_total_frames(output)
+        congestion = obs.obs_output_get_congestion(output)
+        i = self.count % self.size
+        if self.count >= self.size:
+            self.congestion_sum -= self.congestion[i]
+        self.times[i] = now
+        self.total_bytes[i] = total_bytes
+        self.dropped_frames[i] = dropped_frames
+        self.total_frames[i] = total_frames
+        self.congestion[i] = congestion
+        self.congestion_sum += congestion
+        self.count += 1
+        samples = min(self.count, self.size)
+        oldest = (self.count - samples) % self.size
+        elapsed = now - self.times[oldest]
+        window_frames = total_frames - self.total_frames[oldest]
+        window_dropped = dropped_frames - self.dropped_frames[oldest]
+        return {
+            "bitrate_kbps": round((total_bytes - self.total_bytes[oldest]) * 8 / elapsed / 1000, 1) if elapsed > 0 else 0.0,
+            "total_bytes": total_bytes,
+            "dropped_frames": dropped_frames,
+            "dropped_frames_window": window_dropped,
+            "dropped_ratio_window": round(window_dropped / window_frames, 4) if window_frames > 0 else 0.0,
+            "congestion": round(congestion, 3),
+            "congestion_mean": round(self.congestion_sum / samples, 3),
+            "reconnecting": obs.obs_output_reconnecting(output),
+            "reconnects": OUTPUT_RECONNECTS[self.name],
+            "connect_time_ms": obs.obs_output_get_connect_time_ms(output)
+        }
+
+class AdaptiveScheduler:
+    """
+    Picks the next publish interval from the snapshot just taken. Any anomaly drops
+    straight to the fastest interval, after STABLE_TICKS calm snapshots it backs
+    off by BACKOFF per tick until the slowest interval is reached.
+    """
+    STABLE_TICKS = 3
+    BACKOFF = 1.5
+
+    def __init__(self, interval):
+        self.interval = min(ADAPTIVE_MAX_INTERVAL, max(ADAPTIVE_MIN_INTERVAL, interval))
+        self.calm = 0
+        self.lagged_frames = None
+        self.dropped_frames = None
+
+    def anomaly(self, snapshot):
+        lagged_frames = snapshot.lagged_frames
+        dropped_frames = sum(output["dropped_frames"] for output in (snapshot.outputs or {}).values())
+        lagged = self.lagged_frames is not None and lagged_frames - self.lagged_frames >= LAGGED_FRAMES_THRESHOLD
+        dropped = self.dropped_frames is not None and dropped_frames - self.dropped_frames >= DROPPED_FRAMES_THRESHOLD
+        self.lagged_frames = lagged_frames
+        self.dropped_frames = dropped_frames
+        frame_time_ns = snapshot.frame_time_ns
+        if snapshot.frame_window is not None and len(snapshot.frame_window.frame_time_ns):
+            frame_time_ns = max(frame_time_ns, max(snapshot.frame_window.frame_time_ns))
+        slow = frame_time_ns >= FRAME_TIME_THRESHOLD * 1000000
+        return lagged or dropped or slow
+
+    def update(self, snapshot):
+        """
+        Returns the interval (in seconds) until the next snapshot
+        """
+        if self.anomaly(snapshot):
+            self.calm = 0
+            self.interval = ADAPTIVE_MIN_INTERVAL
+        else:
+            self.calm += 1
+            if self.calm >= self.STABLE_TICKS:
+                self.interval = min(ADAPTIVE_MAX_INTERVAL, self.interval * self.BACKOFF)
+        return self.interval
+
 class SwitchType(str, enum.Enum):
     profile = "profile"
     record = "record"
     stream = "stream"
     virtual_camera = "virtual_camera"
+    scene = "scene"
+    scene_collection = "scene_collection"
 
 class SwitchPayload(str, enum.Enum):
     OFF = "OFF"
     ON = "ON"
 
+class Availability(str, enum.Enum):
+    online = "online"
+    offline = "offline"
+
 class Switch:
     """
     Represents a controllable aspect of OBS (Profile, Record, Stream, etc.)
     """
+    platform = "switch"
+
     def __init__(self):
         self.publish_config()
-        self.subscribe()
+        self.add_route()
         self.publish_command(SwitchPayload.OFF)
 
     def publish_config(self):
-        CLIENT.publish(self.config_topic, json.dumps(self.config))
+        if DEVICE_DISCOVERY:
+            return
+        publish_tracked(self.config_topic, json.dumps(self.config))
         if DEBUG: print(f"Published config {self.config['name']}")
 
-    def subscribe(self):
-        CLIENT.subscribe(self.command_topic)
-        if DEBUG: print(f"Subscribed to {self.config['name']}")
+    def add_route(self):
+        ROUTES[self.command_topic] = self
+        if DEBUG: print(f"Routing {self.command_topic} to {self.config['name']}")
+
+    def remove_route(self):
+        ROUTES.pop(self.command_topic, None)
+        if DEBUG: print(f"Stopped routing {self.command_topic}")
 
     def publish_state(self, payload):
-        CLIENT.publish(self.state_topic, payload)
+        PUBLISHER.publish(self.state_topic, payload)
         if DEBUG: print(f"{self.config['name']} state changed to {payload}")
 
     def publish_command(self, payload):
-        CLIENT.publish(self.command_topic, payload)
+        publish_tracked(self.command_topic, payload)
         if DEBUG: print(f"{self.config['name']} command published. Payload: {payload}")
 
 class PersistentSwitch(Switch):
@@ -89,17 +650,15 @@ class PersistentSwitch(Switch):
     Switch that is persisted (retained) in MQTT
     """
     def __init__(self):
+        TOPIC_ALIASES.prefer(self.state_topic)
         super().__init__()
-        self.publish_availability(SwitchPayload.ON)
 
     def publish_config(self):
-        CLIENT.publish(self.config_topic, json.dumps(self.config), retain=True)
+        if DEVICE_DISCOVERY:
+            return
+        publish_tracked(self.config_topic, json.dumps(self.config), retain=True)
         if DEBUG: print(f"Published config {self.config['name']}")
 
-    def publish_availability(self, payload):
-        CLIENT.publish(self.available_topic, payload)
-        if DEBUG: print(f"{self.config['name']} availability set to {payload}")
-
 class ProfileSwitch(Switch):
     def __init__(self, profile_name, mqtt_base_channel, mqtt_sensor_name):
         self.profile_name = profile_name
@@ -112,23 +671,23 @@ class ProfileSwitch(Switch):
         self.config = {
             "name": f"{self.profile_name} Profile",
             "unique_id": f"{self.mqtt_sensor_name}_{self.profile_name}_profile",
-            "device": {
-                "name": f"{self.mqtt_sensor_name}",
-                "identifiers": f"[['mac',{MAC}]]",
-                "manufacturer": f"OBS Script v.{__version__}",
-                "sw_version": __version__
-            },
+            "device": device_config(self.mqtt_sensor_name),
             "state_topic": self.state_topic,
             "command_topic": self.command_topic,
             "icon": f"mdi:alpha-{self.profile_name[0].lower()}-box",
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
             "payload_on": SwitchPayload.ON,
             "payload_off": SwitchPayload.OFF
         }
         super().__init__()
 
-    def publish_remove_config(self):
-        CLIENT.publish(self.config_topic, "")
+    def publish_remove_config(self, qos=0):
+        if DEVICE_DISCOVERY:
+            REMOVED_COMPONENTS.add(self.config["unique_id"])
+            return None
+        info = publish_tracked(self.config_topic, "", qos=qos)
         if DEBUG: print(f"Removed config {self.config['name']}")
+        return info
 
 class StreamSwitch(PersistentSwitch):
     def __init__(self,  mqtt_base_channel, mqtt_sensor_name):
@@ -138,25 +697,15 @@ class StreamSwitch(PersistentSwitch):
         self.state_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/stream/state"
         self.command_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/stream/set"
         self.config_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}_stream/config"
-        self.available_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/stream/available"
         self.config = {
             "name": f"{self.mqtt_sensor_name} Stream",
             "unique_id": f"{self.mqtt_sensor_name}_stream",
-            "device": {
-                "name": f"{self.mqtt_sensor_name}",
-                "identifiers": f"[['mac',{MAC}]]",
-                "manufacturer": f"OBS Script v.{__version__}",
-                "sw_version": __version__
-            },
+            "device": device_config(self.mqtt_sensor_name),
             "state_topic": self.state_topic,
             "command_topic": self.command_topic,
             "payload_on": SwitchPayload.ON,
             "payload_off": SwitchPayload.OFF,
-            "availability": {
-                "payload_available": SwitchPayload.ON,
-                "payload_not_available": SwitchPayload.OFF,
-                "topic": self.available_topic
-            },
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
             "icon": "mdi:broadcast"
         }
         super().__init__()
@@ -169,25 +718,15 @@ class VirtualCameraSwitch(PersistentSwitch):
         self.state_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/virtual_camera/state"
         self.command_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/virtual_camera/set"
         self.config_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}_virtual_camera/config"
-        self.available_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/virtual_camera/available"
         self.config = {
             "name": f"{self.mqtt_sensor_name} Virtual Camera",
             "unique_id": f"{self.mqtt_sensor_name}_virtual_camera",
-            "device": {
-                "name": f"{self.mqtt_sensor_name}",
-                "identifiers": f"[['mac',{MAC}]]",
-                "manufacturer": f"OBS Script v.{__version__}",
-                "sw_version": __version__
-            },
+            "device": device_config(self.mqtt_sensor_name),
             "state_topic": self.state_topic,
             "command_topic": self.command_topic,
             "payload_on": SwitchPayload.ON,
             "payload_off": SwitchPayload.OFF,
-            "availability": {
-                "payload_available": SwitchPayload.ON,
-                "payload_not_available": SwitchPayload.OFF,
-                "topic": self.available_topic
-            },
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
             "icon": "mdi:broadcast"
         }
         super().__init__()
@@ -200,29 +739,120 @@ class RecordSwitch(PersistentSwitch):
         self.state_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/record/state"
         self.command_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/record/set"
         self.config_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}_record/config"
-        self.available_topic = f"{self.mqtt_base_channel}/switch/{self.mqtt_sensor_name}/record/available"
         self.config = {
             "name": f"{self.mqtt_sensor_name} Record",
             "unique_id": f"{self.mqtt_sensor_name}_record",
-            "device": {
-                "name": f"{self.mqtt_sensor_name}",
-                "identifiers": f"[['mac',{MAC}]]",
-                "manufacturer": f"OBS Script v.{__version__}",
-                "sw_version": __version__
-            },
+            "device": device_config(self.mqtt_sensor_name),
             "state_topic": self.state_topic,
             "command_topic": self.command_topic,
             "payload_on": SwitchPayload.ON,
             "payload_off": SwitchPayload.OFF,
-            "availability": {
-                "payload_available": SwitchPayload.ON,
-                "payload_not_available": SwitchPayload.OFF,
-                "topic": self.available_topic
-            },
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
             "icon": "mdi:record"
         }
         super().__init__()
 
+class NameIndex:
+    """
+    Names of something OBS lists (scenes, scene collections). Enumerating them
+    means walking every source, so they are only listed again after
+    frontend_changed has invalidated the index.
+    """
+    def __init__(self, list_names):
+        self.list_names = list_names
+        self.names = None
+        self.positions = {}
+        self.loads = 0
+
+    def get(self):
+        if self.names is None:
+            self.names = list(self.list_names())
+            self.positions = {name: position for position, name in enumerate(self.names)}
+            self.loads += 1
+        return self.names
+
+    def __contains__(self, name):
+        self.get()
+        return name in self.positions
+
+    def invalidate(self):
+        self.names = None
+
+class Select(Switch):
+    """
+    Picks one of the names in a NameIndex, which are its options in Home Assistant
+    """
+    platform = "select"
+
+    def __init__(self, index):
+        self.index = index
+        self.current = None
+        self.config["options"] = index.get()
+        TOPIC_ALIASES.prefer(self.state_topic)
+        self.publish_config()
+        self.add_route()
+
+    def publish_config(self):
+        if DEVICE_DISCOVERY:
+            return
+        publish_tracked(self.config_topic, json.dumps(self.config), retain=True)
+        if DEBUG: print(f"Published config {self.config['name']} with {len(self.config['options'])} options")
+
+    def update_options(self):
+        """
+        Republishes the config if the options changed, returns whether they did
+        """
+        options = self.index.get()
+        if options == self.config["options"]:
+            return False
+        self.config["options"] = options
+        self.publish_config()
+        return True
+
+    def select(self, name):
+        if name is None or name == self.current:
+            return
+        self.current = name
+        self.publish_state(name)
+
+class SceneSelect(Select):
+    def __init__(self, mqtt_base_channel, mqtt_sensor_name):
+        self.mqtt_base_channel = mqtt_base_channel
+        self.mqtt_sensor_name = mqtt_sensor_name
+        self.switch_type = SwitchType.scene
+        self.state_topic = f"{self.mqtt_base_channel}/select/{self.mqtt_sensor_name}/scene/state"
+        self.command_topic = f"{self.mqtt_base_channel}/select/{self.mqtt_sensor_name}/scene/set"
+        self.config_topic = f"{self.mqtt_base_channel}/select/{self.mqtt_sensor_name}_scene/config"
+        self.config = {
+            "name": f"{self.mqtt_sensor_name} Scene",
+            "unique_id": f"{self.mqtt_sensor_name}_scene",
+            "device": device_config(self.mqtt_sensor_name),
+            "state_topic": self.state_topic,
+            "command_topic": self.command_topic,
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
+            "icon": "mdi:movie-open"
+        }
+        super().__init__(SCENES)
+
+class SceneCollectionSelect(Select):
+    def __init__(self, mqtt_base_channel, mqtt_sensor_name):
+        self.mqtt_base_channel = mqtt_base_channel
+        self.mqtt_sensor_name = mqtt_sensor_name
+        self.switch_type = SwitchType.scene_collection
+        self.state_topic = f"{self.mqtt_base_channel}/select/{self.mqtt_sensor_name}/scene_collection/state"
+        self.command_topic = f"{self.mqtt_base_channel}/select/{self.mqtt_sensor_name}/scene_collection/set"
+        self.config_topic = f"{self.mqtt_base_channel}/select/{self.mqtt_sensor_name}_scene_collection/config"
+        self.config = {
+            "name": f"{self.mqtt_sensor_name} Scene Collection",
+            "unique_id": f"{self.mqtt_sensor_name}_scene_collection",
+            "device": device_config(self.mqtt_sensor_name),
+            "state_topic": self.state_topic,
+            "command_topic": self.command_topic,
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
+            "icon": "mdi:folder-multiple-image"
+        }
+        super().__init__(SCENE_COLLECTIONS)
+
 class SensorState(str, enum.Enum):
     Off = "Off"
     Stopped = "Stopped"
@@ -231,123 +861,1330 @@ class SensorState(str, enum.Enum):
     Recording_and_Streaming = "Recording and Streaming"
     VirtualCamera = "Virtual Camera"
 
+class SensorSnapshot:
+    """
+    One consistent reading of every OBS getter, state and attributes are derived
+    from it instead of asking OBS again
+    """
+    __slots__ = (
+        "timestamp", "recording", "streaming", "virtual_camera", "paused", "fps",
+        "frame_time_ns", "frames", "lagged_frames", "frame_window",
+        "reconnects", "outputs", "audio", "interval", "state", "active"
+    )
+    # timestamp, fps, frame_time_ns, frames, lagged_frames, flags
+    RECORD = struct.Struct("<ddqqqI4x")
+
+    def __init__(self, recording, streaming, virtual_camera, paused, fps,
+                 frame_time_ns, frames, lagged_frames, frame_window=None,
+                 reconnects=None, outputs=None, audio=None):
+        self.timestamp = time.time()
+        self.recording = recording
+        self.streaming = streaming
+        self.virtual_camera = virtual_camera
+        self.paused = paused
+        self.fps = fps
+        self.frame_time_ns = frame_time_ns
+        self.frames = frames
+        self.lagged_frames = lagged_frames
+        self.frame_window = frame_window
+        self.reconnects = reconnects
+        self.outputs = outputs
+        self.audio = audio
+        self.interval = None
+        if recording and streaming:
+            self.state = SensorState.Recording_and_Streaming
+        elif streaming:
+            self.state = SensorState.Streaming
+        elif recording:
+            self.state = SensorState.Recording
+        elif virtual_camera:
+            self.state = SensorState.VirtualCamera
+        else:
+            self.state = SensorState.Stopped
+        self.active = self.state != SensorState.Stopped
+
+    def attributes(self):
+        stats = {
+            "recording": self.recording,
+            "streaming": self.streaming,
+            "virtual_camera": self.virtual_camera,
+            "paused": self.paused,
+            "fps": self.fps,
+            "frame_time_ns": self.frame_time_ns,
+            "frames": self.frames,
+            "lagged_frames": self.lagged_frames
+        }
+        if self.frame_window is not None:
+            stats["window"] = self.frame_window.aggregates()
+        if self.reconnects is not None:
+            stats["reconnects"] = self.reconnects
+        if self.outputs:
+            stats["outputs"] = self.outputs
+        if self.audio:
+            stats["audio"] = self.audio
+        if self.interval is not None:
+            stats["interval_s"] = round(self.interval, 2)
+        return stats
+
+    def to_record(self):
+        """
+        Packs the snapshot into a fixed-width record for the offline buffer
+        """
+        flags = (bool(self.recording) | bool(self.streaming) << 1
+                 | bool(self.virtual_camera) << 2 | bool(self.paused) << 3)
+        return self.RECORD.pack(self.timestamp, self.fps, self.frame_time_ns,
+                                self.frames, self.lagged_frames, flags)
+
+    @classmethod
+    def from_record(cls, record):
+        timestamp, fps, frame_time_ns, frames, lagged_frames, flags = cls.RECORD.unpack(record)
+        snapshot = cls(bool(flags & 1), bool(flags & 2), bool(flags & 4), bool(flags & 8),
+                       fps, frame_time_ns, frames, lagged_frames)
+        snapshot.timestamp = timestamp
+        return snapshot
+
+class OfflineBuffer:
+    """
+    Memory mapped ring of snapshot records taken while the broker is unreachable.
+    Once full the oldest records are overwritten, so memory and disk use are fixed.
+    The file survives restarts, records nobody received are sent after the next connect.
+    """
+    HEADER = struct.Struct("<4sIQQ") # magic, capacity, head, tail
+    MAGIC = b"OBSQ"
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.evicted = 0
+        self.backfilling = False
+        size = self.HEADER.size + capacity * SensorSnapshot.RECORD.size
+        self.file = open(path, "a+b")
+        if os.path.getsize(path) != size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        magic, file_capacity, self.head, self.tail = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or file_capacity != capacity:
+            self.head = self.tail = 0
+            self.write_header()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def write_header(self):
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.capacity, self.head, self.tail)
+
+    def offset(self, index):
+        return self.HEADER.size + (index % self.capacity) * SensorSnapshot.RECORD.size
+
+    def append(self, snapshot):
+        with self.lock:
+            offset = self.offset(self.head)
+            self.map[offset:offset + SensorSnapshot.RECORD.size] = snapshot.to_record()
+            self.head += 1
+            if self.head - self.tail > self.capacity:
+                self.tail = self.head - self.capacity
+                self.evicted += 1
+            self.write_header()
+
+    def peek(self, count):
+        """
+        Returns up to count of the oldest snapshots without removing them
+        """
+        with self.lock:
+            snapshots = []
+            for index in range(self.tail, min(self.head, self.tail + count)):
+                offset = self.offset(index)
+                snapshots.append(SensorSnapshot.from_record(self.map[offset:offset + SensorSnapshot.RECORD.size]))
+            return snapshots
+
+    def consume(self, count):
+        with self.lock:
+            self.tail = min(self.head, self.tail + count)
+            self.write_header()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+class History:
+    """
+    Append-only time series of snapshots, one series of files per streaming or
+    recording session. Records are fixed width and time ordered, so queries
+    binary search for their start and read forward in CHUNK sized windows
+    without ever loading a whole file. Files rotate every file_records records
+    and only the newest max_files are kept.
+    """
+    HEADER = struct.Struct("<4sIId") # magic, version, record size, session start
+    # timestamp, fps, frame_time_ns, frames, lagged_frames, flags, output kbps, output dropped frames, congestion
+    RECORD = struct.Struct("<ddqqqIfqf4x")
+    MAGIC = b"OBSH"
+    VERSION = 1
+    CHUNK = 256 # Records per read
+    COLUMNS = ("timestamp", "fps", "frame_time_ms", "lagged_frames", "dropped_frames", "bitrate_kbps", "congestion")
+
+    def __init__(self, directory, prefix, file_records, max_files):
+        self.directory = directory
+        self.prefix = prefix
+        self.pattern = re.compile(re.escape(prefix) + r"_\d{8}-\d{6}_\d{3,}\.hist") # prefix_[UTC start]_[part].hist
+        self.file_records = file_records
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.file = None
+        self.session = None # Start time of the session being written
+        self.part = 0
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, snapshot):
+        """
+        Appends active snapshots, the first inactive one ends the session
+        """
+        with self.lock:
+            if not snapshot.active:
+                self.end_session()
+                return
+            if self.file is None or self.records >= self.file_records:
+                self.rotate(snapshot.timestamp)
+            output = (snapshot.outputs or {}).get(SwitchType.stream) or (snapshot.outputs or {}).get(SwitchType.record) or {}
+            flags = (bool(snapshot.recording) | bool(snapshot.streaming) << 1
+                     | bool(snapshot.virtual_camera) << 2 | bool(snapshot.paused) << 3)
+            self.file.write(self.RECORD.pack(
+                snapshot.timestamp, snapshot.fps, snapshot.frame_time_ns, snapshot.frames,
+                snapshot.lagged_frames, flags, output.get("bitrate_kbps", 0.0),
+                output.get("dropped_frames", 0), output.get("congestion", 0.0)))
+            self.file.flush() # Readers on other threads only see whole records
+            self.records += 1
+
+    def rotate(self, timestamp):
+        if self.file is not None:
+            self.file.close()
+            self.part += 1
+        else:
+            self.session = timestamp
+            self.part = 0
+        name = f"{self.prefix}_{time.strftime('%Y%m%d-%H%M%S', time.gmtime(self.session))}_{self.part:03d}.hist"
+        self.file = open(os.path.join(self.directory, name), "wb")
+        self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size, self.session))
+        self.records = 0
+        for path in self.files()[:-self.max_files]:
+            try:
+                os.remove(path)
+            except OSError as e: # Windows won't remove a file a query is reading
+                print(f"Could not remove old history file {path}: {e}")
+        if DEBUG: print(f"History written to {name}")
+
+    def end_session(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.session = None
+
+    def close(self):
+        with self.lock:
+            self.end_session()
+
+    def files(self):
+        """
+        Every history file, oldest first (the names are in UTC so they sort chronologically)
+        """
+        names = [name for name in os.listdir(self.directory) if self.pattern.fullmatch(name)]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def read(self, path, since=0.0):
+        """
+        Yields the records of one file from the first one at or after since, CHUNK records at a time
+        """
+        size = self.RECORD.size
+        with open(path, "rb") as file:
+            header = file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            magic, version, record_size, session = self.HEADER.unpack(header)
+            if magic != self.MAGIC or record_size != size:
+                return
+            count = (os.fstat(file.fileno()).st_size - self.HEADER.size) // size
+            low, high = 0, count
+            while low < high: # Binary search, one record read per step
+                middle = (low + high) // 2
+                file.seek(self.HEADER.size + middle * size)
+                if self.RECORD.unpack(file.read(size))[0] < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            file.seek(self.HEADER.size + low * size)
+            for start in range(low, count, self.CHUNK):
+                window = file.read(min(self.CHUNK, count - start) * size)
+                yield from self.RECORD.iter_unpack(window[:len(window) - len(window) % size])
+
+    def last_timestamp(self, path):
+        size = self.RECORD.size
+        with open(path, "rb") as file:
+            count = (os.fstat(file.fileno()).st_size - self.HEADER.size) // size
+            if count <= 0:
+                return 0.0
+            file.seek(self.HEADER.size + (count - 1) * size)
+            return self.RECORD.unpack(file.read(size))[0]
+
+    def session_of(self, path):
+        with open(path, "rb") as file:
+            header = file.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            return None
+        return self.HEADER.unpack(header)[3]
+
+    def last(self, seconds, max_points):
+        """
+        The records of the last seconds across sessions, every nth one when there
+        are more than max_points so the response stays bounded
+        """
+        since = time.time() - seconds
+        paths = []
+        for path in reversed(self.files()):
+            if self.last_timestamp(path) < since:
+                break # This and every older file ended before the window
+            paths.insert(0, path)
+        count = sum(1 for path in paths for _ in self.read(path, since))
+        stride = max(1, math.ceil(count / max_points))
+        points = []
+        index = 0
+        for path in paths:
+            for record in self.read(path, since):
+                if index % stride == 0:
+                    points.append(self.point(record))
+                index += 1
+        return {"columns": self.COLUMNS, "points": points, "records": count, "stride": stride}
+
+    def point(self, record):
+        timestamp, fps, frame_time_ns, frames, lagged_frames, flags, kbps, dropped, congestion = record
+        return (round(timestamp, 3), round(fps, 2), round(frame_time_ns / 1e6, 3), lagged_frames,
+                dropped, round(kbps, 1), round(congestion, 3))
+
+    def summary(self):
+        """
+        Aggregates of the current session, or of the last one when nothing is active
+        """
+        paths = self.files()
+        if not paths:
+            return {"session": None}
+        session = self.session_of(paths[-1])
+        paths = [path for path in paths if self.session_of(path) == session]
+        samples = 0
+        fps_min = fps_max = fps_sum = 0.0
+        frame_time_max = frame_time_sum = 0
+        kbps_max = kbps_sum = congestion_max = 0.0
+        first = last = None
+        for path in paths:
+            for record in self.read(path):
+                timestamp, fps, frame_time_ns, frames, lagged_frames, flags, kbps, dropped, congestion = record
+                if first is None:
+                    first = record
+                    fps_min = fps_max = fps
+                last = record
+                samples += 1
+                fps_min = min(fps_min, fps)
+                fps_max = max(fps_max, fps)
+                fps_sum += fps
+                frame_time_max = max(frame_time_max, frame_time_ns)
+                frame_time_sum += frame_time_ns
+                kbps_max = max(kbps_max, kbps)
+                kbps_sum += kbps
+                congestion_max = max(congestion_max, congestion)
+        if not samples:
+            return {"session": session, "samples": 0}
+        return {
+            "session": session,
+            "active": self.session == session,
+            "start": round(first[0], 3),
+            "end": round(last[0], 3),
+            "duration_s": round(last[0] - session, 1),
+            "samples": samples,
+            "files": len(paths),
+            "fps": {"min": round(fps_min, 2), "mean": round(fps_sum / samples, 2), "max": round(fps_max, 2)},
+            "frame_time_ms": {"mean": round(frame_time_sum / samples / 1e6, 3), "max": round(frame_time_max / 1e6, 3)},
+            "frames": last[3] - first[3],
+            "lagged_frames": last[4] - first[4],
+            "dropped_frames": last[7] - first[7],
+            "bitrate_kbps": {"mean": round(kbps_sum / samples, 1), "max": round(kbps_max, 1)},
+            "congestion_max": round(congestion_max, 3)
+        }
+
+class SharedStatus:
+    """
+    Memory mapped segment shared between this script in bridge mode and
+    mqtt_status_bridge.py, which then owns the MQTT connection. OBS writes its
+    state under a sequence lock (odd while a write is in progress) and executes
+    the commands the bridge queues in a single producer, single consumer ring.
+    """
+    HEADER = struct.Struct("<4sIQQQ") # magic, version, session, sequence, written (ns since the epoch)
+    # outputs active, paused, fps, frame time, frames, lagged, profiles generation, current profile,
+    # settings generation, scenes generation, current scene, scene collections generation, current collection
+    STATUS = struct.Struct("<????4xdqqqIiIIiIi")
+    OUTPUT = struct.Struct("<??6xqqqdqI4x") # active, reconnecting, bytes, frames, dropped, congestion, connect time, reconnects
+    RING = struct.Struct("<II") # head (written by the bridge), tail (written by OBS)
+    COMMAND = struct.Struct("<BB2xIi") # kind, payload, list generation, index in the list
+    BLOB = struct.Struct("<I") # length of the name list or settings that follow
+    MAGIC = b"OBSB"
+    VERSION = 2
+    COMMAND_SLOTS = 64
+    PROFILES_SIZE = 32768
+    SCENES_SIZE = 65536
+    COLLECTIONS_SIZE = 8192
+    SETTINGS_SIZE = 8192
+    KINDS = (SwitchType.stream, SwitchType.record, SwitchType.virtual_camera, SwitchType.profile,
+             SwitchType.scene, SwitchType.scene_collection)
+    OUTPUTS = (SwitchType.stream, SwitchType.record, SwitchType.virtual_camera)
+    SETTINGS_GENERATION = 10 # Index in STATUS
+
+    STATUS_OFFSET = HEADER.size
+    OUTPUTS_OFFSET = STATUS_OFFSET + STATUS.size
+    RING_OFFSET = OUTPUTS_OFFSET + len(OUTPUTS) * OUTPUT.size
+    COMMANDS_OFFSET = RING_OFFSET + RING.size
+    PROFILES_OFFSET = COMMANDS_OFFSET + COMMAND_SLOTS * COMMAND.size
+    SCENES_OFFSET = PROFILES_OFFSET + BLOB.size + PROFILES_SIZE
+    COLLECTIONS_OFFSET = SCENES_OFFSET + BLOB.size + SCENES_SIZE
+    SETTINGS_OFFSET = COLLECTIONS_OFFSET + BLOB.size + COLLECTIONS_SIZE
+    SIZE = SETTINGS_OFFSET + BLOB.size + SETTINGS_SIZE
+
+    # Name lists OBS shares: index of their generation and current name in STATUS, where they're kept
+    LISTS = {
+        SwitchType.profile: (8, 9, PROFILES_OFFSET, PROFILES_SIZE),
+        SwitchType.scene: (11, 12, SCENES_OFFSET, SCENES_SIZE),
+        SwitchType.scene_collection: (13, 14, COLLECTIONS_OFFSET, COLLECTIONS_SIZE)
+    }
+
+    def __init__(self, path, create=False):
+        self.path = path
+        if create:
+            # Only readable by us, the settings in it include the MQTT password
+            self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600), "w+b")
+            self.file.truncate(self.SIZE)
+        else:
+            self.file = open(path, "r+b")
+            if os.path.getsize(path) != self.SIZE:
+                self.file.close()
+                raise ValueError(f"{path} is not a bridge segment of this version")
+        self.map = mmap.mmap(self.file.fileno(), self.SIZE)
+        self.sequence = 0
+        self.written = 0
+        self.status = (False, False, False, False, 0.0, 0, 0, 0, 0, -1, 0, 0, -1, 0, -1)
+        self.outputs = {}
+        self.names = {kind: [] for kind in self.LISTS}
+        self.generations = dict.fromkeys(self.LISTS, 0)
+        self.settings = {}
+        self.settings_generation = 0
+        if create:
+            self.session = int.from_bytes(os.urandom(8), "little") or 1
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, self.session, 0, 0)
+        else:
+            magic, version, self.session, _, _ = self.HEADER.unpack_from(self.map, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                self.close()
+                raise ValueError(f"{path} is not a bridge segment of this version")
+
+    # OBS side
+    def begin(self):
+        self.sequence += 1
+        struct.pack_into("<Q", self.map, 16, self.sequence)
+
+    def end(self):
+        self.sequence += 1
+        struct.pack_into("<QQ", self.map, 16, self.sequence, time.time_ns())
+
+    def write_status(self, recording, streaming, virtual_camera, paused, fps, frame_time_ns, frames, lagged_frames, outputs):
+        """
+        outputs maps each of OUTPUTS to (active, reconnecting, bytes, frames, dropped, congestion, connect time, reconnects)
+        """
+        self.begin()
+        self.status = (recording, streaming, virtual_camera, paused, fps, frame_time_ns, frames, lagged_frames) + self.status[8:]
+        self.STATUS.pack_into(self.map, self.STATUS_OFFSET, *self.status)
+        for i, name in enumerate(self.OUTPUTS):
+            self.OUTPUT.pack_into(self.map, self.OUTPUTS_OFFSET + i * self.OUTPUT.size, *outputs[name])
+        self.end()
+
+    def write_blob(self, offset, size, data):
+        if len(data) > size:
+            raise ValueError(f"{len(data)} bytes do not fit the {size} reserved")
+        self.BLOB.pack_into(self.map, offset, len(data))
+        self.map[offset + self.BLOB.size:offset + self.BLOB.size + len(data)] = data
+
+    def write_names(self, kind, names, current_name):
+        """
+        Shares one of the LISTS (profiles, scenes, scene collections) and which of them is current.
+        The list is only rewritten (and its generation bumped) when it changed.
+        """
+        names = list(names)
+        generation_index, current_index, offset, size = self.LISTS[kind]
+        self.begin()
+        if names != self.names[kind] or not self.generations[kind]:
+            self.names[kind] = names
+            self.generations[kind] += 1
+            self.write_blob(offset, size, "\n".join(names).encode("utf-8"))
+        status = list(self.status)
+        status[generation_index] = self.generations[kind]
+        status[current_index] = names.index(current_name) if current_name in names else -1
+        self.status = tuple(status)
+        self.STATUS.pack_into(self.map, self.STATUS_OFFSET, *self.status)
+        self.end()
+
+    def write_settings(self, settings):
+        self.settings = dict(settings)
+        self.settings_generation += 1
+        status = list(self.status)
+        status[self.SETTINGS_GENERATION] = self.settings_generation
+        self.status = tuple(status)
+        self.begin()
+        self.write_blob(self.SETTINGS_OFFSET, self.SETTINGS_SIZE, json.dumps(self.settings).encode("utf-8"))
+        self.STATUS.pack_into(self.map, self.STATUS_OFFSET, *self.status)
+        self.end()
+
+    def read_commands(self):
+        """
+        Returns the commands queued since the last call as (kind, payload, profile, scene or collection name or None)
+        """
+        head, tail = self.RING.unpack_from(self.map, self.RING_OFFSET)
+        commands = []
+        for index in range(max(tail, head - self.COMMAND_SLOTS), head):
+            kind, payload, generation, position = self.COMMAND.unpack_from(
+                self.map, self.COMMANDS_OFFSET + (index % self.COMMAND_SLOTS) * self.COMMAND.size)
+            switch_type = self.KINDS[kind - 1]
+            name = None
+            if switch_type in self.LISTS:
+                names = self.names[switch_type]
+                if generation != self.generations[switch_type] or not 0 <= position < len(names):
+                    continue # Sent against a list that has changed since
+                name = names[position]
+            commands.append((switch_type, SwitchPayload.ON if payload else SwitchPayload.OFF, name))
+        struct.pack_into("<I", self.map, self.RING_OFFSET + 4, head)
+        return commands
+
+    def close(self, closed=False):
+        """
+        closed tells the bridge the segment's owner is gone, so it doesn't wait to find out
+        """
+        if closed:
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, 0, self.sequence + 2, 0)
+        self.map.close()
+        self.file.close()
+
+    # Bridge side
+    def read(self):
+        """
+        Copies a consistent status from the segment. Returns the session, or None once
+        the writer has closed it. The name lists and settings are only decoded when changed.
+        """
+        for attempt in range(100):
+            _, _, session, sequence, written = self.HEADER.unpack_from(self.map, 0)
+            if sequence & 1:
+                time.sleep(0.001) # A write is in progress
+                continue
+            status = self.STATUS.unpack_from(self.map, self.STATUS_OFFSET)
+            outputs = {name: self.OUTPUT.unpack_from(self.map, self.OUTPUTS_OFFSET + i * self.OUTPUT.size)
+                       for i, name in enumerate(self.OUTPUTS)}
+            names = dict(self.names)
+            for kind, (generation_index, _, offset, _) in self.LISTS.items():
+                if status[generation_index] != self.generations[kind]:
+                    length, = self.BLOB.unpack_from(self.map, offset)
+                    data = bytes(self.map[offset + self.BLOB.size:offset + self.BLOB.size + length])
+                    names[kind] = data.decode("utf-8").split("\n") if data else []
+            settings = self.settings
+            if status[self.SETTINGS_GENERATION] != self.settings_generation:
+                length, = self.BLOB.unpack_from(self.map, self.SETTINGS_OFFSET)
+                settings = json.loads(bytes(self.map[self.SETTINGS_OFFSET + self.BLOB.size:self.SETTINGS_OFFSET + self.BLOB.size + length]) or b"{}")
+            if self.HEADER.unpack_from(self.map, 0)[3] == sequence:
+                break
+        else:
+            return session or None # The writer died mid-write, written stops advancing
+        self.written = written
+        self.status = status
+        self.outputs = outputs
+        self.names = names
+        self.generations = {kind: status[fields[0]] for kind, fields in self.LISTS.items()}
+        self.settings = settings
+        self.settings_generation = status[self.SETTINGS_GENERATION]
+        return session or None
+
+    def current(self, kind):
+        """
+        The current name of one of the LISTS, as last read
+        """
+        names = self.names[kind]
+        position = self.status[self.LISTS[kind][1]]
+        return names[position] if 0 <= position < len(names) else None
+
+    def push_command(self, switch_type, payload, name=None):
+        """
+        Queues a command for OBS, the oldest unread one is overwritten once the ring is full.
+        Profiles, scenes and scene collections are sent as their position in the list last read.
+        """
+        names = self.names.get(switch_type, ())
+        position = names.index(name) if name in names else -1
+        head, _ = self.RING.unpack_from(self.map, self.RING_OFFSET)
+        self.COMMAND.pack_into(self.map, self.COMMANDS_OFFSET + (head % self.COMMAND_SLOTS) * self.COMMAND.size,
+                               self.KINDS.index(switch_type) + 1, payload == SwitchPayload.ON,
+                               self.generations.get(switch_type, 0), position)
+        struct.pack_into("<I", self.map, self.RING_OFFSET, head + 1)
+
 class Sensor:
+    platform = "sensor"
+
     def __init__(self, mqtt_base_channel, mqtt_sensor_name):
         self.mqtt_base_channel = mqtt_base_channel
         self.mqtt_sensor_name = mqtt_sensor_name
         self.state_topic = f"{self.mqtt_base_channel}/sensor/{self.mqtt_sensor_name}/state"
         self.config_topic = f"{self.mqtt_base_channel}/sensor/{self.mqtt_sensor_name}/config"
         self.attributes_topic = f"{self.mqtt_base_channel}/sensor/{self.mqtt_sensor_name}/attributes"
+        self.history_topic = f"{self.mqtt_base_channel}/sensor/{self.mqtt_sensor_name}/history"
+        self.history_request_topic = f"{self.history_topic}/get"
+        self.history_result_topic = f"{self.history_topic}/result"
         self.config = {
             "name": self.mqtt_sensor_name,
             "unique_id": self.mqtt_sensor_name,
-            "device": {
-                "name": f"{self.mqtt_sensor_name}",
-                "identifiers": f"[['mac',{MAC}]]",
-                "manufacturer": f"OBS Script v.{__version__}",
-                "sw_version": __version__
-            },
+            "device": device_config(self.mqtt_sensor_name),
             "state_topic": self.state_topic,
-            "json_attributes_topic": self.attributes_topic
+            "json_attributes_topic": self.attributes_topic,
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name)
         }
         self.state = self.get_state
         self.previous_state = SensorState.Off
-        self.recording = obs.obs_frontend_recording_active
-        self.streaming = obs.obs_frontend_streaming_active
-        self.virtual_camera = obs.obs_frontend_virtualcam_active
-        self.paused = obs.obs_frontend_recording_paused
-        self.replay_buffer =obs.obs_frontend_replay_buffer_active
-        self.fps = obs.obs_get_active_fps
-        self.frame_time_ns = obs.obs_get_average_frame_time_ns
-        self.frames = obs.obs_get_total_frames
-        self.lagged_frames = obs.obs_get_lagged_frames
+        self.snapshot = None # Last snapshot taken, read by the command path
         self.active = False
-        self.publish_config()
-        self.publish_state()
-        self.publish_attributes()
+        self.main_thread_ns = 0 # Time spent on the OBS UI thread by the last update_status tick
+        TOPIC_ALIASES.prefer(self.state_topic, self.attributes_topic)
 
     def publish_config(self):
-        CLIENT.publish(self.config_topic, json.dumps(self.config))
+        if DEVICE_DISCOVERY:
+            return
+        publish_tracked(self.config_topic, json.dumps(self.config))
         if DEBUG: print(f"Published config {self.config['name']}")
 
-    def publish_attributes(self):
-        stats = {
-            "recording": self.recording(),
-            "streaming": self.streaming(),
-            "virtual_camera": self.virtual_camera(),
-            "paused": self.paused(),
-            "fps": self.fps(),
-            "frame_time_ns": self.frame_time_ns(),
-            "frames": self.frames(),
-            "lagged_frames": self.lagged_frames()
-        }
-        CLIENT.publish(self.attributes_topic, json.dumps(stats))
-        self.publish_state()
+    def take_snapshot(self, frame_window=None):
+        """
+        Reads every OBS getter exactly once. Cheap enough to run on the OBS UI thread
+        """
+        recording = obs.obs_frontend_recording_active()
+        streaming = obs.obs_frontend_streaming_active()
+        virtual_camera = obs.obs_frontend_virtualcam_active()
+        self.snapshot = SensorSnapshot(
+            recording,
+            streaming,
+            virtual_camera,
+            obs.obs_frontend_recording_paused(),
+            obs.obs_get_active_fps(),
+            obs.obs_get_average_frame_time_ns(),
+            obs.obs_get_total_frames(),
+            obs.obs_get_lagged_frames(),
+            frame_window,
+            dict(OUTPUT_RECONNECTS),
+            sample_outputs({
+                SwitchType.stream: streaming,
+                SwitchType.record: recording,
+                SwitchType.virtual_camera: virtual_camera
+            }),
+            AUDIO.collect() if AUDIO is not None else None
+        )
+        return self.snapshot
+
+    def publish_attributes(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.take_snapshot()
+        connected = CLIENT.is_connected()
+        offline = OFFLINE is not None and not connected
+        if WRITER is not None and (offline or HISTORY is not None):
+            WRITER.submit(snapshot, offline)
+        if not connected:
+            return # Buffered snapshots are sent to history_topic once we're connected
+        stats = snapshot.attributes() # Only OBS stats, so unchanged ones are suppressed until the heartbeat
+        PUBLISHER.publish(self.attributes_topic, json.dumps(stats), expiry=stats_expiry())
+        self.publish_state(snapshot)
         if DEBUG:
             print(f"{self.config['name']} attributes updated")
             print(json.dumps(stats))
 
-    def get_state(self):
-        recording = self.recording()
-        streaming = self.streaming()
-        virtual_camera = self.virtual_camera()
-        if recording and streaming:
-            self.active = True
-            self.previous_state = SensorState.Recording_and_Streaming
-            return SensorState.Recording_and_Streaming
-        elif streaming:
-            self.active = True
-            self.previous_state = SensorState.Streaming
-            return SensorState.Streaming
-        elif recording:
-            self.active = True
-            self.previous_state = SensorState.Recording
-            return SensorState.Recording
-        elif virtual_camera:
-            self.active = True
-            self.previous_state = SensorState.VirtualCamera
-            return SensorState.VirtualCamera
-        else:
-            self.active = False
-            self.previous_state = SensorState.Stopped
-            return SensorState.Stopped
+    def get_state(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.take_snapshot()
+        self.active = snapshot.active
+        self.previous_state = snapshot.state
+        return snapshot.state
 
-    def publish_state(self):
-        state = self.state()
-        CLIENT.publish(self.state_topic, state)
+    def publish_state(self, snapshot=None):
+        state = self.state(snapshot)
+        PUBLISHER.publish(self.state_topic, state)
         if DEBUG: print(f"{self.config['name']} state changed to {state}")
 
-    def publish_off_state(self):
+    def publish_off_state(self, qos=0):
         self.previous_state = SensorState.Off
-        CLIENT.publish(self.state_topic, SensorState.Off)
+        info = PUBLISHER.publish(self.state_topic, SensorState.Off, force=True, qos=qos)
         if DEBUG: print(f"{self.config['name']} state changed to {SensorState.Off}")
+        return info
+
+class DiagnosticsSensor:
+    """
+    Reports what the script itself costs, published at DIAGNOSTICS_INTERVAL
+    """
+    platform = "sensor"
+
+    def __init__(self, mqtt_base_channel, mqtt_sensor_name):
+        self.mqtt_base_channel = mqtt_base_channel
+        self.mqtt_sensor_name = mqtt_sensor_name
+        self.state_topic = f"{self.mqtt_base_channel}/sensor/{self.mqtt_sensor_name}_diagnostics/state"
+        self.config_topic = f"{self.mqtt_base_channel}/sensor/{self.mqtt_sensor_name}_diagnostics/config"
+        self.attributes_topic = f"{self.mqtt_base_channel}/sensor/{self.mqtt_sensor_name}_diagnostics/attributes"
+        self.config = {
+            "name": f"{self.mqtt_sensor_name} Diagnostics",
+            "unique_id": f"{self.mqtt_sensor_name}_diagnostics",
+            "device": device_config(self.mqtt_sensor_name),
+            "state_topic": self.state_topic,
+            "json_attributes_topic": self.attributes_topic,
+            "unit_of_measurement": "µs",
+            "entity_category": "diagnostic",
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
+            "icon": "mdi:speedometer"
+        }
+        self.publish_config()
+
+    def publish_config(self):
+        if DEVICE_DISCOVERY:
+            return
+        publish_tracked(self.config_topic, json.dumps(self.config))
+        if DEBUG: print(f"Published config {self.config['name']}")
+
+    def publish(self):
+        """
+        State is the p95 of update_status, everything else goes in the attributes
+        """
+        stats = {
+            "timings": {name: histogram.summary() for name, histogram in TIMINGS.items() if histogram.count},
+            "publish_ack": ACK_TIMINGS.summary(),
+            "outgoing_queue": len(QUEUED) + len(ACK_PENDING),
+            "awaiting_ack": len(ACK_PENDING),
+            "connects": CONNECTS,
+            "disconnects": DISCONNECTS,
+            "reconnect": BACKOFF.stats(),
+            "published_messages": PUBLISHER.published,
+            "suppressed_messages": PUBLISHER.suppressed
+        }
+        if SENSOR is not None:
+            stats["main_thread_us"] = SENSOR.main_thread_ns // 1000
+        if CONTROL:
+            stats["commands"] = COMMANDS.stats()
+        if OFFLINE is not None:
+            stats["offline_buffered"] = len(OFFLINE)
+            stats["offline_evicted"] = OFFLINE.evicted
+        if WRITER is not None and WRITER.dropped:
+            stats["disk_dropped"] = WRITER.dropped
+        if TLS_CONTEXT is not None:
+            stats["tls"] = TLS_CONTEXT.stats()
+        if MQTT_V5:
+            stats["topic_alias_saved_bytes"] = TOPIC_ALIASES.saved_bytes
+        if THUMBNAILS is not None:
+            stats["thumbnail"] = THUMBNAILS.stats()
+        properties = publish_properties(None, 2 * DIAGNOSTICS_INTERVAL) if MQTT_V5 else None
+        publish_tracked(self.attributes_topic, json.dumps(stats), properties=properties)
+        publish_tracked(self.state_topic, TIMINGS["update_status"].percentile(0.95), properties=properties)
+        if DEBUG: print(f"{self.config['name']} published")
+
+class Camera:
+    """
+    Shows the latest program thumbnail, the image is published as raw PNG bytes
+    """
+    platform = "camera"
+
+    def __init__(self, mqtt_base_channel, mqtt_sensor_name):
+        self.mqtt_base_channel = mqtt_base_channel
+        self.mqtt_sensor_name = mqtt_sensor_name
+        self.topic = f"{self.mqtt_base_channel}/camera/{self.mqtt_sensor_name}/thumbnail"
+        self.config_topic = f"{self.mqtt_base_channel}/camera/{self.mqtt_sensor_name}_thumbnail/config"
+        self.config = {
+            "name": f"{self.mqtt_sensor_name} Program",
+            "unique_id": f"{self.mqtt_sensor_name}_thumbnail",
+            "device": device_config(self.mqtt_sensor_name),
+            "topic": self.topic,
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
+            "icon": "mdi:monitor-screenshot"
+        }
+        self.publish_config()
+        if THUMBNAILS is not None:
+            THUMBNAILS.signature = None # Publish the next frame to the (possibly new) topic
+
+    def publish_config(self):
+        if DEVICE_DISCOVERY:
+            return
+        publish_tracked(self.config_topic, json.dumps(self.config), retain=True)
+        if DEBUG: print(f"Published config {self.config['name']}")
+
+    def publish_image(self, image):
+        publish_tracked(self.topic, image, retain=True)
+        if DEBUG: print(f"{self.config['name']} published {len(image)} bytes")
+
+class AudioEvent:
+    """
+    Fires in Home Assistant as soon as a metered audio source goes silent, comes back or clips
+    """
+    platform = "event"
+
+    def __init__(self, mqtt_base_channel, mqtt_sensor_name):
+        self.mqtt_base_channel = mqtt_base_channel
+        self.mqtt_sensor_name = mqtt_sensor_name
+        self.state_topic = f"{self.mqtt_base_channel}/event/{self.mqtt_sensor_name}/audio/state"
+        self.config_topic = f"{self.mqtt_base_channel}/event/{self.mqtt_sensor_name}_audio/config"
+        self.config = {
+            "name": f"{self.mqtt_sensor_name} Audio",
+            "unique_id": f"{self.mqtt_sensor_name}_audio",
+            "device": device_config(self.mqtt_sensor_name),
+            "state_topic": self.state_topic,
+            "event_types": ["silence", "sound", "clipping"],
+            "availability": availability_config(self.mqtt_base_channel, self.mqtt_sensor_name),
+            "icon": "mdi:microphone-message"
+        }
+        self.publish_config()
+
+    def publish_config(self):
+        if DEVICE_DISCOVERY:
+            return
+        publish_tracked(self.config_topic, json.dumps(self.config), retain=True)
+        if DEBUG: print(f"Published config {self.config['name']}")
+
+    def publish(self, event_type, source):
+        publish_tracked(self.state_topic, json.dumps({"event_type": event_type, "source": source}), qos=1)
+        if DEBUG: print(f"{self.config['name']} event {event_type} for {source}")
+
+class PublishWorker(threading.Thread):
+    """
+    Does the serialization and MQTT I/O for snapshots taken on the OBS thread.
+    The handoff is a single slot deque, appending and popping are atomic so
+    neither side ever takes a lock and a slow broker can only drop stale snapshots.
+    """
+    def __init__(self):
+        super().__init__(name="obs-mqtt-publisher", daemon=True)
+        self.pending = collections.deque(maxlen=1)
+        self.wakeup = threading.Event()
+        self.running = True
+
+    def submit(self, snapshot):
+        self.pending.append(snapshot)
+        self.wakeup.set()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        self.join(timeout=1)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                snapshot = self.pending.popleft()
+            except IndexError:
+                continue
+            try:
+                publish_status(snapshot)
+            except Exception as e:
+                print(f"Publishing worker failed: {e}")
+
+class DiskWriter(threading.Thread):
+    """
+    Writes snapshots to the session history and the offline buffer, so the OBS
+    thread never waits on the disk. Snapshots wait in a bounded deque, appending
+    and popping are atomic and a stalled disk can only drop the oldest ones.
+    """
+    def __init__(self, size):
+        super().__init__(name="obs-mqtt-disk", daemon=True)
+        self.pending = collections.deque(maxlen=size)
+        self.wakeup = threading.Event()
+        self.running = True
+        self.dropped = 0
+
+    def submit(self, snapshot, offline):
+        """
+        offline: the snapshot wasn't published, it goes to the offline buffer too
+        """
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append((snapshot, offline))
+        self.wakeup.set()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        self.join(timeout=1)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.write()
+        self.write() # What was submitted before stop()
+
+    def write(self):
+        while True:
+            try:
+                snapshot, offline = self.pending.popleft()
+            except IndexError:
+                return
+            history, buffer = HISTORY, OFFLINE
+            try:
+                if history is not None:
+                    history.record(snapshot)
+                if offline and buffer is not None:
+                    buffer.append(snapshot) # Sent to history_topic once we're connected again
+            except (OSError, ValueError) as e: # ValueError: closed by a settings change meanwhile
+                print(f"Writing snapshot to disk failed: {e}")
+
+class ProgramCapture:
+    """
+    Renders the program output into a texture of the thumbnail's size and
+    copies it back from the GPU. stage() queues the copy and read() maps it a
+    few frames later, by then the GPU is done so the OBS thread never waits on
+    it. obspython can't map a staging surface, so libobs is called through ctypes.
+    """
+    GS_RGBA = 3
+    GS_ZS_NONE = 0
+    GS_CLEAR_COLOR = 1
+
+    class Vec4(ctypes.Structure):
+        _fields_ = [("x", ctypes.c_float), ("y", ctypes.c_float), ("z", ctypes.c_float), ("w", ctypes.c_float)]
+
+    def __init__(self, width):
+        self.lib = load_libobs()
+        self.width = max(2, width - width % 2)
+        self.height = 0
+        self.texrender = None
+        self.surface = None
+        self.staged = False
+        self.black = self.Vec4(0.0, 0.0, 0.0, 1.0)
+
+    def resize(self, height):
+        """
+        (Re)creates the render target and staging surfaces, inside the graphics context
+        """
+        lib = self.lib
+        self.destroy()
+        self.height = height
+        self.texrender = lib.gs_texrender_create(self.GS_RGBA, self.GS_ZS_NONE)
+        self.surface = lib.gs_stagesurface_create(self.width, height, self.GS_RGBA)
+        self.staged = False
+
+    def destroy(self):
+        lib = self.lib
+        if self.surface:
+            lib.gs_stagesurface_destroy(self.surface)
+        if self.texrender:
+            lib.gs_texrender_destroy(self.texrender)
+        self.surface = None
+        self.texrender = None
+        self.staged = False
+
+    def stage(self):
+        """
+        Renders the current frame and queues its copy back from the GPU, True if one was queued
+        """
+        video = obs.obs_video_info()
+        if not obs.obs_get_video_info(video) or not video.base_width:
+            return False
+        height = max(2, round(self.width * video.base_height / video.base_width))
+        height -= height % 2
+        lib = self.lib
+        lib.obs_enter_graphics()
+        try:
+            if height != self.height:
+                self.resize(height)
+            lib.gs_texrender_reset(self.texrender)
+            if lib.gs_texrender_begin(self.texrender, self.width, self.height):
+                lib.gs_clear(self.GS_CLEAR_COLOR, ctypes.byref(self.black), 0.0, 0)
+                lib.gs_ortho(0.0, float(video.base_width), 0.0, float(video.base_height), -100.0, 100.0)
+                lib.gs_blend_state_push()
+                lib.gs_reset_blend_state()
+                lib.obs_render_main_texture()
+                lib.gs_blend_state_pop()
+                lib.gs_texrender_end(self.texrender)
+                lib.gs_stage_texture(self.surface, lib.gs_texrender_get_texture(self.texrender))
+                self.staged = True
+        finally:
+            lib.obs_leave_graphics()
+        return self.staged
+
+    def read(self):
+        """
+        The frame queued by stage() as (width, height, RGBA bytes), or None
+        """
+        if not self.staged:
+            return None
+        self.lib.obs_enter_graphics()
+        try:
+            self.staged = False
+            return self.map(self.surface)
+        finally:
+            self.lib.obs_leave_graphics()
+
+    def map(self, surface):
+        data = ctypes.c_void_p()
+        linesize = ctypes.c_uint32()
+        if not self.lib.gs_stagesurface_map(surface, ctypes.byref(data), ctypes.byref(linesize)):
+            return None
+        try:
+            row = self.width * 4
+            if linesize.value == row:
+                pixels = ctypes.string_at(data.value, row * self.height)
+            else:
+                pixels = b"".join(ctypes.string_at(data.value + y * linesize.value, row) for y in range(self.height))
+        finally:
+            self.lib.gs_stagesurface_unmap(surface)
+        return self.width, self.height, pixels
+
+    def close(self):
+        self.lib.obs_enter_graphics()
+        try:
+            self.destroy()
+        finally:
+            self.lib.obs_leave_graphics()
+
+class AudioMeters:
+    """
+    Peak, RMS and clip counts of a few audio sources, fed by OBS volmeters.
+    The volmeter callbacks run on OBS's audio thread dozens of times a second,
+    so they only fold their levels into preallocated accumulators. There are two
+    sets of them and collect() swaps which one the callbacks write to before
+    reading the other, neither side takes a lock. A set is only cleared when it
+    becomes active again, a whole window after it was read, so a callback that
+    read the old index just before the swap never writes into a cleared set or a
+    later window. If it finishes after the set was read, its levels are dropped.
+    """
+    FIELDS = 4 # peak (dBFS), sum of linear power, callbacks, clipping callbacks
+    MAX_AUDIO_CHANNELS = 8
+    OBS_FADER_LOG = 2
+    CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.POINTER(ctypes.c_float),
+                                ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_float))
+
+    def __init__(self, names, silence_db, silence_seconds, clip_db):
+        self.names = list(names)
+        self.silence_db = silence_db
+        self.silence_seconds = silence_seconds
+        self.clip_db = clip_db
+        count = len(self.names)
+        self.accumulators = array.array("d", [-math.inf, 0.0, 0.0, 0.0] * (2 * count))
+        self.active = 0 # Which set the callbacks write to
+        self.channels = array.array("i", [2] * count)
+        self.clips = array.array("Q", [0] * count) # Never reset, check_events compares them
+        self.heard = array.array("d", [time.monotonic()] * count) # Last time each peaked above silence_db
+        self.silent = [False] * count
+        self.reported_clips = [0] * count
+        self.clip_reported = [0.0] * count
+        self.lib = None
+        self.meters = []
+        self.callback_pointer = self.CALLBACK(self.callback) # Kept alive as long as OBS may call it
+
+    def attach(self):
+        """
+        Creates a volmeter for every source found, sources that don't exist are reported and skipped
+        """
+        self.lib = load_libobs()
+        for index, name in enumerate(self.names):
+            source = self.lib.obs_get_source_by_name(name.encode("utf-8"))
+            if not source:
+                print(f"Audio source {name} not found")
+                continue
+            meter = self.lib.obs_volmeter_create(self.OBS_FADER_LOG)
+            try:
+                attached = self.lib.obs_volmeter_attach_source(meter, source)
+            finally:
+                self.lib.obs_source_release(source)
+            if not attached:
+                print(f"Audio source {name} has no audio")
+                self.lib.obs_volmeter_destroy(meter)
+                continue
+            self.channels[index] = self.lib.obs_volmeter_get_nr_channels(meter) or 2
+            self.lib.obs_volmeter_add_callback(meter, self.callback_pointer, index)
+            self.meters.append((index, meter))
+            if DEBUG: print(f"Metering audio source {name}")
+
+    def detach(self):
+        for index, meter in self.meters:
+            self.lib.obs_volmeter_remove_callback(meter, self.callback_pointer, index)
+            self.lib.obs_volmeter_detach_source(meter)
+            self.lib.obs_volmeter_destroy(meter)
+        self.meters = []
+
+    def callback(self, param, magnitude, peak, input_peak):
+        """
+        Audio thread, keep it short
+        """
+        index = param or 0
+        loudest = loudness = -math.inf
+        for channel in range(self.channels[index]): # Indexed, slicing the pointers would allocate lists
+            if peak[channel] > loudest:
+                loudest = peak[channel]
+            if magnitude[channel] > loudness:
+                loudness = magnitude[channel]
+        base = (self.active * len(self.names) + index) * self.FIELDS
+        accumulators = self.accumulators
+        if loudest > accumulators[base]:
+            accumulators[base] = loudest
+        accumulators[base + 1] += 10 ** (loudness / 10)
+        accumulators[base + 2] += 1
+        if loudest >= self.clip_db:
+            accumulators[base + 3] += 1
+            self.clips[index] += 1
+        if loudest > self.silence_db:
+            self.heard[index] = time.monotonic()
+
+    def collect(self):
+        """
+        Levels since the previous call, per source
+        """
+        retired = self.active
+        accumulators = self.accumulators
+        count = len(self.names)
+        stale = retired ^ 1 # Read by the previous call, nothing has written to it since
+        for index in range(count):
+            base = (stale * count + index) * self.FIELDS
+            accumulators[base] = -math.inf
+            accumulators[base + 1] = accumulators[base + 2] = accumulators[base + 3] = 0.0
+        self.active = stale
+        levels = {}
+        for index, name in enumerate(self.names):
+            base = (retired * count + index) * self.FIELDS
+            peak, power, callbacks, clipping = accumulators[base:base + self.FIELDS]
+            levels[name] = {
+                "peak_db": round(peak, 1) if callbacks and peak > -math.inf else None,
+                "rms_db": round(10 * math.log10(power / callbacks), 1) if callbacks and power > 0 else None,
+                "clips": int(clipping),
+                "silent": self.silent[index]
+            }
+        return levels
+
+    def check_events(self, now=None):
+        """
+        Returns (event type, source) for every source that started clipping, went silent or came back
+        """
+        now = time.monotonic() if now is None else now
+        events = []
+        for index, name in enumerate(self.names):
+            clips = self.clips[index]
+            if clips != self.reported_clips[index] and now - self.clip_reported[index] >= AUDIO_CLIP_COOLDOWN:
+                self.reported_clips[index] = clips
+                self.clip_reported[index] = now
+                events.append(("clipping", name))
+            silent = now - self.heard[index] >= self.silence_seconds
+            if silent != self.silent[index]:
+                self.silent[index] = silent
+                events.append(("silence" if silent else "sound", name))
+        return events
+
+class ThumbnailWorker(threading.Thread):
+    """
+    Compares, encodes and publishes the frames ProgramCapture reads back. Like
+    PublishWorker the handoff is a single slot deque, a slow encode only drops
+    frames. Frames whose signature barely changed are skipped before encoding.
+    """
+    def __init__(self, max_bytes, threshold):
+        super().__init__(name="obs-mqtt-thumbnails", daemon=True)
+        self.max_bytes = max_bytes
+        self.threshold = threshold
+        self.pending = collections.deque(maxlen=1)
+        self.wakeup = threading.Event()
+        self.running = True
+        self.signature = None
+        self.published = 0
+        self.unchanged = 0
+        self.over_budget = 0
+        self.last_bytes = 0
+        self.encode_ms_last = 0.0
+
+    def submit(self, frame):
+        self.pending.append(frame)
+        self.wakeup.set()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        self.join(timeout=1)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                frame = self.pending.popleft()
+            except IndexError:
+                continue
+            try:
+                self.process(*frame)
+            except Exception as e:
+                print(f"Thumbnail worker failed: {e}")
+
+    def process(self, width, height, rgba):
+        signature = frame_signature(rgba, width, height)
+        if self.signature is not None and signature_difference(signature, self.signature) < self.threshold:
+            self.unchanged += 1
+            return
+        start = time.perf_counter()
+        image = encode_thumbnail(rgba, width, height, self.max_bytes)
+        self.encode_ms_last = (time.perf_counter() - start) * 1000
+        if image is None:
+            self.over_budget += 1
+            if DEBUG: print(f"Thumbnail dropped, it doesn't fit in {self.max_bytes} bytes")
+            return
+        camera = CAMERA
+        if camera is None:
+            return
+        self.signature = signature
+        self.published += 1
+        self.last_bytes = len(image)
+        camera.publish_image(image)
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "unchanged": self.unchanged,
+            "over_budget": self.over_budget,
+            "last_bytes": self.last_bytes,
+            "encode_ms_last": round(self.encode_ms_last, 2)
+        }
+
+class CommandQueue:
+    """
+    Hands MQTT commands from paho's network thread to the OBS thread.
+    Per drain only the last command for each switch is kept (all profile switches
+    count as one since only one profile can be active) and commands the current
+    state already satisfies are skipped.
+    """
+    def __init__(self, size):
+        self.commands = collections.deque(maxlen=size)
+        self.dropped = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.executed = 0
+        self.latency_ms_last = 0.0
+        self.latency_ms_max = 0.0
+        self.latency_ms_total = 0.0
+
+    def put(self, switch, payload):
+        if len(self.commands) == self.commands.maxlen:
+            self.dropped += 1
+        self.commands.append((switch, payload, time.monotonic()))
+
+    def drain(self):
+        if not self.commands:
+            return
+        latest = {}
+        while True:
+            try:
+                command = self.commands.popleft()
+            except IndexError:
+                break
+            switch = command[0]
+            key = SwitchType.profile if switch.switch_type == SwitchType.profile else switch
+            if key in latest:
+                self.coalesced += 1
+                del latest[key] # Re-insert so commands still execute in arrival order
+            latest[key] = command
+        now = time.monotonic()
+        for switch, payload, queued in latest.values():
+            latency_ms = (now - queued) * 1000
+            self.latency_ms_last = latency_ms
+            self.latency_ms_max = max(self.latency_ms_max, latency_ms)
+            self.latency_ms_total += latency_ms
+            if command_satisfied(switch, payload):
+                self.skipped += 1
+                if DEBUG: print(f"Skipping {payload} for {switch.config['name']}, already satisfied")
+                continue
+            self.executed += 1
+            execute_action(switch, payload)
+
+    def stats(self):
+        handled = self.skipped + self.executed
+        return {
+            "executed": self.executed,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "latency_ms_last": round(self.latency_ms_last, 2),
+            "latency_ms_max": round(self.latency_ms_max, 2),
+            "latency_ms_mean": round(self.latency_ms_total / handled, 2) if handled else 0.0
+        }
 
 # MQTT Event Functions
-def on_mqtt_connect(client, userdata, flags, rc):
+def on_mqtt_connect(client, userdata, flags, rc, properties=None):
     """
     Called when the MQTT client is connected from the server.  Just prints a
     message indicating we connected successfully.
     """
+    global CONNECTS
+    global DISCOVERY_PENDING
     print("MQTT connection successful")
+    CONNECTS += 1
+    if rc == 0:
+        BACKOFF.connected(client)
+        if TLS_CONTEXT is not None:
+            TLS_CONTEXT.connected(client.socket())
+    PUBLISHER.reset()
+    TOPIC_ALIASES.reset(getattr(properties, "TopicAliasMaximum", 0) if MQTT_V5 else 0)
+    with ACK_LOCK:
+        ACK_PENDING.clear()
+        QUEUED.clear() # paho drops the QoS 0 packets that were queued on the old connection
+        EARLY_ACKS.clear()
 
-    set_homeassistant_config()
+    publish_availability(Availability.online)
+    # Discovery takes the first snapshot and asks OBS for profiles and scenes,
+    # none of which may happen on this thread
+    DISCOVERY_PENDING = True
 
-def on_mqtt_disconnect(client, userdata, rc):
+def on_mqtt_disconnect(client, userdata, rc, properties=None):
     """
     Called when the MQTT client gets disconnected.  Just logs a message about it
     (we'll auto-reconnect inside of update_status()).
     """
+    global DISCONNECTS
+    DISCONNECTS += 1
+    TOPIC_ALIASES.reset(0) # Aliases die with the connection, none are used until the next CONNACK
+    if rc != 0: # Not asked for, paho reconnects after the delay set here
+        delay = BACKOFF.disconnected(client)
+        if DEBUG: print(f"Reconnecting in {delay:.1f}s")
     print("MQTT disconnected.  Reason: {}".format(str(rc)))
 
+def on_mqtt_connect_fail(client, userdata):
+    """
+    Called when a reconnect attempt didn't reach the broker, the next one waits longer
+    """
+    delay = BACKOFF.attempt_failed(client)
+    if DEBUG: print(f"MQTT connection failed, retrying in {delay:.1f}s")
+
+def on_mqtt_publish(client, userdata, mid):
+    """
+    Called when a publish has been handed to the network (QoS 0) or acknowledged (QoS > 0)
+    """
+    now = time.perf_counter_ns()
+    with ACK_LOCK:
+        sent = ACK_PENDING.pop(mid, None)
+        if sent is not None:
+            ACK_TIMINGS.record(now - sent)
+        elif mid in QUEUED:
+            QUEUED.discard(mid)
+        else:
+            # CLIENT.publish hasn't returned to publish_tracked yet, it picks this up.
+            # Publishes it didn't track (backlog full) leave theirs behind, drop those.
+            if len(EARLY_ACKS) >= 64:
+                for late in [late for late, seen in EARLY_ACKS.items() if now - seen > 1000000000]:
+                    del EARLY_ACKS[late]
+            EARLY_ACKS[mid] = now
+
+@timed
 def on_mqtt_message(client, userdata, message):
     """
     Handles MQTT messages that have been subscribed to
     """
-    payload = str(message.payload.decode("utf-8"))
-    if DEBUG: print(f"{message.topic}: {payload}")
+    if HISTORY is not None and SENSOR is not None and message.topic == SENSOR.history_request_topic:
+        start_history_query(message)
+        return
     entity = message_to_switch_entity(message)
     if entity != None:
-        execute_action(entity, payload)
+        payload = str(message.payload.decode("utf-8"))
+        if DEBUG: print(f"{message.topic}: {payload}")
+        COMMANDS.put(entity, payload) # Executed on the OBS thread by drain_commands
 
 # OBS Script Function Exports
 def script_description():
@@ -370,11 +2207,25 @@ def script_unload():
     global STATE
     print("Script unloading")
     STATE = "Off"
+    stop_worker()
+    stop_writer() # Before the files it writes to are closed
+    stop_thumbnails()
+    stop_audio()
+    unhook_outputs()
+    if BRIDGE is not None:
+        stop_bridge()
+    if OFFLINE is not None:
+        OFFLINE.close()
+    if HISTORY is not None:
+        HISTORY.close()
     if CLIENT.is_connected():
-        SENSOR.publish_off_state()
-        set_persistent_switch_availability()
-        remove_profiles_from_homeassistant()
-        time.sleep(0.5)
+        # QoS 1, so the acknowledgements tell us when the broker has them
+        final = [publish_availability(Availability.offline)]
+        if SENSOR is not None:
+            final.append(SENSOR.publish_off_state(qos=1))
+        final += remove_profiles_from_homeassistant(qos=1)
+        final.append(publish_device_discovery(qos=1))
+        flush([info for info in final if info is not None], SHUTDOWN_FLUSH_TIMEOUT)
         CLIENT.disconnect()
     CLIENT.loop_stop()
 
@@ -388,8 +2239,41 @@ def script_defaults(settings):
     obs.obs_data_set_default_string(settings, "mqtt_base_channel", MQTT_BASE_CHANNEL)
     obs.obs_data_set_default_string(settings, "mqtt_sensor_name", MQTT_SENSOR_NAME)
     obs.obs_data_set_default_int(settings, "mqtt_port", MQTT_PORT)
+    obs.obs_data_set_default_bool(settings, "mqtt_v5", MQTT_V5)
+    obs.obs_data_set_default_bool(settings, "mqtt_tls", MQTT_TLS)
+    obs.obs_data_set_default_string(settings, "mqtt_ca_file", MQTT_CA_FILE)
+    obs.obs_data_set_default_string(settings, "mqtt_cert_file", MQTT_CERT_FILE)
+    obs.obs_data_set_default_string(settings, "mqtt_key_file", MQTT_KEY_FILE)
+    obs.obs_data_set_default_bool(settings, "mqtt_tls_insecure", MQTT_TLS_INSECURE)
+    obs.obs_data_set_default_int(settings, "reconnect_min_delay", RECONNECT_MIN_DELAY)
+    obs.obs_data_set_default_int(settings, "reconnect_max_delay", RECONNECT_MAX_DELAY)
     obs.obs_data_set_default_int(settings, "interval", INTERVAL)
+    obs.obs_data_set_default_int(settings, "heartbeat", HEARTBEAT)
+    obs.obs_data_set_default_int(settings, "diagnostics_interval", DIAGNOSTICS_INTERVAL)
+    obs.obs_data_set_default_bool(settings, "adaptive", ADAPTIVE)
+    obs.obs_data_set_default_double(settings, "adaptive_min_interval", ADAPTIVE_MIN_INTERVAL)
+    obs.obs_data_set_default_double(settings, "adaptive_max_interval", ADAPTIVE_MAX_INTERVAL)
+    obs.obs_data_set_default_int(settings, "lagged_frames_threshold", LAGGED_FRAMES_THRESHOLD)
+    obs.obs_data_set_default_double(settings, "frame_time_threshold", FRAME_TIME_THRESHOLD)
+    obs.obs_data_set_default_int(settings, "dropped_frames_threshold", DROPPED_FRAMES_THRESHOLD)
+    obs.obs_data_set_default_int(settings, "sample_interval", SAMPLE_INTERVAL)
     obs.obs_data_set_default_bool(settings, "controllable", CONTROL)
+    obs.obs_data_set_default_bool(settings, "worker_mode", WORKER_MODE)
+    obs.obs_data_set_default_bool(settings, "event_driven", EVENT_DRIVEN)
+    obs.obs_data_set_default_bool(settings, "device_discovery", DEVICE_DISCOVERY)
+    obs.obs_data_set_default_bool(settings, "offline_buffer", OFFLINE_BUFFER)
+    obs.obs_data_set_default_string(settings, "data_dir", DATA_DIR)
+    obs.obs_data_set_default_bool(settings, "thumbnail", THUMBNAIL)
+    obs.obs_data_set_default_int(settings, "thumbnail_interval", THUMBNAIL_INTERVAL)
+    obs.obs_data_set_default_int(settings, "thumbnail_width", THUMBNAIL_WIDTH)
+    obs.obs_data_set_default_int(settings, "thumbnail_max_bytes", THUMBNAIL_MAX_BYTES)
+    obs.obs_data_set_default_double(settings, "thumbnail_threshold", THUMBNAIL_THRESHOLD)
+    obs.obs_data_set_default_string(settings, "audio_sources", AUDIO_SOURCES)
+    obs.obs_data_set_default_double(settings, "audio_silence_threshold", AUDIO_SILENCE_THRESHOLD)
+    obs.obs_data_set_default_int(settings, "audio_silence_seconds", AUDIO_SILENCE_SECONDS)
+    obs.obs_data_set_default_double(settings, "audio_clip_threshold", AUDIO_CLIP_THRESHOLD)
+    obs.obs_data_set_default_bool(settings, "history", KEEP_HISTORY)
+    obs.obs_data_set_default_bool(settings, "bridge_mode", BRIDGE_MODE)
 
 def script_properties():
     """
@@ -402,65 +2286,285 @@ def script_properties():
     obs.obs_properties_add_text(props, "mqtt_base_channel", "MQTT Base channel",obs.OBS_TEXT_DEFAULT)
     obs.obs_properties_add_text(props, "mqtt_sensor_name", "MQTT Sensor Name",obs.OBS_TEXT_DEFAULT)
     obs.obs_properties_add_int(props, "mqtt_port", "MQTT TCP/IP port", MQTT_PORT, 65535, 1)
+    obs.obs_properties_add_bool(props, "mqtt_v5", "Use MQTT v5")
+    obs.obs_properties_add_bool(props, "mqtt_tls", "Use TLS")
+    obs.obs_properties_add_path(props, "mqtt_ca_file", "CA certificates (empty = system)", obs.OBS_PATH_FILE, "Certificates (*.pem *.crt)", None)
+    obs.obs_properties_add_path(props, "mqtt_cert_file", "Client certificate", obs.OBS_PATH_FILE, "Certificates (*.pem *.crt)", None)
+    obs.obs_properties_add_path(props, "mqtt_key_file", "Client key", obs.OBS_PATH_FILE, "Keys (*.pem *.key)", None)
+    obs.obs_properties_add_bool(props, "mqtt_tls_insecure", "Don't verify the server certificate")
+    obs.obs_properties_add_int(props, "reconnect_min_delay", "First reconnect delay (seconds)", 1, 60, 1)
+    obs.obs_properties_add_int(props, "reconnect_max_delay", "Longest reconnect delay (seconds)", 1, 3600, 1)
     obs.obs_properties_add_int(props, "interval", "Update Interval (seconds)", 1, 3600, 1)
+    obs.obs_properties_add_int(props, "sample_interval", "Frame stats sample interval (milliseconds, 0 = off)", 0, 1000, 10)
+    obs.obs_properties_add_bool(props, "adaptive", "Adapt the update interval to stream health")
+    obs.obs_properties_add_float(props, "adaptive_min_interval", "Fastest update interval (seconds)", 0.25, 3600, 0.25)
+    obs.obs_properties_add_float(props, "adaptive_max_interval", "Slowest update interval (seconds)", 1, 3600, 1)
+    obs.obs_properties_add_int(props, "lagged_frames_threshold", "Lagged frames per update that speed it up", 1, 10000, 1)
+    obs.obs_properties_add_float(props, "frame_time_threshold", "Frame time that speeds updates up (ms)", 1, 1000, 0.5)
+    obs.obs_properties_add_int(props, "dropped_frames_threshold", "Dropped frames per update that speed it up", 1, 10000, 1)
+    obs.obs_properties_add_int(props, "diagnostics_interval", "Diagnostics interval (seconds, 0 = off)", 0, 3600, 1)
+    obs.obs_properties_add_int(props, "heartbeat", "Republish unchanged values every (seconds, 0 = always)", 0, 3600, 1)
     obs.obs_properties_add_bool(props, "controllable", "Control Streaming/Recording via MQTT")
+    obs.obs_properties_add_bool(props, "worker_mode", "Publish from a background thread")
+    obs.obs_properties_add_bool(props, "event_driven", "Only poll while an output is active")
+    obs.obs_properties_add_bool(props, "device_discovery", "Use a single device discovery message")
+    obs.obs_properties_add_bool(props, "offline_buffer", "Buffer updates on disk while disconnected")
+    obs.obs_properties_add_path(props, "data_dir", "Data directory (offline buffer, history)", obs.OBS_PATH_DIRECTORY, None, None)
+    obs.obs_properties_add_bool(props, "thumbnail", "Publish a thumbnail of the program output")
+    obs.obs_properties_add_int(props, "thumbnail_interval", "Thumbnail interval (seconds)", 1, 3600, 1)
+    obs.obs_properties_add_int(props, "thumbnail_width", "Thumbnail width (pixels)", 64, 1920, 16)
+    obs.obs_properties_add_int(props, "thumbnail_max_bytes", "Largest thumbnail (bytes)", 4096, 1048576, 1024)
+    obs.obs_properties_add_float(props, "thumbnail_threshold", "Change needed to republish the thumbnail (%)", 0, 100, 0.5)
+    obs.obs_properties_add_text(props, "audio_sources", "Audio sources to meter (comma separated)", obs.OBS_TEXT_DEFAULT)
+    obs.obs_properties_add_float(props, "audio_silence_threshold", "Silence below (dBFS)", -100, 0, 1)
+    obs.obs_properties_add_int(props, "audio_silence_seconds", "Report silence after (seconds)", 1, 3600, 1)
+    obs.obs_properties_add_float(props, "audio_clip_threshold", "Clipping from (dBFS)", -20, 0, 0.1)
+    obs.obs_properties_add_bool(props, "history", "Keep a history of each session (in the data directory)")
+    obs.obs_properties_add_bool(props, "bridge_mode", "Publish through mqtt_status_bridge.py")
     obs.obs_properties_add_bool(props, "debug", "Debug")
     return props
 
 def script_update(settings):
     """
-    Applies any changes made to the MQTT settings in the OBS Scripts GUI then
-    reconnects the MQTT client.
+    Called by OBS for every edit made in the OBS Scripts GUI. The first call
+    (when the script loads) is applied straight away, after that edits are
+    collected until SETTINGS_DEBOUNCE passes without another one.
+    """
+    global PENDING_SETTINGS
+    PENDING_SETTINGS = {
+        "mqtt_host": obs.obs_data_get_string(settings, "mqtt_host"),
+        "mqtt_port": obs.obs_data_get_int(settings, "mqtt_port"),
+        "mqtt_user": obs.obs_data_get_string(settings, "mqtt_user"),
+        "mqtt_pw": obs.obs_data_get_string(settings, "mqtt_pw"),
+        "mqtt_v5": obs.obs_data_get_bool(settings, "mqtt_v5"),
+        "mqtt_tls": obs.obs_data_get_bool(settings, "mqtt_tls"),
+        "mqtt_ca_file": obs.obs_data_get_string(settings, "mqtt_ca_file"),
+        "mqtt_cert_file": obs.obs_data_get_string(settings, "mqtt_cert_file"),
+        "mqtt_key_file": obs.obs_data_get_string(settings, "mqtt_key_file"),
+        "mqtt_tls_insecure": obs.obs_data_get_bool(settings, "mqtt_tls_insecure"),
+        "reconnect_min_delay": obs.obs_data_get_int(settings, "reconnect_min_delay"),
+        "reconnect_max_delay": obs.obs_data_get_int(settings, "reconnect_max_delay"),
+        "mqtt_base_channel": obs.obs_data_get_string(settings, "mqtt_base_channel"),
+        "mqtt_sensor_name": obs.obs_data_get_string(settings, "mqtt_sensor_name"),
+        "controllable": obs.obs_data_get_bool(settings, "controllable"),
+        "device_discovery": obs.obs_data_get_bool(settings, "device_discovery"),
+        "diagnostics_interval": obs.obs_data_get_int(settings, "diagnostics_interval"),
+        "interval": obs.obs_data_get_int(settings, "interval"),
+        "sample_interval": obs.obs_data_get_int(settings, "sample_interval"),
+        "event_driven": obs.obs_data_get_bool(settings, "event_driven"),
+        "adaptive": obs.obs_data_get_bool(settings, "adaptive"),
+        "adaptive_min_interval": obs.obs_data_get_double(settings, "adaptive_min_interval"),
+        "adaptive_max_interval": obs.obs_data_get_double(settings, "adaptive_max_interval"),
+        "lagged_frames_threshold": obs.obs_data_get_int(settings, "lagged_frames_threshold"),
+        "frame_time_threshold": obs.obs_data_get_double(settings, "frame_time_threshold"),
+        "dropped_frames_threshold": obs.obs_data_get_int(settings, "dropped_frames_threshold"),
+        "heartbeat": obs.obs_data_get_int(settings, "heartbeat"),
+        "worker_mode": obs.obs_data_get_bool(settings, "worker_mode"),
+        "offline_buffer": obs.obs_data_get_bool(settings, "offline_buffer"),
+        "data_dir": obs.obs_data_get_string(settings, "data_dir"),
+        "thumbnail": obs.obs_data_get_bool(settings, "thumbnail"),
+        "thumbnail_interval": obs.obs_data_get_int(settings, "thumbnail_interval"),
+        "thumbnail_width": obs.obs_data_get_int(settings, "thumbnail_width"),
+        "thumbnail_max_bytes": obs.obs_data_get_int(settings, "thumbnail_max_bytes"),
+        "thumbnail_threshold": obs.obs_data_get_double(settings, "thumbnail_threshold"),
+        "audio_sources": obs.obs_data_get_string(settings, "audio_sources"),
+        "audio_silence_threshold": obs.obs_data_get_double(settings, "audio_silence_threshold"),
+        "audio_silence_seconds": obs.obs_data_get_int(settings, "audio_silence_seconds"),
+        "audio_clip_threshold": obs.obs_data_get_double(settings, "audio_clip_threshold"),
+        "history": obs.obs_data_get_bool(settings, "history"),
+        "bridge_mode": obs.obs_data_get_bool(settings, "bridge_mode"),
+        "debug": obs.obs_data_get_bool(settings, "debug")
+    }
+    if not APPLIED_SETTINGS:
+        apply_settings()
+        return
+    obs.timer_remove(apply_settings)
+    obs.timer_add(apply_settings, SETTINGS_DEBOUNCE)
+
+def apply_settings():
+    """
+    Applies what changed since the last call. Only connection settings and topic
+    names reconnect the MQTT client (the last will follows the names), the other
+    discovery settings rerun discovery and everything else is applied in place.
     """
     # Apply the new settings
     global MQTT_HOST
     global MQTT_USER
     global MQTT_PW
     global MQTT_PORT
+    global MQTT_V5
+    global MQTT_TLS
+    global MQTT_CA_FILE
+    global MQTT_CERT_FILE
+    global MQTT_KEY_FILE
+    global MQTT_TLS_INSECURE
+    global TLS_CONTEXT
+    global RECONNECT_MIN_DELAY
+    global RECONNECT_MAX_DELAY
     global MQTT_BASE_CHANNEL
     global MQTT_SENSOR_NAME
     global INTERVAL
     global CONTROL
     global DEBUG
-    mqtt_host = obs.obs_data_get_string(settings, "mqtt_host")
-    if mqtt_host != MQTT_HOST:
-        MQTT_HOST = mqtt_host
-    mqtt_user = obs.obs_data_get_string(settings, "mqtt_user")
-    if mqtt_user != MQTT_USER:
-        MQTT_USER = mqtt_user
-    mqtt_pw = obs.obs_data_get_string(settings, "mqtt_pw")
-    if mqtt_pw != MQTT_PW:
-        MQTT_PW = mqtt_pw
-    mqtt_base_channel = obs.obs_data_get_string(settings, "mqtt_base_channel")
-    if mqtt_base_channel != MQTT_BASE_CHANNEL:
-        MQTT_BASE_CHANNEL = mqtt_base_channel
-    mqtt_sensor_name = obs.obs_data_get_string(settings, "mqtt_sensor_name")
-    if mqtt_sensor_name != MQTT_SENSOR_NAME:
-        MQTT_SENSOR_NAME = mqtt_sensor_name
-    mqtt_port = obs.obs_data_get_int(settings, "mqtt_port")
-    if mqtt_port != MQTT_PORT:
-        MQTT_PORT = mqtt_port
-    INTERVAL = obs.obs_data_get_int(settings, "interval")
-    CONTROL = obs.obs_data_get_bool(settings, "controllable")
-    DEBUG = obs.obs_data_get_bool(settings, "debug")
-
-    # Disconnect (if connected) and reconnect the MQTT client
-    CLIENT.disconnect()
-    try:
-        if MQTT_PW != "" and MQTT_USER != "":
-            CLIENT.username_pw_set(MQTT_USER, password=MQTT_PW)
-        CLIENT.connect_async(MQTT_HOST, MQTT_PORT, 60)
-    except (socket.gaierror, ConnectionRefusedError) as e:
-        print("NOTE: Got a socket issue: %s" % e)
-        pass # Ignore it for now
+    global WORKER_MODE
+    global HEARTBEAT
+    global SAMPLE_INTERVAL
+    global EVENT_DRIVEN
+    global DEVICE_DISCOVERY
+    global DATA_DIR
+    global OFFLINE_BUFFER
+    global DIAGNOSTICS_INTERVAL
+    global ADAPTIVE
+    global ADAPTIVE_MIN_INTERVAL
+    global ADAPTIVE_MAX_INTERVAL
+    global LAGGED_FRAMES_THRESHOLD
+    global FRAME_TIME_THRESHOLD
+    global DROPPED_FRAMES_THRESHOLD
+    global BRIDGE_MODE
+    global KEEP_HISTORY
+    global THUMBNAIL
+    global THUMBNAIL_INTERVAL
+    global THUMBNAIL_WIDTH
+    global THUMBNAIL_MAX_BYTES
+    global THUMBNAIL_THRESHOLD
+    global AUDIO_SOURCES
+    global AUDIO_SILENCE_THRESHOLD
+    global AUDIO_SILENCE_SECONDS
+    global AUDIO_CLIP_THRESHOLD
+    global CLIENT
+    obs.timer_remove(apply_settings)
+    first = not APPLIED_SETTINGS
+    changed = {name for name, value in PENDING_SETTINGS.items() if APPLIED_SETTINGS.get(name) != value}
+    if not changed:
+        return
+    if DEBUG: print(f"Settings changed: {', '.join(sorted(changed))}")
+    rediscover = not first and not changed.isdisjoint(DISCOVERY_SETTINGS)
+    if rediscover and CLIENT.is_connected():
+        remove_homeassistant_config() # Still under the old names
+        if not changed.isdisjoint(("mqtt_base_channel", "mqtt_sensor_name")):
+            publish_availability(Availability.offline) # Nothing is published under the old names anymore
+    APPLIED_SETTINGS.update(PENDING_SETTINGS)
+    settings = APPLIED_SETTINGS
+    MQTT_HOST = settings["mqtt_host"]
+    MQTT_PORT = settings["mqtt_port"]
+    MQTT_USER = settings["mqtt_user"]
+    MQTT_PW = settings["mqtt_pw"]
+    protocol_changed = MQTT_V5 != settings["mqtt_v5"]
+    MQTT_V5 = settings["mqtt_v5"]
+    MQTT_TLS = settings["mqtt_tls"]
+    MQTT_CA_FILE = settings["mqtt_ca_file"]
+    MQTT_CERT_FILE = settings["mqtt_cert_file"]
+    MQTT_KEY_FILE = settings["mqtt_key_file"]
+    MQTT_TLS_INSECURE = settings["mqtt_tls_insecure"]
+    RECONNECT_MIN_DELAY = settings["reconnect_min_delay"]
+    RECONNECT_MAX_DELAY = max(RECONNECT_MIN_DELAY, settings["reconnect_max_delay"])
+    BACKOFF.min_delay = RECONNECT_MIN_DELAY
+    BACKOFF.max_delay = RECONNECT_MAX_DELAY
+    MQTT_BASE_CHANNEL = settings["mqtt_base_channel"]
+    MQTT_SENSOR_NAME = settings["mqtt_sensor_name"]
+    CONTROL = settings["controllable"]
+    DEVICE_DISCOVERY = settings["device_discovery"]
+    DIAGNOSTICS_INTERVAL = settings["diagnostics_interval"]
+    INTERVAL = settings["interval"]
+    SAMPLE_INTERVAL = settings["sample_interval"]
+    EVENT_DRIVEN = settings["event_driven"]
+    ADAPTIVE = settings["adaptive"]
+    ADAPTIVE_MIN_INTERVAL = settings["adaptive_min_interval"]
+    ADAPTIVE_MAX_INTERVAL = max(ADAPTIVE_MIN_INTERVAL, settings["adaptive_max_interval"])
+    LAGGED_FRAMES_THRESHOLD = settings["lagged_frames_threshold"]
+    FRAME_TIME_THRESHOLD = settings["frame_time_threshold"]
+    DROPPED_FRAMES_THRESHOLD = settings["dropped_frames_threshold"]
+    HEARTBEAT = settings["heartbeat"]
+    PUBLISHER.heartbeat = HEARTBEAT
+    WORKER_MODE = settings["worker_mode"]
+    DATA_DIR = settings["data_dir"]
+    OFFLINE_BUFFER = settings["offline_buffer"]
+    DEBUG = settings["debug"]
+    KEEP_HISTORY = settings["history"]
+    THUMBNAIL = settings["thumbnail"]
+    THUMBNAIL_INTERVAL = settings["thumbnail_interval"]
+    THUMBNAIL_WIDTH = settings["thumbnail_width"]
+    THUMBNAIL_MAX_BYTES = settings["thumbnail_max_bytes"]
+    THUMBNAIL_THRESHOLD = settings["thumbnail_threshold"]
+    AUDIO_SOURCES = settings["audio_sources"]
+    AUDIO_SILENCE_THRESHOLD = settings["audio_silence_threshold"]
+    AUDIO_SILENCE_SECONDS = settings["audio_silence_seconds"]
+    AUDIO_CLIP_THRESHOLD = settings["audio_clip_threshold"]
+    BRIDGE_MODE = settings["bridge_mode"]
+    if BRIDGE_MODE:
+        start_bridge()
+        return
+    if "bridge_mode" in changed and not first:
+        stop_bridge()
+        first = True # Set up everything bridge mode tore down
+    open_offline_buffer()
+    open_history()
+    start_writer()
+    create_sensor()
+    if WORKER_MODE:
+        start_worker()
+    else:
+        stop_worker()
+    if first or not changed.isdisjoint(THUMBNAIL_SETTINGS):
+        start_thumbnails() # Before reconnecting, the camera is only announced while thumbnails are captured
+    if first or not changed.isdisjoint(AUDIO_SETTINGS):
+        start_audio()
 
+    renamed = not first and not changed.isdisjoint(("mqtt_base_channel", "mqtt_sensor_name"))
+    if first or renamed or not changed.isdisjoint(CONNECTION_SETTINGS):
+        # Disconnect (if connected) and reconnect the MQTT client, discovery runs in on_mqtt_connect.
+        # Renames reconnect too, the last will's topic can only be set when connecting.
+        CLIENT.disconnect()
+        recreate = protocol_changed or not changed.isdisjoint(TLS_SETTINGS)
+        if recreate:
+            # The protocol version and TLS settings are fixed when a paho client is created
+            CLIENT.loop_stop()
+            CLIENT = create_client()
+            TLS_CONTEXT = None
+            if not first:
+                CLIENT.loop_start()
+        set_last_will()
+        try:
+            if MQTT_TLS and TLS_CONTEXT is None:
+                TLS_CONTEXT = create_tls_context()
+                CLIENT.tls_set_context(TLS_CONTEXT)
+            if MQTT_PW != "" and MQTT_USER != "":
+                CLIENT.username_pw_set(MQTT_USER, password=MQTT_PW)
+            BACKOFF.schedule(CLIENT)
+            CLIENT.connect_async(MQTT_HOST, MQTT_PORT, 60)
+        except (socket.gaierror, ConnectionRefusedError) as e:
+            print("NOTE: Got a socket issue: %s" % e)
+            pass # Ignore it for now
+        except (OSError, ValueError) as e:
+            # Never fall back to a plain connection, it would send the credentials in the clear
+            print("NOTE: Couldn't set up TLS, not connecting: %s" % e)
+    elif rediscover and CLIENT.is_connected():
+        set_homeassistant_config()
 
-    obs.obs_frontend_remove_event_callback(frontend_changed)
-    obs.obs_frontend_add_event_callback(frontend_changed)
-    # Remove and replace the timer that publishes our status information
-    obs.timer_remove(update_status)
-    obs.timer_add(update_status, INTERVAL * 1000)
-    CLIENT.loop_start()
+    if first:
+        obs.obs_frontend_remove_event_callback(frontend_changed)
+        obs.obs_frontend_add_event_callback(frontend_changed)
+        hook_outputs()
+        obs.timer_remove(discover_pending)
+        obs.timer_add(discover_pending, COMMAND_DRAIN_INTERVAL)
+        obs.timer_remove(follow_outputs)
+        obs.timer_add(follow_outputs, COMMAND_DRAIN_INTERVAL)
+    if first or "diagnostics_interval" in changed:
+        obs.timer_remove(publish_diagnostics)
+        if DIAGNOSTICS_INTERVAL > 0:
+            obs.timer_add(publish_diagnostics, DIAGNOSTICS_INTERVAL * 1000)
+    if first or "controllable" in changed:
+        obs.timer_remove(drain_commands)
+        if CONTROL:
+            obs.timer_add(drain_commands, COMMAND_DRAIN_INTERVAL)
+    if first or not changed.isdisjoint(POLLING_SETTINGS):
+        # Remove and replace the timers that publish our status information
+        if not EVENT_DRIVEN or any_output_active():
+            start_polling()
+        else:
+            stop_polling()
+    if first:
+        CLIENT.loop_start()
 
 def frontend_changed(event):
     """
@@ -469,8 +2573,14 @@ def frontend_changed(event):
     switcher = {
         obs.OBS_FRONTEND_EVENT_PROFILE_CHANGED: profile_changed,
         obs.OBS_FRONTEND_EVENT_PROFILE_LIST_CHANGED: profile_list_changed,
+        obs.OBS_FRONTEND_EVENT_SCENE_CHANGED: scene_changed,
+        obs.OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED: scene_list_changed,
+        obs.OBS_FRONTEND_EVENT_SCENE_COLLECTION_CHANGED: scene_collection_changed,
+        obs.OBS_FRONTEND_EVENT_SCENE_COLLECTION_LIST_CHANGED: scene_collection_list_changed,
+        obs.OBS_FRONTEND_EVENT_RECORDING_STARTING: hook_outputs,
         obs.OBS_FRONTEND_EVENT_RECORDING_STARTED: recording_started,
         obs.OBS_FRONTEND_EVENT_RECORDING_STOPPED: recording_stopped,
+        obs.OBS_FRONTEND_EVENT_STREAMING_STARTING: hook_outputs,
         obs.OBS_FRONTEND_EVENT_STREAMING_STARTED: streaming_started,
         obs.OBS_FRONTEND_EVENT_STREAMING_STOPPED: streaming_stopped,
         obs.OBS_FRONTEND_EVENT_VIRTUALCAM_STARTED: virtual_camera_started,
@@ -478,7 +2588,12 @@ def frontend_changed(event):
     }
     function = switcher.get(event, None)
     if function != None:
+        start = time.perf_counter_ns()
         function()
+        histogram = TIMINGS.get(function.__name__)
+        if histogram is None: # Created on the first event only, not thrown away on every one
+            histogram = TIMINGS[function.__name__] = Histogram()
+        histogram.record(time.perf_counter_ns() - start)
     else:
         print(f"Unknown event fired: {event}")
 
@@ -487,9 +2602,8 @@ def profile_changed():
     Callback for OBS_FRONTEND_EVENT_PROFILE_CHANGED
     """
     global PROFILE
-    while LOCK:
-        time.sleep(0.5)
-    PROFILE.publish_state(SwitchPayload.OFF)
+    if PROFILE is not None:
+        PROFILE.publish_state(SwitchPayload.OFF)
     new_profile = obs.obs_frontend_get_current_profile()
     for profile in PROFILES:
         if profile.profile_name == new_profile:
@@ -501,65 +2615,179 @@ def profile_list_changed():
     """
     Callback for OBS_FRONTEND_EVENT_PROFILE_LIST_CHANGED
     """
-    global LOCK
-    LOCK = True
-    for profile in PROFILES:
-        profile.publish_remove_config()
-    time.sleep(0.1)
-    setup_profiles_in_homeassistant()
-    LOCK = False
+    if CONTROL:
+        sync_profiles()
+        publish_device_discovery()
     print("Profile List Changed")
 
+def scene_changed():
+    """
+    Callback for OBS_FRONTEND_EVENT_SCENE_CHANGED, only the current scene is asked for
+    """
+    if CONTROL and SCENE_SELECT is not None: # Created once connected
+        SCENE_SELECT.select(current_scene_name())
+    if DEBUG: print("Scene Changed")
+
+def scene_list_changed():
+    """
+    Callback for OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED
+    """
+    SCENES.invalidate()
+    if CONTROL and SCENE_SELECT is not None and SCENE_SELECT.update_options():
+        publish_device_discovery()
+    print("Scene List Changed")
+
+def scene_collection_changed():
+    """
+    Callback for OBS_FRONTEND_EVENT_SCENE_COLLECTION_CHANGED, every scene belongs to the old collection
+    (and so does every audio source)
+    """
+    SCENES.invalidate()
+    if AUDIO is not None:
+        start_audio()
+    if CONTROL and SCENE_SELECT is not None and SCENE_COLLECTION_SELECT is not None:
+        changed = SCENE_SELECT.update_options()
+        SCENE_SELECT.select(current_scene_name())
+        SCENE_COLLECTION_SELECT.select(obs.obs_frontend_get_current_scene_collection())
+        if changed:
+            publish_device_discovery()
+    print("Scene Collection Changed")
+
+def scene_collection_list_changed():
+    """
+    Callback for OBS_FRONTEND_EVENT_SCENE_COLLECTION_LIST_CHANGED
+    """
+    SCENE_COLLECTIONS.invalidate()
+    if CONTROL and SCENE_COLLECTION_SELECT is not None and SCENE_COLLECTION_SELECT.update_options():
+        publish_device_discovery()
+    print("Scene Collection List Changed")
+
 def recording_started():
     """
     Publishes state of sensor and record switch
     """
-    SENSOR.publish_state()
-    SENSOR.publish_attributes()
-    if CONTROL:
+    snapshot = SENSOR.take_snapshot()
+    SENSOR.publish_attributes(snapshot)
+    if CONTROL and RECORD_SWITCH is not None: # Created on the first connection
         RECORD_SWITCH.publish_state(SwitchPayload.ON)
+    update_polling(snapshot)
 
 def recording_stopped():
     """
     Publishes state of sensor and record switch
     """
-    SENSOR.publish_state()
-    if CONTROL:
+    snapshot = SENSOR.take_snapshot()
+    SENSOR.publish_state(snapshot)
+    if CONTROL and RECORD_SWITCH is not None:
         RECORD_SWITCH.publish_state(SwitchPayload.OFF)
+    update_polling(snapshot)
 
 def streaming_started():
     """
     Publishes state of sensor and stream switch
     """
-    SENSOR.publish_state()
-    SENSOR.publish_attributes()
-    if CONTROL:
+    snapshot = SENSOR.take_snapshot()
+    SENSOR.publish_attributes(snapshot)
+    if CONTROL and STREAM_SWITCH is not None:
         STREAM_SWITCH.publish_state(SwitchPayload.ON)
+    update_polling(snapshot)
 
 def streaming_stopped():
     """
     Publishes state of sensor and stream switch
     """
-    SENSOR.publish_state()
-    if CONTROL:
+    snapshot = SENSOR.take_snapshot()
+    SENSOR.publish_state(snapshot)
+    if CONTROL and STREAM_SWITCH is not None:
         STREAM_SWITCH.publish_state(SwitchPayload.OFF)
+    update_polling(snapshot)
 
 def virtual_camera_started():
     """
     Publishes state of sensor and virtual camera switch
     """
-    SENSOR.publish_state()
-    SENSOR.publish_attributes()
-    if CONTROL:
+    hook_outputs()
+    snapshot = SENSOR.take_snapshot()
+    SENSOR.publish_attributes(snapshot)
+    if CONTROL and VIRTUAL_CAMERA_SWITCH is not None:
         VIRTUAL_CAMERA_SWITCH.publish_state(SwitchPayload.ON)
+    update_polling(snapshot)
 
 def virtual_camera_stopped():
     """
     Publishes state of sensor and virtual camera switch
     """
-    SENSOR.publish_state()
-    if CONTROL:
+    snapshot = SENSOR.take_snapshot()
+    SENSOR.publish_state(snapshot)
+    if CONTROL and VIRTUAL_CAMERA_SWITCH is not None:
         VIRTUAL_CAMERA_SWITCH.publish_state(SwitchPayload.OFF)
+    update_polling(snapshot)
+
+# Output Signal Functions
+def hook_outputs():
+    """
+    Connects output_signal to the stream, record and virtual camera outputs.
+    OBS recreates outputs (e.g. when the stream service changes), so this is
+    called again whenever one is about to start. Connecting twice is harmless.
+    """
+    for name, get_output in OUTPUT_GETTERS.items():
+        output = get_output()
+        if output is None:
+            continue
+        handler = obs.obs_output_get_signal_handler(output)
+        for signal in OUTPUT_SIGNALS:
+            callback = OUTPUT_CALLBACKS.get((name, signal))
+            if callback is None:
+                callback = output_signal_callback(name, signal)
+                OUTPUT_CALLBACKS[(name, signal)] = callback
+            obs.signal_handler_disconnect(handler, signal, callback)
+            obs.signal_handler_connect(handler, signal, callback)
+        obs.obs_output_release(output)
+
+def unhook_outputs():
+    """
+    Disconnects everything hook_outputs connected
+    """
+    for name, get_output in OUTPUT_GETTERS.items():
+        output = get_output()
+        if output is None:
+            continue
+        handler = obs.obs_output_get_signal_handler(output)
+        for signal in OUTPUT_SIGNALS:
+            callback = OUTPUT_CALLBACKS.get((name, signal))
+            if callback is not None:
+                obs.signal_handler_disconnect(handler, signal, callback)
+        obs.obs_output_release(output)
+
+def output_signal_callback(name, signal):
+    """
+    Signal handlers only get the calldata, so bind the output and signal names
+    """
+    def callback(calldata):
+        output_signal(name, signal)
+    return callback
+
+def output_signal(name, signal):
+    """
+    Called on the output's own thread, so it only records what happened.
+    follow_outputs starts or stops the polling on the OBS thread.
+    """
+    global OUTPUTS_CHANGED
+    if signal == "reconnect":
+        OUTPUT_RECONNECTS[name] += 1
+    else:
+        OUTPUTS_CHANGED = True
+
+def follow_outputs():
+    """
+    Starts or stops polling on the OBS thread once an output signalled it started, stopped or reconnected
+    """
+    global OUTPUTS_CHANGED
+    if not OUTPUTS_CHANGED:
+        return
+    OUTPUTS_CHANGED = False
+    if EVENT_DRIVEN and SENSOR is not None:
+        update_polling(SENSOR.take_snapshot())
 
 # Event Helper Functions
 def set_homeassistant_config():
@@ -567,11 +2795,36 @@ def set_homeassistant_config():
     Sends initial configuration state and attributes topic
     for autodiscovery in Home Assistant
     """
-    global SENSOR
-    SENSOR = Sensor(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
+    global DIAGNOSTICS
+    global CAMERA
+    global AUDIO_EVENTS
+    create_sensor()
+    SENSOR.publish_config()
+    SENSOR.publish_attributes()
+    if DIAGNOSTICS_INTERVAL > 0:
+        DIAGNOSTICS = DiagnosticsSensor(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
+    if THUMBNAILS is not None:
+        CAMERA = Camera(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
+    if AUDIO is not None:
+        AUDIO_EVENTS = AudioEvent(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
 
     if CONTROL:
+        ROUTES.clear()
         setup_homeassistant_control()
+    if CONTROL or HISTORY is not None:
+        subscribe_commands()
+    publish_device_discovery()
+
+def create_sensor():
+    """
+    (Re)creates SENSOR for the current names without announcing it. It exists
+    before the first connection, so snapshots taken while the broker has never
+    been reached still go to the offline buffer and the history.
+    """
+    global SENSOR
+    if (SENSOR is None or SENSOR.mqtt_base_channel != MQTT_BASE_CHANNEL
+            or SENSOR.mqtt_sensor_name != MQTT_SENSOR_NAME):
+        SENSOR = Sensor(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
 
 def setup_homeassistant_control():
     """
@@ -580,50 +2833,381 @@ def setup_homeassistant_control():
     global STREAM_SWITCH
     global VIRTUAL_CAMERA_SWITCH
     global RECORD_SWITCH
+    global SCENE_SELECT
+    global SCENE_COLLECTION_SELECT
     setup_profiles_in_homeassistant()
     # Set up switches for autodiscovery
     STREAM_SWITCH = StreamSwitch(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
     VIRTUAL_CAMERA_SWITCH = VirtualCameraSwitch(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
     RECORD_SWITCH = RecordSwitch(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
+    SCENE_SELECT = SceneSelect(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
+    SCENE_SELECT.select(current_scene_name())
+    SCENE_COLLECTION_SELECT = SceneCollectionSelect(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)
+    SCENE_COLLECTION_SELECT.select(obs.obs_frontend_get_current_scene_collection())
+
+def control_entities():
+    """
+    Every entity setup_homeassistant_control publishes
+    """
+    return [STREAM_SWITCH, VIRTUAL_CAMERA_SWITCH, RECORD_SWITCH, SCENE_SELECT, SCENE_COLLECTION_SELECT] + PROFILES
+
+def current_scene_name():
+    """
+    Name of the scene on program, without listing every scene
+    """
+    scene = obs.obs_frontend_get_current_scene()
+    if scene is None:
+        return None
+    try:
+        return obs.obs_source_get_name(scene)
+    finally:
+        obs.obs_source_release(scene)
+
+def set_current_scene(name):
+    """
+    Looks the scene up by name (a hash lookup in OBS) instead of walking the scene list
+    """
+    if name not in SCENES:
+        print(f"Unknown scene {name}")
+        return
+    scene = obs.obs_get_source_by_name(name)
+    if scene is None:
+        return
+    try:
+        obs.obs_frontend_set_current_scene(scene)
+    finally:
+        obs.obs_source_release(scene)
 
 def setup_profiles_in_homeassistant():
     """
     Publishes config, and subscribes to the command topic for each profile.
     Also sets the current profile's state
     """
+    global PROFILES
+    PROFILES = []
+    sync_profiles()
+
+def sync_profiles():
+    """
+    Brings PROFILES in line with the profiles in OBS. Only added profiles are
+    published and subscribed and only deleted ones are removed, so a rename
+    costs two switches worth of MQTT traffic however many profiles there are.
+    """
     global PROFILE
     global PROFILES
     current_profile = obs.obs_frontend_get_current_profile()
     profiles = obs.obs_frontend_get_profiles()
-    PROFILES = []
+    existing = {profile.profile_name: profile for profile in PROFILES}
+    for name in existing.keys() - set(profiles):
+        existing[name].remove_route()
+        existing[name].publish_remove_config()
+        if DEBUG: print(f"Profile {name} removed from PROFILES")
+    synced = []
     for profile in profiles:
-        profile_switch = ProfileSwitch(
-            profile_name=profile,
-            mqtt_base_channel=MQTT_BASE_CHANNEL,
-            mqtt_sensor_name=MQTT_SENSOR_NAME
-        )
-        PROFILES.append(profile_switch)
-        if DEBUG: print(f"Profile {profile_switch.profile_name} added to PROFILES")
+        profile_switch = existing.get(profile)
+        if profile_switch is None:
+            profile_switch = ProfileSwitch(
+                profile_name=profile,
+                mqtt_base_channel=MQTT_BASE_CHANNEL,
+                mqtt_sensor_name=MQTT_SENSOR_NAME
+            )
+            if DEBUG: print(f"Profile {profile_switch.profile_name} added to PROFILES")
+        synced.append(profile_switch)
         if profile_switch.profile_name == current_profile:
             PROFILE = profile_switch
             profile_switch.publish_state(SwitchPayload.ON)
+    PROFILES = synced # Swapped in one go, the MQTT thread may be iterating the old list
+
+def publish_device_discovery(qos=0):
+    """
+    Publishes every entity as a component of one retained device discovery payload.
+    Reconnects republish the same payload, so it is skipped when its hash is unchanged.
+    """
+    global DISCOVERY_HASH
+    if not DEVICE_DISCOVERY or SENSOR is None or not CLIENT.is_connected():
+        return None # The hash would claim a payload the broker never got
+    entities = [SENSOR]
+    if DIAGNOSTICS is not None:
+        entities.append(DIAGNOSTICS)
+    if CAMERA is not None:
+        entities.append(CAMERA)
+    if AUDIO_EVENTS is not None:
+        entities.append(AUDIO_EVENTS)
+    if CONTROL:
+        entities += control_entities()
+    components = {}
+    for unique_id in REMOVED_COMPONENTS:
+        components[unique_id] = {"p": "switch"} # A platform without config removes the component
+    for entity in entities:
+        component = {key: value for key, value in entity.config.items() if key != "device"}
+        component["p"] = entity.platform
+        components[entity.config["unique_id"]] = component
+    payload = json.dumps({
+        "dev": device_config(MQTT_SENSOR_NAME),
+        "o": {"name": "update_mqtt_status_homeassistant", "sw": __version__},
+        "cmps": components
+    }, sort_keys=True)
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    if digest == DISCOVERY_HASH:
+        if DEBUG: print("Device discovery unchanged, not republishing")
+        return None
+    info = publish_tracked(f"{MQTT_BASE_CHANNEL}/device/{MQTT_SENSOR_NAME}/config", payload, qos=qos, retain=True)
+    DISCOVERY_HASH = digest
+    REMOVED_COMPONENTS.clear()
+    if DEBUG: print(f"Published device discovery with {len(entities)} components")
+    return info
+
+def open_offline_buffer():
+    """
+    (Re)opens the offline buffer for the current sensor name and data directory
+    """
+    global OFFLINE
+    path = os.path.join(DATA_DIR or tempfile.gettempdir(), f"{MQTT_SENSOR_NAME}_offline.bin")
+    if OFFLINE is not None:
+        if OFFLINE_BUFFER and OFFLINE.path == path:
+            return
+        OFFLINE.close()
+        OFFLINE = None
+    if not OFFLINE_BUFFER:
+        return
+    try:
+        OFFLINE = OfflineBuffer(path, OFFLINE_BUFFER_RECORDS)
+    except OSError as e:
+        print(f"Offline buffer disabled, could not open {path}: {e}")
+        OFFLINE = None
+
+def open_history():
+    """
+    (Re)opens the session history for the current sensor name and data directory
+    """
+    global HISTORY
+    directory = os.path.join(DATA_DIR or tempfile.gettempdir(), "history")
+    if HISTORY is not None:
+        if KEEP_HISTORY and HISTORY.directory == directory and HISTORY.prefix == MQTT_SENSOR_NAME:
+            return
+        HISTORY.close()
+        HISTORY = None
+    if not KEEP_HISTORY:
+        return
+    try:
+        HISTORY = History(directory, MQTT_SENSOR_NAME, HISTORY_FILE_RECORDS, HISTORY_MAX_FILES)
+    except OSError as e:
+        print(f"History disabled, could not use {directory}: {e}")
+
+def start_history_query(message):
+    """
+    Answers on a thread of its own, so reading history files never holds up paho's network loop
+    """
+    if not HISTORY_QUERIES.acquire(blocking=False):
+        publish_history_result(message, {"error": "busy"})
+        return
+    threading.Thread(target=answer_history_query, args=(message,), name="obs-mqtt-history", daemon=True).start()
+
+def answer_history_query(message):
+    """
+    {"minutes": N} returns the records of the last N minutes (at most "max_points"
+    of them), anything else the summary of the current or last session. An "id"
+    in the request is copied into the result.
+    """
+    request = {}
+    try:
+        try:
+            payload = json.loads(message.payload or b"{}")
+            if isinstance(payload, dict):
+                request = payload
+            if "minutes" in request:
+                max_points = min(int(request.get("max_points", HISTORY_MAX_POINTS)), 10 * HISTORY_MAX_POINTS)
+                result = HISTORY.last(float(request["minutes"]) * 60, max(1, max_points))
+            else:
+                result = HISTORY.summary()
+        except (ValueError, TypeError, OSError) as e:
+            result = {"error": str(e)}
+        if "id" in request:
+            result["id"] = request["id"]
+        publish_history_result(message, result)
+    finally:
+        HISTORY_QUERIES.release()
+
+def publish_history_result(message, result):
+    """
+    Publishes to the result topic, or with MQTT v5 to the request's response topic with its correlation data
+    """
+    topic = SENSOR.history_result_topic
+    properties = None
+    request_properties = getattr(message, "properties", None) if MQTT_V5 else None
+    if request_properties is not None:
+        topic = getattr(request_properties, "ResponseTopic", None) or topic
+        correlation = getattr(request_properties, "CorrelationData", None)
+        if correlation is not None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.CorrelationData = correlation
+    publish_tracked(topic, json.dumps(result), qos=1, properties=properties)
+    if DEBUG: print(f"Answered history query on {topic}")
+
+def start_backfill():
+    """
+    Starts sending the snapshots buffered while disconnected, unless that's already happening
+    """
+    if OFFLINE is None or len(OFFLINE) == 0 or OFFLINE.backfilling:
+        return
+    OFFLINE.backfilling = True
+    threading.Thread(target=backfill, args=(OFFLINE,), name="obs-mqtt-backfill", daemon=True).start()
+
+def backfill(offline):
+    """
+    Publishes buffered snapshots oldest first in throttled batches, stops early on disconnect
+    """
+    try:
+        while len(offline) and CLIENT.is_connected():
+            snapshots = offline.peek(BACKFILL_BATCH)
+            history = [dict(snapshot.attributes(), timestamp=snapshot.timestamp) for snapshot in snapshots]
+            publish_tracked(SENSOR.history_topic, json.dumps(history), qos=1)
+            offline.consume(len(snapshots))
+            if DEBUG: print(f"Backfilled {len(snapshots)} snapshots, {len(offline)} left")
+            time.sleep(BACKFILL_INTERVAL)
+    finally:
+        offline.backfilling = False
 
-def set_persistent_switch_availability():
+def command_filters():
     """
-    Reports the availability of the persistent switches
+    One wildcard filter covers the command topic of every entity under
+    the base channel, ROUTES decides which messages are ours
     """
-    RECORD_SWITCH.publish_availability(SwitchPayload.OFF)
-    STREAM_SWITCH.publish_availability(SwitchPayload.OFF)
+    filters = []
+    if CONTROL:
+        filters.append(f"{MQTT_BASE_CHANNEL}/+/+/+/set")
+    if HISTORY is not None:
+        filters.append(f"{MQTT_BASE_CHANNEL}/sensor/{MQTT_SENSOR_NAME}/history/get")
+    return filters
+
+def subscribe_commands():
+    """
+    Subscribes to every command filter in a single SUBSCRIBE packet. With MQTT v5
+    the broker doesn't echo our own publishes on them back to us (no local).
+    """
+    filters = command_filters()
+    if MQTT_V5:
+        CLIENT.subscribe([(topic_filter, SubscribeOptions(qos=0, noLocal=True)) for topic_filter in filters])
+    else:
+        CLIENT.subscribe([(topic_filter, 0) for topic_filter in filters])
+    if DEBUG: print(f"Subscribed to {', '.join(filters)}")
+
+def set_last_will():
+    """
+    Registers the offline availability as the last will, the broker publishes it
+    if the connection is lost without a clean disconnect. Only read when connecting.
+    """
+    topic = availability_config(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)["topic"]
+    CLIENT.will_set(topic, Availability.offline, qos=1, retain=True)
+
+def publish_availability(payload):
+    """
+    Publishes the (retained) availability shared by every entity
+    """
+    topic = availability_config(MQTT_BASE_CHANNEL, MQTT_SENSOR_NAME)["topic"]
+    info = publish_tracked(topic, payload, qos=1, retain=True)
+    if DEBUG: print(f"Availability set to {payload}")
+    return info
+
+def remove_homeassistant_config():
+    """
+    Removes every entity published under the current topic names and stops
+    routing their commands, before the names change
+    """
+    global DIAGNOSTICS
+    global CAMERA
+    global AUDIO_EVENTS
+    global DISCOVERY_HASH
+    global PROFILES
+    if CONTROL or HISTORY is not None:
+        CLIENT.unsubscribe(command_filters())
+        ROUTES.clear()
+    if DEVICE_DISCOVERY:
+        publish_tracked(f"{MQTT_BASE_CHANNEL}/device/{MQTT_SENSOR_NAME}/config", "", retain=True)
+        REMOVED_COMPONENTS.clear()
+        DISCOVERY_HASH = None
+    else:
+        entities = [SENSOR, DIAGNOSTICS, CAMERA, AUDIO_EVENTS]
+        if CONTROL:
+            entities += control_entities()
+        for entity in entities:
+            if entity is not None:
+                publish_tracked(entity.config_topic, "", retain=True)
+    DIAGNOSTICS = None
+    CAMERA = None
+    AUDIO_EVENTS = None
+    PROFILES = []
+    if DEBUG: print(f"Removed Home Assistant config under {MQTT_BASE_CHANNEL}/{MQTT_SENSOR_NAME}")
 
-def remove_profiles_from_homeassistant():
+def remove_profiles_from_homeassistant(qos=0):
     """
     Profiles are removed when obs is not open
     """
     global PROFILES
-    for profile in PROFILES:
-        profile.publish_remove_config()
+    infos = [profile.publish_remove_config(qos) for profile in PROFILES]
     PROFILES = []
+    return [info for info in infos if info is not None]
+
+def flush(infos, timeout):
+    """
+    Waits until every message has been acknowledged, or until timeout (in seconds)
+    has passed. Returns as soon as the last acknowledgement arrives.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    flushed = 0
+    for info in infos:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0 and not info.is_published():
+                info.wait_for_publish(remaining)
+        except (RuntimeError, ValueError):
+            pass # paho never queued it, the connection was already gone
+        if info.is_published():
+            flushed += 1
+    dropped = len(infos) - flushed
+    print(f"Flushed {flushed} final messages, dropped {dropped} ({(time.monotonic() - start) * 1000:.0f}ms)")
+    return flushed, dropped
+
+def discover_pending():
+    """
+    Runs Home Assistant discovery on the OBS thread once on_mqtt_connect flagged a new connection
+    """
+    global DISCOVERY_PENDING
+    if not DISCOVERY_PENDING:
+        return
+    DISCOVERY_PENDING = False
+    if not CLIENT.is_connected():
+        return # Flagged again by the next connection
+    set_homeassistant_config()
+    start_backfill()
+
+def drain_commands():
+    """
+    Executes the commands received since the last call, on the OBS thread
+    """
+    COMMANDS.drain()
+
+def command_satisfied(switch, payload):
+    """
+    Checks the command against the last snapshot instead of asking OBS again
+    """
+    if switch.switch_type == SwitchType.profile:
+        # Turning a profile off has no meaning, a profile is left by turning another one on
+        return payload != SwitchPayload.ON or (PROFILE is not None and PROFILE.profile_name == switch.profile_name)
+    if switch.platform == "select":
+        return payload == switch.current
+    snapshot = SENSOR.snapshot if SENSOR is not None else None
+    if snapshot is None:
+        return False
+    active = {
+        SwitchType.stream: snapshot.streaming,
+        SwitchType.record: snapshot.recording,
+        SwitchType.virtual_camera: snapshot.virtual_camera
+    }[switch.switch_type]
+    return active == (payload == SwitchPayload.ON)
 
+@timed
 def execute_action(switch, payload):
     """
     Executes frontend actions (Profile change, recording, streaming)
@@ -651,50 +3235,641 @@ def execute_action(switch, payload):
             obs.obs_frontend_recording_start()
         else:
             obs.obs_frontend_recording_stop()
+    elif switch.switch_type == SwitchType.scene:
+        set_current_scene(payload)
+    elif switch.switch_type == SwitchType.scene_collection:
+        if payload in SCENE_COLLECTIONS:
+            obs.obs_frontend_set_current_scene_collection(payload)
+        else:
+            print(f"Unknown scene collection {payload}")
 
 # Helper Functions
+@timed
 def update_status():
     """
     Updates the STATE and the STATUS global with the stats of the current session.
     This info if published (JSON-encoded) to the configured MQTT_HOST/MQTT_PORT/MQTT_BASE_CHANNEL.
     Meant to be called at the configured INTERVAL.
+
+    In worker mode only the snapshot is taken here, publishing is handed off to WORKER.
+    """
+    if SENSOR is None:
+        return
+    start = time.perf_counter_ns()
+    snapshot = SENSOR.take_snapshot(SAMPLES.drain() if SAMPLES is not None else None)
+    if SCHEDULER is not None:
+        reschedule(SCHEDULER.update(snapshot))
+        snapshot.interval = SCHEDULER.interval
+    if WORKER is not None:
+        WORKER.submit(snapshot)
+    else:
+        publish_status(snapshot)
+    SENSOR.main_thread_ns = time.perf_counter_ns() - start
+    if DEBUG: print(f"update_status spent {SENSOR.main_thread_ns // 1000}us on the OBS thread")
+
+def reschedule(interval):
+    """
+    Moves the update_status timer to a new interval (in seconds) if it changed
+    """
+    global TIMER_INTERVAL
+    milliseconds = int(interval * 1000)
+    if milliseconds == TIMER_INTERVAL:
+        return
+    obs.timer_remove(update_status)
+    obs.timer_add(update_status, milliseconds)
+    TIMER_INTERVAL = milliseconds
+    if DEBUG: print(f"Publishing every {milliseconds}ms")
+
+def start_polling():
+    """
+    (Re)starts the timers that sample and publish our status information
+    """
+    global SAMPLES
+    global POLLING
+    global SCHEDULER
+    global TIMER_INTERVAL
+    longest = INTERVAL
+    if ADAPTIVE:
+        SCHEDULER = AdaptiveScheduler(INTERVAL)
+        longest = max(INTERVAL, ADAPTIVE_MAX_INTERVAL)
+    else:
+        SCHEDULER = None
+    TIMER_INTERVAL = None
+    obs.timer_remove(update_status)
+    reschedule(SCHEDULER.interval if SCHEDULER is not None else INTERVAL)
+    obs.timer_remove(sample_frame_stats)
+    if SAMPLE_INTERVAL > 0:
+        # Twice the samples of the longest interval, so a late publish doesn't wrap the window
+        SAMPLES = SampleRing(2 * math.ceil(longest * 1000 / SAMPLE_INTERVAL))
+        obs.timer_add(sample_frame_stats, SAMPLE_INTERVAL)
+    else:
+        SAMPLES = None
+    POLLING = True
+
+def stop_polling():
+    """
+    Removes the periodic timers, nothing runs until an output starts again
+    """
+    global POLLING
+    obs.timer_remove(update_status)
+    obs.timer_remove(sample_frame_stats)
+    POLLING = False
+
+def update_polling(snapshot):
+    """
+    In event driven mode the timers only run while an output is active.
+    When the last output stops the window sampled so far is published.
+    """
+    if not EVENT_DRIVEN:
+        return
+    if snapshot.active and not POLLING:
+        start_polling()
+    elif not snapshot.active and POLLING:
+        stop_polling()
+        if SAMPLES is not None:
+            snapshot.frame_window = SAMPLES.drain()
+        SENSOR.publish_attributes(snapshot)
+
+def any_output_active():
+    return (obs.obs_frontend_streaming_active() or obs.obs_frontend_recording_active()
+            or obs.obs_frontend_virtualcam_active())
+
+def sample_outputs(active):
+    """
+    Samples the telemetry of every active output, inactive ones start a fresh window
+    """
+    outputs = {}
+    for name, telemetry in OUTPUT_TELEMETRY.items():
+        if not active[name]:
+            telemetry.reset()
+            continue
+        output = OUTPUT_GETTERS[name]()
+        if output is None:
+            continue
+        try:
+            outputs[name] = telemetry.sample(output)
+        finally:
+            obs.obs_output_release(output)
+    return outputs
+
+def sample_frame_stats():
+    """
+    Records one frame stats sample, called at SAMPLE_INTERVAL
+    """
+    if SAMPLES is not None:
+        SAMPLES.add(obs.obs_get_active_fps(), obs.obs_get_average_frame_time_ns(), obs.obs_get_lagged_frames())
+
+def publish_status(snapshot):
+    """
+    Publishes a snapshot taken by update_status
     """
-    global SENSOR
-    if CONTROL:
-        STREAM_SWITCH.publish_availability(SwitchPayload.ON)
-        VIRTUAL_CAMERA_SWITCH.publish_availability(SwitchPayload.ON)
-        RECORD_SWITCH.publish_availability(SwitchPayload.ON)
-    sensor_state = SENSOR.state()
     previous_state = SENSOR.previous_state
+    sensor_state = SENSOR.state(snapshot)
     if previous_state != SensorState.Stopped and sensor_state == SensorState.Stopped:
         print("Publishing Final Stopped Message")
-        SENSOR.publish_attributes()
+        SENSOR.publish_attributes(snapshot)
     if previous_state != SensorState.Off and sensor_state == SensorState.Off:
         print("Publishing Final Off Message")
-        SENSOR.publish_attributes()
+        SENSOR.publish_attributes(snapshot)
     if SENSOR.active:
-        SENSOR.publish_attributes()
+        SENSOR.publish_attributes(snapshot)
+
+def publish_diagnostics():
+    """
+    Publishes the diagnostics sensor, called at DIAGNOSTICS_INTERVAL
+    """
+    if DIAGNOSTICS is not None and CLIENT.is_connected():
+        DIAGNOSTICS.publish()
+
+@timed
+def capture_thumbnail():
+    """
+    Renders the program output on the OBS thread, called at THUMBNAIL_INTERVAL.
+    read_thumbnail picks the frame up THUMBNAIL_READBACK_DELAY later.
+    """
+    if CAMERA is None or not CLIENT.is_connected():
+        return
+    if CAPTURE.stage():
+        obs.timer_remove(read_thumbnail)
+        obs.timer_add(read_thumbnail, THUMBNAIL_READBACK_DELAY)
+
+@timed
+def read_thumbnail():
+    """
+    One-shot timer, maps the frame capture_thumbnail staged. Comparing, encoding
+    and publishing happen on THUMBNAILS.
+    """
+    obs.timer_remove(read_thumbnail)
+    if CAPTURE is None:
+        return
+    frame = CAPTURE.read()
+    if frame is not None:
+        THUMBNAILS.submit(frame)
+
+def start_thumbnails():
+    """
+    (Re)starts capturing thumbnails with the current settings
+    """
+    global CAPTURE
+    global THUMBNAILS
+    stop_thumbnails()
+    if not THUMBNAIL:
+        return
+    try:
+        CAPTURE = ProgramCapture(THUMBNAIL_WIDTH)
+    except OSError as e:
+        print(f"Thumbnails disabled: {e}")
+        return
+    THUMBNAILS = ThumbnailWorker(THUMBNAIL_MAX_BYTES, THUMBNAIL_THRESHOLD)
+    THUMBNAILS.start()
+    obs.timer_add(capture_thumbnail, THUMBNAIL_INTERVAL * 1000)
+
+def stop_thumbnails():
+    global CAPTURE
+    global THUMBNAILS
+    obs.timer_remove(capture_thumbnail)
+    obs.timer_remove(read_thumbnail)
+    if THUMBNAILS is not None:
+        THUMBNAILS.stop()
+        THUMBNAILS = None
+    if CAPTURE is not None:
+        CAPTURE.close()
+        CAPTURE = None
+
+def start_audio():
+    """
+    (Re)attaches the meters to the configured audio sources
+    """
+    global AUDIO
+    stop_audio()
+    names = [name.strip() for name in AUDIO_SOURCES.split(",") if name.strip()]
+    if not names:
+        return
+    AUDIO = AudioMeters(names, AUDIO_SILENCE_THRESHOLD, AUDIO_SILENCE_SECONDS, AUDIO_CLIP_THRESHOLD)
+    try:
+        AUDIO.attach()
+    except OSError as e:
+        print(f"Audio levels disabled: {e}")
+        AUDIO = None
+        return
+    obs.timer_add(check_audio_events, AUDIO_EVENT_INTERVAL)
+
+def stop_audio():
+    global AUDIO
+    obs.timer_remove(check_audio_events)
+    if AUDIO is not None:
+        AUDIO.detach()
+        AUDIO = None
+
+def check_audio_events():
+    """
+    Publishes silence and clipping as they happen instead of waiting for the next update, called at AUDIO_EVENT_INTERVAL
+    """
+    events = AUDIO.check_events()
+    if AUDIO_EVENTS is None or not CLIENT.is_connected():
+        return
+    for event_type, source in events:
+        AUDIO_EVENTS.publish(event_type, source)
+
+def frame_signature(rgba, width, height, columns=16, rows=9):
+    """
+    Colours of the pixels on a coarse grid, a few hundred bytes per frame
+    """
+    step = max(1, width // columns) * 4
+    signature = bytearray()
+    for row in range(rows):
+        y = (2 * row + 1) * height // (2 * rows)
+        line = rgba[y * width * 4:(y + 1) * width * 4]
+        for channel in range(3):
+            signature += line[step // 2 - step // 2 % 4 + channel::step][:columns]
+    return bytes(signature)
+
+def signature_difference(a, b):
+    """
+    Mean absolute difference of two signatures, in percent
+    """
+    if len(a) != len(b) or not a:
+        return 100.0
+    return sum(abs(x - y) for x, y in zip(a, b)) * 100 / (255 * len(a))
+
+def encode_thumbnail(rgba, width, height, max_bytes):
+    """
+    Encodes the frame as a PNG of at most max_bytes. Colours are quantized and
+    then the size halved until it fits, None if it never does.
+    """
+    rgb = bytearray(width * height * 3)
+    for channel in range(3):
+        rgb[channel::3] = rgba[channel::4]
+    while True:
+        for bits in (0, 2, 3, 4):
+            image = encode_png(rgb.translate(QUANTIZE[bits]) if bits else rgb, width, height)
+            if len(image) <= max_bytes:
+                return image
+        if width < 128:
+            return None
+        rgb, width, height = halve(rgb, width, height)
+
+def halve(rgb, width, height):
+    """
+    Drops every other row and column
+    """
+    half_width = width // 2
+    stride = width * 3
+    out = bytearray(half_width * (height // 2) * 3)
+    position = 0
+    for y in range(0, height - 1, 2):
+        line = rgb[y * stride:(y + 1) * stride]
+        for channel in range(3):
+            out[position + channel:position + half_width * 3:3] = line[channel::6][:half_width]
+        position += half_width * 3
+    return out, half_width, height // 2
+
+def encode_png(rgb, width, height):
+    """
+    8 bit RGB PNG without row filters, zlib does all the work
+    """
+    stride = width * 3
+    raw = b"".join(b"\x00" + rgb[y * stride:(y + 1) * stride] for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6))
+            + chunk(b"IEND", b""))
+
+def stats_expiry():
+    """
+    Stats older than two publish intervals are never worth delivering (in seconds)
+    """
+    if not MQTT_V5:
+        return None
+    return math.ceil(2 * (max(INTERVAL, ADAPTIVE_MAX_INTERVAL) if ADAPTIVE else INTERVAL))
+
+def create_client():
+    """
+    Creates the MQTT client for the configured protocol version
+    """
+    client = mqtt.Client(protocol=mqtt.MQTTv5 if MQTT_V5 else mqtt.MQTTv311)
+    client.on_connect = on_mqtt_connect
+    client.on_connect_fail = on_mqtt_connect_fail
+    client.on_disconnect = on_mqtt_disconnect
+    client.on_message = on_mqtt_message
+    client.on_publish = on_mqtt_publish
+    return client
+
+def create_tls_context():
+    """
+    TLS settings for the broker connection, the session is kept for the next connection
+    """
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    if MQTT_CA_FILE:
+        context.load_verify_locations(cafile=MQTT_CA_FILE)
+    else:
+        context.load_default_certs()
+    if MQTT_CERT_FILE:
+        context.load_cert_chain(MQTT_CERT_FILE, MQTT_KEY_FILE or None)
+    if MQTT_TLS_INSECURE:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+def load_libobs():
+    """
+    The libobs OBS has already loaded, with the signatures of the calls ProgramCapture and AudioMeters make
+    """
+    candidates = ["obs"] if sys.platform == "win32" else [None, "libobs.so.0", "libobs.dylib"]
+    found = ctypes.util.find_library("obs")
+    if found:
+        candidates.append(found)
+    for name in candidates:
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+        if hasattr(lib, "obs_render_main_texture"):
+            break
+    else:
+        raise OSError("libobs not found")
+    void_p = ctypes.c_void_p
+    signatures = {
+        "obs_enter_graphics": (None, []),
+        "obs_leave_graphics": (None, []),
+        "obs_render_main_texture": (None, []),
+        "gs_texrender_create": (void_p, [ctypes.c_int, ctypes.c_int]),
+        "gs_texrender_destroy": (None, [void_p]),
+        "gs_texrender_reset": (None, [void_p]),
+        "gs_texrender_begin": (ctypes.c_bool, [void_p, ctypes.c_uint32, ctypes.c_uint32]),
+        "gs_texrender_end": (None, [void_p]),
+        "gs_texrender_get_texture": (void_p, [void_p]),
+        "gs_stagesurface_create": (void_p, [ctypes.c_uint32, ctypes.c_uint32, ctypes.c_int]),
+        "gs_stagesurface_destroy": (None, [void_p]),
+        "gs_stage_texture": (None, [void_p, void_p]),
+        "gs_stagesurface_map": (ctypes.c_bool, [void_p, ctypes.POINTER(void_p), ctypes.POINTER(ctypes.c_uint32)]),
+        "gs_stagesurface_unmap": (None, [void_p]),
+        "gs_clear": (None, [ctypes.c_uint32, ctypes.POINTER(ProgramCapture.Vec4), ctypes.c_float, ctypes.c_uint8]),
+        "gs_ortho": (None, [ctypes.c_float] * 6),
+        "gs_blend_state_push": (None, []),
+        "gs_blend_state_pop": (None, []),
+        "gs_reset_blend_state": (None, []),
+        "obs_get_source_by_name": (void_p, [ctypes.c_char_p]),
+        "obs_source_release": (None, [void_p]),
+        "obs_volmeter_create": (void_p, [ctypes.c_int]),
+        "obs_volmeter_destroy": (None, [void_p]),
+        "obs_volmeter_attach_source": (ctypes.c_bool, [void_p, void_p]),
+        "obs_volmeter_detach_source": (None, [void_p]),
+        "obs_volmeter_get_nr_channels": (ctypes.c_int, [void_p]),
+        "obs_volmeter_add_callback": (None, [void_p, AudioMeters.CALLBACK, void_p]),
+        "obs_volmeter_remove_callback": (None, [void_p, AudioMeters.CALLBACK, void_p]),
+    }
+    for function, (restype, argtypes) in signatures.items():
+        getattr(lib, function).restype = restype
+        getattr(lib, function).argtypes = argtypes
+    return lib
+
+def publish_tracked(topic, payload=None, qos=0, retain=False, properties=None):
+    """
+    Every publish goes through here. Messages are tracked until paho reports them
+    written to the socket (QoS 0) or acknowledged by the broker (QoS > 0), which
+    gives the outgoing backlog and, for QoS > 0, the acknowledgement latency.
+    """
+    sent = time.perf_counter_ns()
+    info = CLIENT.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        return info
+    with ACK_LOCK:
+        acked = EARLY_ACKS.pop(info.mid, None)
+        if acked is not None: # on_mqtt_publish already ran on the network thread
+            if qos > 0:
+                ACK_TIMINGS.record(acked - sent)
+        elif len(ACK_PENDING) + len(QUEUED) < 10000: # Never grows unbounded if the socket stalls
+            if qos > 0:
+                ACK_PENDING[info.mid] = sent
+            else:
+                QUEUED.add(info.mid)
+    return info
+
+def shared_status_path(data_dir, mqtt_sensor_name):
+    """
+    Where the segment shared with mqtt_status_bridge.py lives, in memory backed /dev/shm where there is one
+    """
+    if not data_dir:
+        data_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(data_dir, f"{mqtt_sensor_name}_bridge.bin")
+
+def start_bridge():
+    """
+    Hands MQTT over to mqtt_status_bridge.py. From here on OBS only writes its state
+    into the shared segment and executes the commands the bridge queues there,
+    settings changes are passed on for the bridge to apply.
+    """
+    global BRIDGE
+    global OFFLINE
+    CLIENT.disconnect()
+    CLIENT.loop_stop()
+    stop_worker()
+    stop_writer()
+    stop_thumbnails()
+    stop_audio()
+    stop_polling()
+    obs.timer_remove(publish_diagnostics)
+    obs.timer_remove(drain_commands)
+    obs.timer_remove(discover_pending)
+    obs.timer_remove(follow_outputs)
+    obs.obs_frontend_remove_event_callback(frontend_changed)
+    if OFFLINE is not None:
+        OFFLINE.close() # The bridge opens its own
+        OFFLINE = None
+    path = shared_status_path(DATA_DIR, MQTT_SENSOR_NAME)
+    if BRIDGE is not None and BRIDGE.path != path:
+        BRIDGE.close(closed=True)
+        BRIDGE = None
+    if BRIDGE is None:
+        try:
+            BRIDGE = SharedStatus(path, create=True)
+        except OSError as e:
+            print(f"Bridge mode disabled, could not create {path}: {e}")
+            return
+        if DEBUG: print(f"Sharing state with the bridge through {path}")
+    BRIDGE.write_settings(APPLIED_SETTINGS)
+    write_bridge_names()
+    write_bridge_status()
+    obs.obs_frontend_remove_event_callback(bridge_changed)
+    obs.obs_frontend_add_event_callback(bridge_changed)
+    hook_outputs()
+    obs.timer_remove(bridge_tick)
+    obs.timer_add(bridge_tick, BRIDGE_INTERVAL)
+
+def stop_bridge():
+    """
+    Closes the shared segment, which tells the bridge to mark everything unavailable
+    """
+    global BRIDGE
+    obs.timer_remove(bridge_tick)
+    obs.obs_frontend_remove_event_callback(bridge_changed)
+    if BRIDGE is not None:
+        BRIDGE.close(closed=True)
+        BRIDGE = None
+
+def bridge_changed(event):
+    """
+    Frontend callback in bridge mode, the bridge sees every change without waiting for the next tick
+    """
+    if event in (obs.OBS_FRONTEND_EVENT_PROFILE_CHANGED, obs.OBS_FRONTEND_EVENT_PROFILE_LIST_CHANGED):
+        BRIDGE.write_names(SwitchType.profile, obs.obs_frontend_get_profiles(), obs.obs_frontend_get_current_profile())
+    elif event in (obs.OBS_FRONTEND_EVENT_SCENE_CHANGED, obs.OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED):
+        if event == obs.OBS_FRONTEND_EVENT_SCENE_LIST_CHANGED:
+            SCENES.invalidate()
+        BRIDGE.write_names(SwitchType.scene, SCENES.get(), current_scene_name())
+    elif event in (obs.OBS_FRONTEND_EVENT_SCENE_COLLECTION_CHANGED, obs.OBS_FRONTEND_EVENT_SCENE_COLLECTION_LIST_CHANGED):
+        SCENES.invalidate()
+        SCENE_COLLECTIONS.invalidate()
+        write_bridge_names()
+    elif event in (obs.OBS_FRONTEND_EVENT_STREAMING_STARTING, obs.OBS_FRONTEND_EVENT_RECORDING_STARTING,
+                   obs.OBS_FRONTEND_EVENT_VIRTUALCAM_STARTED):
+        hook_outputs()
+    write_bridge_status()
+
+def bridge_tick():
+    """
+    Writes the current state for the bridge and executes the commands it queued, called at BRIDGE_INTERVAL
+    """
+    write_bridge_status()
+    for switch_type, payload, name in BRIDGE.read_commands():
+        if DEBUG: print(f"Bridge command {switch_type.value} {name or ''} {payload.value}")
+        if switch_type == SwitchType.profile:
+            if payload == SwitchPayload.ON:
+                obs.obs_frontend_set_current_profile(name)
+        elif switch_type == SwitchType.scene:
+            set_current_scene(name)
+        elif switch_type == SwitchType.scene_collection:
+            obs.obs_frontend_set_current_scene_collection(name)
+        elif switch_type == SwitchType.stream:
+            if payload == SwitchPayload.ON:
+                obs.obs_frontend_streaming_start()
+            else:
+                obs.obs_frontend_streaming_stop()
+        elif switch_type == SwitchType.virtual_camera:
+            if payload == SwitchPayload.ON:
+                obs.obs_frontend_start_virtualcam()
+            else:
+                obs.obs_frontend_stop_virtualcam()
+        elif switch_type == SwitchType.record:
+            if payload == SwitchPayload.ON:
+                obs.obs_frontend_recording_start()
+            else:
+                obs.obs_frontend_recording_stop()
+
+def write_bridge_names():
+    """
+    Shares the profiles, scenes and scene collections, the segment only rewrites the lists that changed
+    """
+    BRIDGE.write_names(SwitchType.profile, obs.obs_frontend_get_profiles(), obs.obs_frontend_get_current_profile())
+    BRIDGE.write_names(SwitchType.scene, SCENES.get(), current_scene_name())
+    BRIDGE.write_names(SwitchType.scene_collection, SCENE_COLLECTIONS.get(), obs.obs_frontend_get_current_scene_collection())
+
+def write_bridge_status():
+    """
+    Reads every getter the bridge needs once and copies them into the segment
+    """
+    active = {
+        SwitchType.stream: obs.obs_frontend_streaming_active(),
+        SwitchType.record: obs.obs_frontend_recording_active(),
+        SwitchType.virtual_camera: obs.obs_frontend_virtualcam_active()
+    }
+    outputs = {}
+    for name, get_output in OUTPUT_GETTERS.items():
+        output = get_output() if active[name] else None
+        if output is None:
+            outputs[name] = (False, False, 0, 0, 0, 0.0, 0, OUTPUT_RECONNECTS[name])
+            continue
+        try:
+            outputs[name] = (
+                True,
+                obs.obs_output_reconnecting(output),
+                obs.obs_output_get_total_bytes(output),
+                obs.obs_output_get_total_frames(output),
+                obs.obs_output_get_frames_dropped(output),
+                obs.obs_output_get_congestion(output),
+                obs.obs_output_get_connect_time_ms(output),
+                OUTPUT_RECONNECTS[name]
+            )
+        finally:
+            obs.obs_output_release(output)
+    BRIDGE.write_status(
+        active[SwitchType.record],
+        active[SwitchType.stream],
+        active[SwitchType.virtual_camera],
+        obs.obs_frontend_recording_paused(),
+        obs.obs_get_active_fps(),
+        obs.obs_get_average_frame_time_ns(),
+        obs.obs_get_total_frames(),
+        obs.obs_get_lagged_frames(),
+        outputs
+    )
+
+def start_writer():
+    """
+    Starts the disk writing thread while the offline buffer or the history is open, stops it otherwise
+    """
+    global WRITER
+    if OFFLINE is None and HISTORY is None:
+        stop_writer()
+    elif WRITER is None:
+        WRITER = DiskWriter(WRITER_QUEUE_SIZE)
+        WRITER.start()
+
+def stop_writer():
+    """
+    Stops the disk writing thread once it has written what it was given
+    """
+    global WRITER
+    if WRITER is not None:
+        WRITER.stop()
+        WRITER = None
+
+def start_worker():
+    """
+    Starts the background publishing thread if it isn't running yet
+    """
+    global WORKER
+    if WORKER is None:
+        WORKER = PublishWorker()
+        WORKER.start()
+
+def stop_worker():
+    """
+    Stops the background publishing thread, publishing happens on the OBS thread again
+    """
+    global WORKER
+    if WORKER is not None:
+        WORKER.stop()
+        WORKER = None
 
 def message_to_switch_entity(message):
     """
     Converts MQTT Message to the corresponding switch entity
     """
-    topic = pathlib.PurePosixPath(message.topic)
-    message_type = SwitchType[topic.parent.stem] # Stream, Record or Profile
-    if message_type == SwitchType.stream:
-        return STREAM_SWITCH
-    if message_type == SwitchType.virtual_camera:
-        return VIRTUAL_CAMERA_SWITCH
-    if message_type == SwitchType.record:
-        return RECORD_SWITCH
-    if message_type == SwitchType.profile:
-        for profile in PROFILES:
-            if profile.command_topic == message.topic:
-                return profile
-    return None
+    switch = ROUTES.get(message.topic)
+    if switch is None and DEBUG:
+        print(f"Ignoring message on unrouted topic {message.topic}")
+    return switch
 
 # Using a global MQTT client variable to keep things simple:
-CLIENT = mqtt.Client()
-CLIENT.on_connect = on_mqtt_connect
-CLIENT.on_disconnect = on_mqtt_disconnect
-CLIENT.on_message = on_mqtt_message
+BACKOFF = Backoff(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+CLIENT = create_client()
+TOPIC_ALIASES = TopicAliases()
+ACK_TIMINGS = Histogram()
+OUTPUT_GETTERS = {
+    SwitchType.stream: obs.obs_frontend_get_streaming_output,
+    SwitchType.record: obs.obs_frontend_get_recording_output,
+    SwitchType.virtual_camera: obs.obs_frontend_get_virtualcam_output
+}
+OUTPUT_RECONNECTS = dict.fromkeys(OUTPUT_GETTERS, 0)
+OUTPUT_TELEMETRY = {name: OutputTelemetry(name, OUTPUT_WINDOW) for name in OUTPUT_GETTERS}
+PUBLISHER = Publisher(HEARTBEAT)
+SCENES = NameIndex(obs.obs_frontend_get_scene_names)
+SCENE_COLLECTIONS = NameIndex(obs.obs_frontend_get_scene_collections)
+QUANTIZE = {bits: bytes(value & (0xff << bits) & 0xff for value in range(256)) for bits in (2, 3, 4)} # Drop the low bits of each colour
+COMMANDS = CommandQueue(COMMAND_QUEUE_SIZE)